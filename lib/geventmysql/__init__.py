@@ -9,6 +9,7 @@
 #TODO weak ref on connection in cursor
 
 
+import re
 import sys
 import logging
 import exceptions
@@ -16,8 +17,8 @@ import exceptions
 import gevent
 TaskletExit = gevent.GreenletExit
 
-from datetime import datetime, date
 from geventmysql import client
+from geventmysql._mysql import escape_string, encode_args, ROW_FACTORY
 
 threadsafety = 1
 apilevel = "2.0"
@@ -38,12 +39,54 @@ class NotSupportedError(DatabaseError): pass
 
 class TimeoutError(DatabaseError): pass
 
+#matches INSERT/REPLACE ... VALUES (%s, ...) [ON DUPLICATE KEY UPDATE ...] so that executemany can
+#send multiple rows in a single statement
+_insert_values = re.compile(r"\s*((?:INSERT|REPLACE)\b.+\bVALUES?\s*)(\(\s*%s\s*(?:,\s*%s\s*)*\))(\s*(?:ON\s+DUPLICATE\b.*)?);?\s*\Z",
+                            re.IGNORECASE | re.DOTALL)
+
+#quoted strings and identifiers, which the server does not look into for ? placeholders
+_quoted = re.compile(r"""('(?:[^'\\]|\\.|'')*'|"(?:[^"\\]|\\.|"")*"|`[^`]*`)""", re.DOTALL)
+_format_spec = re.compile(r"%(.)", re.DOTALL)
+
+def _prepared_query(qry, arg_count):
+    """rewrites the %s placeholders of a query into the ? placeholders of a prepared statement.
+    Returns None if that is not possible, because there are placeholders inside quoted strings, a literal ?
+    outside of them or the wrong number of placeholders"""
+    parts = _quoted.split(qry)
+    placeholders = [0]
+    def convert(m):
+        if m.group(1) == 's':
+            placeholders[0] += 1
+            return '?'
+        elif m.group(1) == '%':
+            return '%'
+        raise ValueError(m.group(0))
+    try:
+        for i, part in enumerate(parts):
+            if i % 2 == 0:
+                #outside quotes
+                if '?' in part:
+                    return None
+                parts[i] = _format_spec.sub(convert, part)
+            elif '%' in part:
+                parts[i] = part % () #unescape %%, placeholders raise TypeError
+    except (ValueError, TypeError):
+        return None
+    if placeholders[0] != arg_count:
+        return None
+    return ''.join(parts)
+
 class Cursor(object):
     log = logging.getLogger('Cursor')
 
+    batch_size = 1024 * 1024 #max size in bytes of a multi row statement sent by executemany
+    pipeline_size = 1000 #max number of statements executemany sends in a single pipeline
+    row_factory = None #type of the rows fetched (see ROW_FACTORY), None means the default of the connection
+
     def __init__(self, connection):
         self.connection = connection
         self.result = None
+        self._statement = None #uncached prepared statement that belongs to the current result
         self.closed = False
         self._close_result()
         
@@ -53,24 +96,24 @@ class Cursor(object):
         if self.result is not None:
             #make sure any left over resultset is read from the db, otherwise
             #the connection would be in an inconsistent state
-            try:
-                while True:
-                    self.result_iter.next()
-            except StopIteration:
-                pass #done
+            if self.result.state == client.ResultSet.STATE_OPEN:
+                self.result.discard()
             self.result.close()
 
+        if self._statement is not None:
+            self._statement.close()
+            self._statement = None
+
         self.description = None
         self.result = None
         self.result_iter = None
         self.lastrowid = None
         self.rowcount = -1
+        self._results = None #the next results of a pipelined statement, None when nextset reads them from the connection
         
-    def _escape_string(self, s, replace = {'\0': '\\0', '\n': '\\n', '\r': '\\r', '\\': '\\\\', "'": "\\'", '"': '\\"', '\x1a': '\\Z'}):
+    def _escape_string(self, s):
         """take from mysql src code:"""
-        #TODO how fast is this?, do this in C/pyrex?
-        get = replace.get
-        return "".join([get(ch, ch) for ch in s])
+        return escape_string(s)
 
             
     def _wrap_exception(self, e, msg):
@@ -80,8 +123,10 @@ class Cursor(object):
         else:
             return Error(msg + ': ' + str(e))
         
-    def execute(self, qry, args = []):
+    def execute(self, qry, args = [], shared = None):
         #print repr(qry),  repr(args), self.connection.charset
+        #shared is passed on to client.Connection.query, by default selects are only shared with the
+        #connections single_flight in autocommit mode, True shares them within a transaction as well
         if self.closed:
             raise ProgrammingError('this cursor is already closed')
 
@@ -91,46 +136,162 @@ class Cursor(object):
 
         try:
             self._close_result() #close any previous result if needed
-            #substitute arguments
-            params = []
-            for arg in args:
-                if type(arg) == str:
-                    params.append("'%s'" % self._escape_string(arg))
-                elif type(arg) == unicode:
-                    params.append("'%s'" % self._escape_string(arg).encode(self.connection.charset))
-                elif isinstance(arg, (int, long, float)):
-                    params.append(str(arg))
-                elif arg is None:
-                    params.append('null')
-                elif isinstance(arg, datetime):
-                    params.append("'%s'" % arg.strftime('%Y-%m-%d %H:%M:%S'))
-                elif isinstance(arg, date):
-                    params.append("'%s'" % arg.strftime('%Y-%m-%d'))
-                else:
-                    assert False, "unknown argument type: %s %s" % (type(arg), repr(arg))
 
-            qry = qry % tuple(params)
-            result = self.connection.client.query(qry)
-            
-            #process result if nescecary
-            if isinstance(result, client.ResultSet):
-                self.description = tuple(((name, type_code, None, None, None, None, None) for name, type_code, charsetnr in result.fields))
-                self.result = result
-                self.result_iter = iter(result)
-                self.lastrowid = None
-                self.rowcount = -1
+            prepared_qry = None
+            if args and (self.connection.client.statement_cache_size or filter(client.is_long_data, args)):
+                prepared_qry = _prepared_query(qry, len(args))
+                if prepared_qry is None and filter(client.is_long_data, args):
+                    raise ProgrammingError("file like and iterator arguments need a query that can be prepared, with a %s placeholder for every argument and no placeholders in quoted strings")
+
+            if prepared_qry is not None:
+                result = self._execute_prepared(prepared_qry, args)
             else:
-                self.rowcount, self.lastrowid = result
-                self.description = None
-                self.result = None
+                #queries that can not be prepared fall back to the text protocol
+                result = self._execute_query(qry, args, shared)
+
+            self._set_result(result)
+
+        except TaskletExit:
+            raise
+        except Exception, e:
+            raise self._wrap_exception(e, "an error occurred while executing qry %s" % (qry, ))
+
+    def executemany(self, qry, seq_of_args):
+        """Executes the query once for each sequence of arguments in *seq_of_args*.
+        INSERT and REPLACE statements are rewritten into multi row statements of at most :attr:`batch_size`
+        bytes, other statements are sent in pipelines of at most :attr:`pipeline_size` statements.
+        :attr:`rowcount` is the total number of affected rows. When a pipelined statement fails, the statements
+        in the same pipeline after it were executed already."""
+        if self.closed:
+            raise ProgrammingError('this cursor is already closed')
+
+        if type(qry) == unicode:
+            qry = qry.encode(self.connection.charset)
+
+        m = _insert_values.match(qry)
+        if m is not None:
+            prefix, values, postfix = m.groups()
+            try:
+                prefix, postfix = prefix % (), postfix % () #unescape %%
+            except TypeError:
+                m = None #there are placeholders outside of the values part
+
+        try:
+            self._close_result()
+
+            if m is None:
+                self.rowcount = self._execute_pipelined(qry, seq_of_args)
+                return
+
+            #stay well below the max packet size of both sides, leaving room for the header and the command byte
+            max_size = min(self.batch_size, self.connection.client.get_max_allowed_packet() - 1024)
+            charset = self.connection.charset
+            rowcount = 0
+            batch = []
+            size = len(prefix) + len(postfix)
+            for args in seq_of_args:
+                row = values % encode_args(args, charset)
+                if batch and size + len(row) + 1 > max_size:
+                    rowcount += self._execute_batch(prefix, batch, postfix)
+                    batch = []
+                    size = len(prefix) + len(postfix)
+                batch.append(row)
+                size += len(row) + 1
+            if batch:
+                rowcount += self._execute_batch(prefix, batch, postfix)
+            self.rowcount = rowcount
 
         except TaskletExit:
             raise
         except Exception, e:
             raise self._wrap_exception(e, "an error occurred while executing qry %s" % (qry, ))
+
+    def _execute_pipelined(self, qry, seq_of_args):
+        charset = self.connection.charset
+        rowcount = 0
+        pipeline = self.connection.client.pipeline()
+        for args in seq_of_args:
+            pipeline.query(qry % encode_args(args, charset))
+            if len(pipeline) >= self.pipeline_size:
+                rowcount += self._run_pipeline(pipeline)
+        if len(pipeline):
+            rowcount += self._run_pipeline(pipeline)
+        return rowcount
+
+    def _run_pipeline(self, pipeline):
+        rowcount = 0
+        error = None
+        for results in pipeline.run():
+            if not isinstance(results, list):
+                results = [results]
+            for result in results:
+                if isinstance(result, Exception):
+                    error = error or result
+                elif isinstance(result, client.ResultSet):
+                    result.close() #the rows were read already
+                else:
+                    affected, self.lastrowid = result
+                    rowcount += affected
+        if error is not None:
+            raise error
+        return rowcount
+
+    def _execute_batch(self, prefix, rows, postfix):
+        rowcount, self.lastrowid = self.connection.client.query(prefix + ','.join(rows) + postfix)
+        return rowcount
+
+    def _set_result(self, result):
+        #process result if nescecary
+        if isinstance(result, client.ResultSet):
+            if self.row_factory is not None:
+                result.decoder.set_row_factory(self.row_factory)
+            self.description = tuple(((name, type_code, None, None, None, None, None) for name, type_code, charsetnr, flags in result.fields))
+            self.result = result
+            self.result_iter = iter(result)
+            self.lastrowid = None
+            self.rowcount = -1
+        else:
+            self.rowcount, self.lastrowid = result
+            self.description = None
+            self.result = None
+
+    def _execute_query(self, qry, args, shared = None):
+        #substitute arguments
+        qry = qry % encode_args(args, self.connection.charset)
+        if self.row_factory is not None:
+            #shared rows are read before our row factory could be applied to them
+            shared = False
+        return self.connection.client.query(qry, shared)
+
+    def _execute_prepared(self, qry, args):
+        #the query is prepared once per connection with ? placeholders (see _prepared_query), the arguments are
+        #sent separately in the binary protocol, so they need no formatting or escaping.
+        #file like and iterator arguments are streamed to the server
+        cnn = self.connection.client
+        if cnn.statement_cache_size:
+            statement = cnn.prepare_cached(qry)
+        else:
+            statement = cnn.prepare(qry)
+        charset = self.connection.charset
+        params = []
+        for arg in args:
+            if type(arg) == unicode:
+                params.append(arg.encode(charset))
+            else:
+                params.append(arg)
+        try:
+            result = statement.execute(params)
+        finally:
+            if not cnn.statement_cache_size and cnn.current_resultset is None:
+                statement.close()
+        if not cnn.statement_cache_size and isinstance(result, client.ResultSet):
+            self._statement = statement #closed after the resultset
+        return result
         
     def fetchall(self):
         try:
+            if isinstance(self.result_iter, client.RowIterator):
+                return self.result_iter.read_all() #fills the list without going through the iterator protocol
             return list(self.result_iter)
         except TaskletExit:
             raise
@@ -147,6 +308,61 @@ class Cursor(object):
         except Exception, e:
             raise self._wrap_exception(e, "an error occurred while fetching results")
     
+    def nextset(self):
+        """Skips to the next result of a query with multiple statements or of a stored procedure call,
+        the rows of the current resultset that were not fetched are discarded. Returns None when there are
+        no more results, otherwise True"""
+        if self.closed:
+            raise ProgrammingError('this cursor is already closed')
+
+        try:
+            if self.result is not None:
+                if self.result.state == client.ResultSet.STATE_OPEN:
+                    self.result.discard()
+                self.result.close()
+                self.result = None
+
+            if self._results is not None:
+                #the results of a pipelined statement were read already
+                if not self._results:
+                    self._close_result()
+                    return None
+                result = self._results.pop(0)
+                if isinstance(result, Exception):
+                    self._results = []
+                    raise result
+                self._set_result(result)
+                return True
+
+            cnn = self.connection.client
+            if not cnn.more_results:
+                self._close_result()
+                return None
+
+            self._set_result(cnn.next_result())
+            return True
+
+        except TaskletExit:
+            raise
+        except Exception, e:
+            raise self._wrap_exception(e, "an error occurred while reading next result")
+
+    def fetch_columns(self):
+        """Returns the rows of the current resultset per column, see :meth:`client.ResultSet.fetch_columns`.
+        Must be called before any rows are fetched"""
+        if self.result is None:
+            raise ProgrammingError("there is no resultset to fetch columns from")
+        if self.result.started:
+            raise ProgrammingError("cannot fetch columns after rows were fetched")
+        try:
+            columns = self.result.fetch_columns()
+            self.result_iter = iter(())
+            return columns
+        except TaskletExit:
+            raise
+        except Exception, e:
+            raise self._wrap_exception(e, "an error occurred while fetching results")
+
     def close(self):
         if self.closed: 
             raise ProgrammingError("cannot cursor twice")
@@ -159,6 +375,152 @@ class Cursor(object):
         except Exception, e:
             raise self._wrap_exception(e, "an error occurred while closing cursor")
         
+class SSCursor(Cursor):
+    """A cursor that streams the rows of a resultset from the server. Only the rows that were
+    already received in the connections buffer are kept in memory, independent of the size of the result.
+    Rows that were not fetched are skipped without decoding them when the next query is executed
+    or the cursor is closed."""
+
+    arraysize = 1 #default number of rows returned by fetchmany
+
+    def _close_result(self):
+        Cursor._close_result(self)
+        self._batches = None
+        self._rows = []
+        self._pos = 0
+
+    def execute(self, qry, args = []):
+        #streamed rows can not be shared
+        Cursor.execute(self, qry, args, shared = False)
+        self._start_batches()
+
+    def nextset(self):
+        self._batches = None
+        self._rows = []
+        self._pos = 0
+        result = Cursor.nextset(self)
+        self._start_batches()
+        return result
+
+    def _start_batches(self):
+        if self.result is not None:
+            self.result_iter = None #we don't use the row iterator, but the batches
+            self._batches = self.result.iter_batches()
+
+    def fetch_columns(self):
+        columns = Cursor.fetch_columns(self)
+        self._batches = None
+        return columns
+
+    def _next_batch(self):
+        """makes the next batch of rows current, returns False if there are no more rows"""
+        if self._batches is None:
+            return False
+        try:
+            self._rows = self._batches.next()
+            self._pos = 0
+            return True
+        except StopIteration:
+            self._batches = None
+            self._rows = []
+            self._pos = 0
+            return False
+
+    def fetchone(self):
+        try:
+            if self._pos >= len(self._rows) and not self._next_batch():
+                return None
+            row = self._rows[self._pos]
+            self._pos += 1
+            return row
+        except TaskletExit:
+            raise
+        except Exception, e:
+            raise self._wrap_exception(e, "an error occurred while fetching results")
+
+    def fetchmany(self, size = None):
+        if size is None:
+            size = self.arraysize
+        try:
+            result = []
+            while len(result) < size:
+                if self._pos >= len(self._rows) and not self._next_batch():
+                    break
+                n = size - len(result)
+                result.extend(self._rows[self._pos:self._pos + n])
+                self._pos += n
+            return result
+        except TaskletExit:
+            raise
+        except Exception, e:
+            raise self._wrap_exception(e, "an error occurred while fetching results")
+
+    def fetchall(self):
+        try:
+            result = self._rows[self._pos:]
+            self._pos = len(self._rows)
+            while self._next_batch():
+                result.extend(self._rows)
+                self._pos = len(self._rows)
+            return result
+        except TaskletExit:
+            raise
+        except Exception, e:
+            raise self._wrap_exception(e, "an error occurred while fetching results")
+
+class Pipeline(object):
+    """Queues statements that are sent to the server in a single round-trip by :meth:`run`,
+    see :meth:`Connection.pipeline` and :class:`client.Pipeline`"""
+    log = logging.getLogger('Pipeline')
+
+    _wrap_exception = Cursor.__dict__['_wrap_exception']
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.pipeline = connection.client.pipeline()
+        self.queries = []
+
+    def __len__(self):
+        return len(self.queries)
+
+    def execute(self, qry, args = []):
+        """queues the statement, its arguments are substituted like in :meth:`Cursor.execute`"""
+        charset = self.connection.charset
+        if type(qry) == unicode:
+            qry = qry.encode(charset)
+        qry = qry % encode_args(args, charset)
+        self.pipeline.query(qry)
+        self.queries.append(qry)
+
+    def run(self):
+        """Sends the queued statements and returns a list with a cursor holding the result of each statement,
+        the rows of selects are already read. A statement that failed has its :exc:`Error` in its place in the list.
+        The cursor of a statement with more than one result (multi statements, stored procedures) holds the first one,
+        :meth:`Cursor.nextset` moves to the others"""
+        queries = self.queries
+        self.queries = []
+        try:
+            results = self.pipeline.run()
+        except TaskletExit:
+            raise
+        except Exception, e:
+            raise self._wrap_exception(e, "an error occurred while executing pipeline")
+
+        cursors = []
+        for qry, result in zip(queries, results):
+            if isinstance(result, Exception):
+                cursors.append(self._wrap_exception(result, "an error occurred while executing qry %s" % (qry, )))
+            else:
+                cursor = self.connection.cursor()
+                if isinstance(result, list):
+                    #an error ends the results, so the first one is never an error
+                    cursor._set_result(result[0])
+                    cursor._results = result[1:]
+                else:
+                    cursor._set_result(result)
+                cursors.append(cursor)
+        return cursors
+
 class Connection(object):
     
     def __init__(self, *args, **kwargs):
@@ -202,14 +564,33 @@ class Connection(object):
             self.log.exception(msg)
             raise Error(msg + str(e))
             
-    def cursor(self):
+    def cursor(self, cursorclass = Cursor, row_factory = None):
         if self.closed: 
             raise ProgrammingError("this connection is already closed")
-        return Cursor(self)
+        cursor = cursorclass(self)
+        if row_factory is not None:
+            cursor.row_factory = row_factory
+        return cursor
     
+    def pipeline(self):
+        """Returns a :class:`Pipeline` that sends several statements in a single round-trip"""
+        if self.closed:
+            raise ProgrammingError("this connection is already closed")
+        return Pipeline(self)
+
     def get_server_info(self):
         return self.client.server_version
 
+    def get_statement_cache_stats(self):
+        return self.client.get_statement_cache_stats()
+
+    def register_local_infile(self, filename, source):
+        """Registers the data sent for *filename* by a LOAD DATA LOCAL INFILE statement,
+        see :meth:`client.Connection.register_local_infile`"""
+        if self.closed:
+            raise ProgrammingError("this connection is already closed")
+        self.client.register_local_infile(filename, source)
+
     def rollback(self):
         self.client.rollback()
     
@@ -25,11 +25,13 @@ class BufferedReader(object):
     def _read_more(self):
         #any partially read data will be put in front, otherwise normal clear:
         self.buffer.compact()
-        data = self.stream.recv(self.buffer.limit - self.buffer.position)
-        if not data:   
+        #receive straight into the free part of the buffer (position up till limit)
+        n = self.stream.recv_into(self.buffer)
+        if not n:
             raise EOFError("while reading")
-        self.buffer.write_bytes(data)
+        self.buffer.skip(n)
         self.buffer.flip() #prepare to read from buffer
+        return n
 
     def read_lines(self):
         """note that it cant read line accross buffer"""
@@ -100,17 +102,30 @@ class BufferedWriter(object):
     def clear(self):
         self.buffer.clear()
 
-    def write_bytes(self, s):
+    def write_bytes(self, s, offset = 0, length = -1):
+        """writes s, or *length* bytes of s starting at *offset*"""
         assert type(s) == str, "arg must be a str, got: %s" % type(s)
-        try:
-            self.buffer.write_bytes(s)
-        except BufferOverflowError:
-            #we need to send it in parts, flushing as we go
-            while s:
-                r = self.buffer.remaining
-                part, s = s[:r], s[r:]
-                self.buffer.write_bytes(part)
-                self.flush()
+        if length == -1:
+            length = len(s) - offset
+        if offset != 0 or length != len(s):
+            if length <= self.buffer.remaining:
+                self.buffer.write_bytes(s[offset:offset + length])
+                return
+        else:
+            try:
+                self.buffer.write_bytes(s)
+                return
+            except BufferOverflowError:
+                pass
+        #fill up the buffer (e.g. behind a packet header) and send it
+        r = self.buffer.remaining
+        self.buffer.write_bytes(s[offset:offset + r])
+        self.flush()
+        if length - r > self.buffer.remaining:
+            #send the rest straight from s, without copying it into the buffer
+            self.stream.sendall(buffer(s, offset + r, length - r))
+        else:
+            self.buffer.write_bytes(s[offset + r:offset + length])
 
     def write_byte(self, ch):
         assert type(ch) == int, "ch arg must be int"
@@ -139,8 +154,8 @@ class BufferedWriter(object):
 
     def flush(self):
         self.buffer.flip()
-        bytes = self.buffer.read_bytes()
-        self.stream.sendall(bytes)
+        #send from a view on the buffer (position up till limit), without copying into a string
+        self.stream.sendall(buffer(self.buffer))
         self.buffer.clear()
 
 class BufferedStream(object):
@@ -6,12 +6,18 @@
 #TODO supporting closing a halfread resultset (e.g. automatically read and discard rest)
 
 import errno
+import re
+import collections
 from geventmysql._mysql import Buffer
-from geventmysql.mysql import BufferedPacketReader, BufferedPacketWriter, PACKET_READ_RESULT, CAPS, COMMAND
+from geventmysql.mysql import BufferedPacketReader, BufferedPacketWriter, PACKET_READ_RESULT, CAPS, COMMAND, FIELD_TYPE, SERVER_STATUS
+from geventmysql.mysql import pack_binary_value, pack_tsv_row, CompressedStream, MAX_PAYLOAD_LENGTH, RowIterator
+from geventmysql.mysql import ColumnBuilder, BufferedBlobReader, RowDecoder, ROW_FACTORY
 import logging
 import time
+import struct
 from gevent import socket
 import gevent
+from gevent.event import AsyncResult
 import sys
 
 # From query: SHOW COLLATION;
@@ -80,30 +86,176 @@ class ClientProgrammingError(ClientError): pass
 
 class ResultSet(object):
     """Represents the current resultset being read from a Connection.
-    The resultset implements an iterator over rows. A Resultset must
+    Iterating the resultset returns a :class:`RowIterator` over the rows. A Resultset must
     be iterated entirely and closed explicitly."""
     STATE_INIT = 0
     STATE_OPEN = 1
     STATE_EOF = 2
     STATE_CLOSED = 3
 
-    def __init__(self, connection, field_count):
+    def __init__(self, connection, field_count, binary = False):
         self.state = self.STATE_INIT
 
         self.connection = connection
+        self.binary = binary #rows of prepared statements are sent in the binary protocol
 
         self.fields = connection.reader.read_fields(field_count)
+        self.decoder = connection.reader.compile_fields(self.fields)
+        self.rows = None #the RowIterator returned by __iter__
+        self.started = False #whether reading rows has begun
+        self.streaming = None #the StreamingRows of iter_streaming
+        self.buffered = None #rows read into memory by _buffer_rows
 
         self.state = self.STATE_OPEN
 
+    def _get_state(self):
+        #the row iterator does not know about us, so we look whether it reached the end
+        if self._state == self.STATE_OPEN and self.rows is not None and self.rows.eof:
+            self._state = self.STATE_EOF
+        return self._state
+
+    def _set_state(self, state):
+        self._state = state
+
+    state = property(_get_state, _set_state)
+
+    def _get_started(self):
+        return self._started or (self.rows is not None and self.rows.started == 1)
+
+    def _set_started(self, started):
+        self._started = started
+
+    started = property(_get_started, _set_started)
+
     def __iter__(self):
+        if self.buffered is not None:
+            return iter(self.buffered)
+
         assert self.state == self.STATE_OPEN, "cannot iterate a resultset when it is not open"
 
-        for row in self.connection.reader.read_rows(self.fields):
+        if self.rows is None:
+            self.rows = self.connection.reader.read_rows(self.decoder, binary = self.binary)
+        return self.rows
+
+    def _buffer_rows(self):
+        """reads all rows into memory and releases the connection, so that it can read the next reply.
+        Iterating the resultset then returns the rows from memory"""
+        self.buffered = iter(self).read_all()
+        self.connection._close_current_resultset(self)
+
+    def iter_batches(self, row_count = 100):
+        """Iterates over the rows in lists of at most *row_count* rows"""
+        if self.buffered is not None:
+            rows = list(self.buffered)
+            for i in range(0, len(rows), row_count):
+                yield rows[i:i + row_count]
+            return
+
+        assert self.state == self.STATE_OPEN, "cannot iterate a resultset when it is not open"
+
+        self.started = True
+        for rows in self.connection.reader.read_row_batches(self.decoder, row_count, self.binary):
+            yield rows
+
+        self.state = self.STATE_EOF
+
+    def iter_streaming(self, columns):
+        """Iterates over the rows, returning the values of the given *columns* (names or indexes) as
+        file like :class:`mysql.BlobReader` objects that read straight from the connection, instead of strings.
+        Use this to pass on large BLOB values with constant memory use. The streamed columns must be the last
+        columns of the select, and must be read in order before the next row is fetched.
+        When the rows were read into memory already (e.g. a :class:`SharedResultSet`) the streamed values are
+        returned as :class:`mysql.BufferedBlobReader` objects over the decoded values, in that case the rows must
+        be tuples, dicts or namedtuples."""
+        if self.buffered is None:
+            assert self.state == self.STATE_OPEN and not self.started, "can only stream an open resultset that was not iterated"
+        if self.binary:
+            raise ClientProgrammingError("streaming columns is not supported for prepared statements")
+
+        names = [field[0] for field in self.fields]
+        indexes = set()
+        for column in columns:
+            if isinstance(column, basestring):
+                column = names.index(column)
+            indexes.add(column)
+        first_streamed = min(indexes)
+        if indexes != set(range(first_streamed, len(names))):
+            raise ClientProgrammingError("streamed columns must be the last columns of the select")
+
+        if self.buffered is not None:
+            encoding = self.connection.reader.reader.encoding or sys.getdefaultencoding()
+            for row in self.buffered:
+                if isinstance(row, dict):
+                    values = [row[name] for name in names]
+                else:
+                    values = list(row)
+                for i in range(first_streamed, len(values)):
+                    value = values[i]
+                    if isinstance(value, unicode):
+                        value = value.encode(encoding)
+                    elif value is not None and not isinstance(value, str):
+                        value = str(value)
+                    values[i] = BufferedBlobReader(value)
+                yield self.decoder.make_row(values)
+            return
+
+        self.started = True
+        self.streaming = self.connection.reader.read_streaming_rows(self.decoder, first_streamed)
+        for row in self.streaming:
             yield row
 
         self.state = self.STATE_EOF
 
+    def fetch_columns(self):
+        """Reads all rows of the resultset and returns them per column, as a tuple (columns, nulls).
+        INT and FLOAT/DOUBLE columns are returned as array.array of C longs or doubles, with a NULL bitmap
+        (an array.array('B'), bit i % 8 of byte i / 8 is set when row i is NULL) in nulls.
+        Other columns are returned as lists, with None as their bitmap. This can not be combined with iterating over the rows.
+        When the rows were read into memory already (e.g. a :class:`SharedResultSet`) the columns are built from those,
+        in that case the rows must be tuples, dicts or namedtuples."""
+        if self.buffered is not None:
+            builder = ColumnBuilder(self.decoder)
+            builder.add_rows(self.buffered)
+            return builder.get_columns()
+
+        assert self.state == self.STATE_OPEN and not self.started, "can only fetch columns of an open resultset that was not iterated"
+
+        self.started = True
+        columns = self.connection.reader.read_columns(self.decoder, binary = self.binary)
+
+        self.state = self.STATE_EOF
+        return columns
+
+    def discard(self, kill_after = -1):
+        """Reads the rest of the rows from the connection without decoding them, after this the resultset can be closed.
+        When more than *kill_after* bytes (default is the connections :attr:`discard_kill_after`, None never kills) were
+        skipped without reaching the end, the query is killed with :meth:`Connection.kill_query` to stop the server from
+        sending the rest of the rows."""
+        assert self.state == self.STATE_OPEN, "cannot discard a resultset when it is not open"
+
+        connection = self.connection
+        reader = connection.reader
+        if kill_after == -1:
+            kill_after = connection.discard_kill_after
+
+        if self.streaming is not None:
+            self.streaming.finish_row()
+
+        killed = False
+        if kill_after is not None and not reader.skip_rows(kill_after):
+            try:
+                connection.kill_query()
+                killed = True
+            except Exception:
+                #we can still read the rest of the rows
+                connection.log.exception("an error occurred while killing query")
+        reader.skip_rows()
+
+        self.state = self.STATE_EOF
+
+        if reader.reader.command == 0xff and not killed:
+            raise ClientCommandError.from_error_packet(reader.reader.packet, skip = 9)
+
     def close(self, connection_close = False):
         """Closes the current resultset. Make sure you have iterated over all rows before closing it!"""
         #print 'close on ResultSet', id(self.connection)
@@ -112,9 +264,162 @@ class ResultSet(object):
         connection = self.connection
         del self.connection
         del self.fields
-        connection._close_current_resultset(self)
+        del self.decoder
+        if self.buffered is None:
+            connection._close_current_resultset(self)
         self.state = self.STATE_CLOSED
 
+class SharedResultSet(ResultSet):
+    """A resultset returned to a greenlet that waited for the identical query of another greenlet,
+    see :class:`SingleFlight`. Its rows are in memory, in a tuple shared with the other greenlets"""
+
+    def __init__(self, connection, fields, decoder, rows):
+        self.state = self.STATE_INIT
+
+        self.connection = connection
+        self.binary = False
+        self.fields = fields
+        self.decoder = decoder
+        self.rows = None
+        self.started = False
+        self.streaming = None
+        self.buffered = rows
+
+        self.state = self.STATE_EOF
+
+#selects that are safe to share with other connections, no locking reads and nothing that depends on the session
+_shared_select = re.compile(r"\s*SELECT\b", re.IGNORECASE)
+_session_select = re.compile(r"FOR\s+UPDATE|FOR\s+SHARE|LOCK\s+IN\s+SHARE\s+MODE|NOWAIT|SKIP\s+LOCKED|SQL_CALC_FOUND_ROWS|"
+                             r"LAST_INSERT_ID|FOUND_ROWS|ROW_COUNT|CONNECTION_ID|GET_LOCK|RELEASE_LOCK|IS_FREE_LOCK|IS_USED_LOCK|"
+                             r"RAND\s*\(|UUID|SYSDATE|DATABASE\s*\(|@|;", re.IGNORECASE)
+
+#row factories of which the rows can be handed to several greenlets, see Connection.query
+_immutable_rows = (None, ROW_FACTORY.TUPLE, ROW_FACTORY.NAMEDTUPLE)
+
+def is_shared_select(cmd_text):
+    """whether the result of the query can be shared between connections by :class:`SingleFlight`"""
+    return bool(_shared_select.match(cmd_text)) and not _session_select.search(cmd_text)
+
+#the server reads the commands that follow LOAD DATA LOCAL INFILE as the contents of the file
+_local_infile_query = re.compile(r"LOAD\s+DATA\s+(?:(?:LOW_PRIORITY|CONCURRENT)\s+)?LOCAL\b", re.IGNORECASE)
+
+def is_long_data(arg):
+    """whether a statement argument is a file like object or an iterator, whose data is
+    streamed to the server in chunks instead of being sent with the statement"""
+    return hasattr(arg, 'read') or (hasattr(arg, 'next') and not isinstance(arg, basestring))
+
+class Pipeline(object):
+    """Queues commands that :meth:`run` sends to the server at once, without waiting for the reply of each
+    command before sending the next one. The replies are then read in order, so a pipeline of N commands costs
+    a single network round-trip instead of N. Create one with :meth:`Connection.pipeline`.
+    Keep pipelines to statements with small results, as the server does not read the next command before its
+    reply to the previous command was sent. LOAD DATA LOCAL INFILE can not be pipelined, the server would read the
+    commands after it as the contents of the file."""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.commands = [] #(cmd, cmd_text, read_result)
+
+    def __len__(self):
+        return len(self.commands)
+
+    def command(self, cmd, cmd_text):
+        """queues a COM_XXX command with the given text"""
+        assert type(cmd_text) == str #as opposed to unicode
+        if cmd == COMMAND.QUERY and _local_infile_query.search(cmd_text):
+            raise ClientProgrammingError("LOAD DATA LOCAL INFILE can not be pipelined")
+        self.commands.append((cmd, cmd_text, self.connection._read_result))
+
+    def query(self, cmd_text):
+        """queues a COM_QUERY command with the given text"""
+        self.command(COMMAND.QUERY, cmd_text)
+
+    def execute_statement(self, statement, args = ()):
+        """queues the execution of a prepared statement, file like and iterator arguments are not supported"""
+        assert statement.connection is self.connection, "statement was not prepared on this connection"
+        long_data = []
+        payload = self.connection._pack_execute(statement, args, long_data)
+        if long_data:
+            raise ClientProgrammingError("file like and iterator arguments can not be pipelined")
+        self.commands.append((COMMAND.STMT_EXECUTE, payload, self.connection._read_binary_result))
+
+    def run(self):
+        """Sends the queued commands and returns their results in order: a :class:`ResultSet`, of which
+        the rows were already read, or (affected rows, last row id). A command that fails has its
+        :exc:`ClientError` in its place in the list, the other commands are not affected by it.
+        A command with more than one result (multi statements, stored procedures) has a list of its results in its place."""
+        commands = self.commands
+        self.commands = []
+        return self.connection._run_pipeline(commands)
+
+class SingleFlight(object):
+    """Lets greenlets that send a select while the byte-identical select is being executed share its result,
+    instead of executing it again. Connections that were connected with the same SingleFlight (the *single_flight* argument of
+    :meth:`Connection.connect`) share their selects, so it should only be shared by connections to the same database with the
+    same charset, converters and row factory, e.g. those of a single pool. The greenlet that executes the select reads its rows
+    into memory and the waiting greenlets get a :class:`SharedResultSet` with the same rows, as a tuple.
+    Only selects of connections in autocommit mode, outside of a transaction, are shared by default, see :meth:`Connection.query`."""
+
+    def __init__(self):
+        self.flights = {} #cmd_text -> AsyncResult of the select being executed
+        self.executed = 0 #number of selects executed
+        self.shared = 0 #number of selects that waited for the result of another
+
+    def query(self, connection, cmd_text):
+        """executes the select on *connection*, or waits for the result of the identical select that is being executed"""
+        flight = self.flights.get(cmd_text)
+        if flight is not None:
+            self.shared += 1
+            fields, decoder, result = flight.get() #raises the error of the executing greenlet
+            if fields is None:
+                return result #not a resultset, e.g. select into outfile
+            return SharedResultSet(connection, fields, decoder, result)
+
+        flight = AsyncResult()
+        self.flights[cmd_text] = flight
+        self.executed += 1
+        try:
+            result = connection.command(COMMAND.QUERY, cmd_text)
+            if isinstance(result, ResultSet):
+                result._buffer_rows()
+                result.buffered = tuple(result.buffered)
+        except Exception, e:
+            del self.flights[cmd_text]
+            flight.set_exception(e)
+            raise
+        except:
+            #we were killed, the waiting greenlets must not get our GreenletExit
+            del self.flights[cmd_text]
+            flight.set_exception(ClientError("shared select was interrupted"))
+            raise
+        del self.flights[cmd_text]
+        if isinstance(result, ResultSet):
+            flight.set((result.fields, result.decoder, result.buffered))
+        else:
+            flight.set((None, None, result))
+        return result
+
+class PreparedStatement(object):
+    """Represents a statement prepared on the server with :meth:`Connection.prepare`.
+    The statement can be executed any number of times and must be closed when no longer needed."""
+
+    def __init__(self, connection, statement_id, params, fields):
+        self.connection = connection
+        self.statement_id = statement_id
+        self.params = params #field descriptions of the parameters
+        self.fields = fields #field descriptions of the result columns
+        self.param_count = len(params)
+
+    def execute(self, args = ()):
+        """Executes the statement with the given arguments and return a resultset (select) or (affected rows, last row id)"""
+        return self.connection.execute_statement(self, args)
+
+    def close(self):
+        """Deallocates the statement on the server"""
+        connection = self.connection
+        del self.connection
+        connection.close_statement(self)
+
 class Connection(object):
     """Represents a single connection to a MySQL Database host."""
     STATE_ERROR = -1
@@ -127,6 +432,14 @@ class Connection(object):
     def __init__(self):
         self.state = self.STATE_INIT
         self.buffer = Buffer(1024 * 16)
+        self.max_packet_size = 1024 * 1024 * 32 #max packet size we announce to the server
+        self.server_max_allowed_packet = None #max_allowed_packet of the server, read by get_max_allowed_packet
+        self.long_data_chunk_size = 1024 * 1024 #max size of the chunks in which file like statement arguments are sent
+        self.discard_kill_after = None #bytes ResultSet.discard skips before it kills the query, None never kills
+        self.thread_id = None #connection id on the server
+        self._kill_args = None #(addr, user, password) for the connection that sends KILL QUERY
+        self.local_infile_chunk_size = 1024 * 64 #size of the packets in which LOAD DATA LOCAL INFILE data is sent
+        self._local_infiles = {} #filename -> source, for answering LOAD DATA LOCAL INFILE
         self.socket = None
         self.reader = None
         self.writer = None
@@ -134,6 +447,16 @@ class Connection(object):
         self._command_time = -1
         self._incommand = False
         self.current_resultset = None
+        self.single_flight = None #the SingleFlight that shares selects with other connections
+        self.more_results = False #whether the server has more results for the last command (multi statements, stored procedures)
+        self.server_status = 0 #SERVER_STATUS flags of the last OK or EOF packet, tells whether we are in a transaction
+        self._binary_results = False #whether those results are in the binary protocol
+        self._compressed_stream = None
+        self.statement_cache_size = 0 #max nr of statements kept by prepare_cached, 0 is no caching
+        self._statement_cache = collections.OrderedDict() #cmd_text -> statement, least recently used first
+        self.statement_cache_hits = 0
+        self.statement_cache_misses = 0
+        self.statement_cache_evictions = 0
 
     def _scramble(self, password, seed):
         """taken from java jdbc driver, scrambles the password using the given seed
@@ -146,7 +469,7 @@ class Connection(object):
         #i love python :-):
         return ''.join(map(chr, [x ^ ord(stage1[i]) for i, x in enumerate(map(ord, md.digest()))]))
 
-    def _handshake(self, user, password, database, charset):
+    def _handshake(self, user, password, database, charset, compress = False, local_infile = False, multi_statements = False):
         """performs the mysql login handshake"""
 
         #init buffer for reading (both pos and lim = 0)
@@ -168,7 +491,7 @@ class Connection(object):
 
         self.server_version = packet.read_bytes_until(0)
 
-        packet.skip(4) #thread_id
+        self.thread_id = struct.unpack('<I', packet.read_bytes(4))[0]
         scramble_buff = packet.read_bytes(8)
         packet.skip(1) #filler
         server_caps = packet.read_short()
@@ -178,7 +501,7 @@ class Connection(object):
             assert False, "<4.1 auth not supported"
 
         server_language = packet.read_byte()
-        server_status = packet.read_short()
+        self.server_status = packet.read_short()
         packet.skip(13) #filler
         if packet.remaining:
             scramble_buff += packet.read_bytes_until(0)
@@ -187,9 +510,17 @@ class Connection(object):
 
         client_caps = server_caps
 
-        #always turn off compression
-        client_caps &= ~CAPS.COMPRESS
+        #only use compression when asked for (and the server supports it)
+        if not compress:
+            client_caps &= ~CAPS.COMPRESS
         client_caps &= ~CAPS.NO_SCHEMA
+        #only allow the server to ask for local files when asked for
+        if not local_infile:
+            client_caps &= ~CAPS.LOCAL_FILES
+        #only allow queries with multiple statements when asked for, multiple results
+        #(e.g. of stored procedures) are always accepted
+        if not multi_statements:
+            client_caps &= ~CAPS.MULTI_STATEMENTS
         #always turn off ssl
         client_caps &= ~CAPS.SSL
 
@@ -202,7 +533,7 @@ class Connection(object):
         self.writer.clear()
         self.writer.start()
         self.writer.write_int(client_caps)
-        self.writer.write_int(1024 * 1024 * 32) #16mb max packet
+        self.writer.write_int(self.max_packet_size)
         if charset:
             self.writer.write_byte(charset_map[charset.replace("-", "")])
         else:
@@ -231,9 +562,15 @@ class Connection(object):
         elif result == 0xfe:
             assert False, "old password handshake not implemented"
 
+        return client_caps
+
     def _close_current_resultset(self, resultset):
         assert resultset == self.current_resultset
         self.current_resultset = None
+        if self.reader.eof:
+            #the EOF packet after the rows tells whether another result follows
+            self.server_status = self.reader.server_status
+            self.more_results = bool(self.server_status & SERVER_STATUS.MORE_RESULTS_EXISTS)
 
     def _send_command(self, cmd, cmd_text):
         """sends a command with the given text"""
@@ -243,9 +580,9 @@ class Connection(object):
         #could not fit in buffer, causing flushes in write_string, in that case 'finish' would
         #not be able to go back to the header of the packet to write the length in that case
         self.writer.clear()
-        self.writer.write_header(len(cmd_text) + 1 + 4, 0) #1 is len of cmd, 4 is len of header, 0 is packet number
-        self.writer.write_byte(cmd)
-        self.writer.write_bytes(cmd_text)
+        if self._compressed_stream is not None:
+            self._compressed_stream.reset()
+        self.writer.write_command(cmd, cmd_text)
         self.writer.flush()
 
     def _close(self):
@@ -254,14 +591,27 @@ class Connection(object):
             self.state = self.STATE_CLOSING
             if self.current_resultset:
                 self.current_resultset.close(True)
+            self._statement_cache.clear() #statements die with the connection
             self.socket.close()
             self.state = self.STATE_CLOSED
         except:
             self.state = self.STATE_ERROR
             raise
 
-    def connect(self, host = "localhost", port = 3306, user = "", password = "", db = "", autocommit = None, charset = None, use_unicode=False):
-        """connects to the given host and port with user and password"""
+    def connect(self, host = "localhost", port = 3306, user = "", password = "", db = "", autocommit = None, charset = None, use_unicode=False,
+                statement_cache_size = 0, compress = False, min_compress_length = 50, converters = None, row_factory = None,
+                max_allowed_packet = None, local_infile = False, discard_kill_after = None, multi_statements = False,
+                single_flight = None):
+        """connects to the given host and port with user and password.
+        *converters* optionally maps FIELD_TYPE values, or (FIELD_TYPE, FIELD_FLAG) tuples, to callables
+        that are applied to the values of matching columns while the rows are read.
+        *row_factory* sets the type of the rows returned, see :meth:`set_row_factory`.
+        *max_allowed_packet* is the largest packet we announce to the server and accept from it.
+        *local_infile* enables LOAD DATA LOCAL INFILE, see :meth:`register_local_infile`.
+        *discard_kill_after* sets :attr:`discard_kill_after`, see :meth:`ResultSet.discard`.
+        *multi_statements* allows queries of several statements separated by ';', see :meth:`next_result`.
+        *single_flight* is a :class:`SingleFlight` that shares identical selects that are executed at the same time
+        with other connections, see :meth:`query`"""
         #self.log.debug("connect mysql client %s %s %s %s %s", id(self), host, port, user, password)
         try:
             #parse addresses of form str <host:port>
@@ -280,10 +630,25 @@ class Connection(object):
 
             self.state = self.STATE_CONNECTING
             self.socket = socket.create_connection(addr)          
+            if type(addr) == tuple:
+                #commands might be sent in more than one send call, don't let nagle delay the last part
+                self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             
+            self._kill_args = (addr, user, password)
+            self.discard_kill_after = discard_kill_after
+            self.single_flight = single_flight
+
             self.reader = BufferedPacketReader(self.socket, self.buffer)
+            if max_allowed_packet is not None:
+                self.max_packet_size = max_allowed_packet
+                self.reader.reader.max_packet_size = max_allowed_packet
             self.writer = BufferedPacketWriter(self.socket, self.buffer)
-            self._handshake(user, password, db, charset)
+            client_caps = self._handshake(user, password, db, charset, compress, local_infile, multi_statements)
+            if client_caps & CAPS.COMPRESS:
+                #from now on all packets are sent in compressed frames
+                self._compressed_stream = CompressedStream(self.socket, min_compress_length)
+                self.reader.stream = self._compressed_stream
+                self.writer.stream = self._compressed_stream
             #handshake complete client can now send commands
             self.state = self.STATE_CONNECTED
 
@@ -299,6 +664,12 @@ class Connection(object):
 
             self.set_use_unicode(use_unicode)
 
+            self.set_converters(converters)
+
+            self.set_row_factory(row_factory)
+
+            self.statement_cache_size = statement_cache_size
+
             return self
         except gevent.Timeout:
             self.state = self.STATE_INIT
@@ -316,58 +687,394 @@ class Connection(object):
         if self._incommand != False: assert False, "cannot close while still in a command"
         self._close()
 
-    def command(self, cmd, cmd_text):
-        """sends a COM_XXX command with the given text and possibly return a resultset (select)"""
-        #print 'command', cmd, repr(cmd_text), type(cmd_text)
+    def _read_result(self, packet, binary = False):
+        """reads the reply to a command, expect 1 of OK, ERROR or result set header"""
+        result = packet.read_byte()
+        #print 'res', result
+        self.more_results = False
+        self._binary_results = binary
+        if result == 0x00:
+            #OK, return (affected rows, last row id)
+            rowcount = self.reader.read_length_coded_binary()
+            lastrowid = self.reader.read_length_coded_binary()
+            if packet.remaining >= 2:
+                self.server_status = packet.read_short()
+                self.more_results = bool(self.server_status & SERVER_STATUS.MORE_RESULTS_EXISTS)
+            return (rowcount, lastrowid)
+        elif result == 0xff:
+            #an error ends the results, the statements after it are not executed
+            raise ClientCommandError.from_error_packet(packet)
+        elif result == 0xfb:
+            #LOAD DATA LOCAL INFILE, the server asks for the contents of the file
+            return self._send_local_infile(packet.read_bytes(packet.remaining), binary)
+        else: #result set
+            self.current_resultset = ResultSet(self, result, binary)
+            return self.current_resultset
+
+    def _local_infile_chunks(self, source):
+        """yields the data of a local infile source in chunks of about :attr:`local_infile_chunk_size` bytes"""
+        chunk_size = self.local_infile_chunk_size
+        if isinstance(source, basestring):
+            f = open(source, 'rb')
+            try:
+                for chunk in iter(lambda: f.read(chunk_size), ''):
+                    yield chunk
+            finally:
+                f.close()
+        elif hasattr(source, 'read'):
+            for chunk in iter(lambda: source.read(chunk_size), ''):
+                yield chunk
+        else:
+            #rows, which are formatted as lines of tab separated values
+            encoding = self.reader.reader.encoding or sys.getdefaultencoding()
+            lines = []
+            size = 0
+            for row in source:
+                line = pack_tsv_row(row, encoding)
+                lines.append(line)
+                size += len(line)
+                if size >= chunk_size:
+                    yield ''.join(lines)
+                    lines = []
+                    size = 0
+            if lines:
+                yield ''.join(lines)
+
+    def _send_local_infile(self, filename, binary = False):
+        """sends the contents of the registered local infile as packets continuing the sequence of the request,
+        terminated by an empty packet, and reads the result of the LOAD DATA"""
+        source = self._local_infiles.pop(filename, None)
+        writer = self.writer
+        writer.clear()
+        number = self.reader.reader.number + 1
+        error = None
+        if source is None:
+            error = ClientProgrammingError("local infile %r was not registered" % filename)
+        else:
+            try:
+                for chunk in self._local_infile_chunks(source):
+                    if type(chunk) == unicode:
+                        chunk = chunk.encode(self.reader.reader.encoding or sys.getdefaultencoding())
+                    offset = 0
+                    while offset < len(chunk):
+                        length = min(len(chunk) - offset, MAX_PAYLOAD_LENGTH - 1)
+                        if writer.buffer.remaining < 4:
+                            writer.flush()
+                        writer.write_header(length + 4, number & 0xFF)
+                        writer.write_bytes(chunk, offset, length)
+                        offset += length
+                        number += 1
+            except socket.error:
+                raise
+            except Exception, e:
+                #end the file early so that the connection stays usable, and raise afterwards
+                error = e
+        #an empty packet marks the end of the file
+        if writer.buffer.remaining < 4:
+            writer.flush()
+        writer.write_header(4, number & 0xFF)
+        writer.flush()
+        self.buffer.flip()
+        result = self._read_result(self.reader.read_packet(), binary)
+        if error is not None:
+            raise error
+        return result
+
+    def register_local_infile(self, filename, source):
+        """Registers the data the client sends when the server asks for *filename* in a
+        ``LOAD DATA LOCAL INFILE 'filename'`` statement. *source* is a path of a local file, a file like object,
+        or an iterable of rows (sequences of values), which are sent as tab separated lines in the default format
+        of LOAD DATA. A registration is used only once. The connection must be connected with local_infile = True"""
+        self._local_infiles[filename] = source
+
+    def _read_binary_result(self, packet):
+        return self._read_result(packet, True)
+
+    def _read_prepare_result(self, packet):
+        """reads the reply to a COM_STMT_PREPARE, expect 1 of ERROR or PREPARE_OK followed by the
+        parameter and column definitions"""
+        result = packet.read_byte()
+        if result == 0xff:
+            raise ClientCommandError.from_error_packet(packet)
+        statement_id, field_count, param_count = struct.unpack('<IHH', packet.read_bytes(8))
+        params, fields = [], []
+        if param_count:
+            params = self.reader.read_fields(param_count)
+        if field_count:
+            fields = self.reader.read_fields(field_count)
+        return PreparedStatement(self, statement_id, params, fields)
+
+    def _command(self, cmd, cmd_text, read_result, send_first = None):
+        """sends the command and reads its reply with *read_result*. *send_first* is called
+        before the command is sent, for commands that are preceded by commands without a reply"""
         assert type(cmd_text) == str #as opposed to unicode
         assert self.is_connected(), "make sure connection is connected before query"
         if self._incommand != False: assert False, "overlapped commands not supported"
         if self.current_resultset: assert False, "overlapped commands not supported, pls read prev resultset and close it"
+        if self.more_results:
+            self._skip_results()
         try:
             self._incommand = True
             if self._time_command:
                 start_time = time.time()
+            if send_first is not None:
+                send_first()
             self._send_command(cmd, cmd_text)
-            #read result, expect 1 of OK, ERROR or result set header
             self.buffer.flip()
             packet = self.reader.read_packet()
-            result = packet.read_byte()
-            #print 'res', result
             if self._time_command:
                 end_time = time.time()
                 self._command_time = end_time - start_time
-            if result == 0x00:
-                #OK, return (affected rows, last row id)
-                rowcount = self.reader.read_length_coded_binary()
-                lastrowid = self.reader.read_length_coded_binary()
-                return (rowcount, lastrowid)
-            elif result == 0xff:
-                raise ClientCommandError.from_error_packet(packet)
-            else: #result set
-                self.current_resultset = ResultSet(self, result)
-                return self.current_resultset
+            return read_result(packet)
 
         except socket.error, e:
-            (errorcode, errorstring) = e
+            self._socket_error(e)
+            raise
+        finally:
+            self._incommand = False
+
+    def _socket_error(self, e):
+        """closes the connection when the socket error means it was lost"""
+        (errorcode, errorstring) = e
+
+        if errorcode in [errno.ECONNABORTED, errno.ECONNREFUSED, errno.ECONNRESET, errno.EPIPE]:
+            self._incommand = False
+            self.close()
 
-            if errorcode in [errno.ECONNABORTED, errno.ECONNREFUSED, errno.ECONNRESET, errno.EPIPE]:
+        if sys.platform == "win32":
+            if errorcode in [errno.WSAECONNABORTED]:
                 self._incommand = False
                 self.close()
 
-            if sys.platform == "win32":
-                if errorcode in [errno.WSAECONNABORTED]:
-                    self._incommand = False
-                    self.close()
+    def _run_pipeline(self, commands):
+        """sends all *commands* (cmd, cmd_text, read_result) before reading any reply, then reads the replies in order"""
+        assert self.is_connected(), "make sure connection is connected before query"
+        if self._incommand != False: assert False, "overlapped commands not supported"
+        if self.current_resultset: assert False, "overlapped commands not supported, pls read prev resultset and close it"
+        if self.more_results:
+            self._skip_results()
+        try:
+            self._incommand = True
+            if self._time_command:
+                start_time = time.time()
+            self.writer.clear()
+            for cmd, cmd_text, _ in commands:
+                if self._compressed_stream is not None:
+                    #every command starts its own sequence of compressed frames
+                    self._send_command(cmd, cmd_text)
+                else:
+                    #collect the commands in the buffer, it is flushed when it is full
+                    self.writer.write_command(cmd, cmd_text)
+            if self._compressed_stream is None:
+                self.writer.flush()
+            self.buffer.flip()
+
+            results = []
+            for _, _, read_result in commands:
+                results.append(self._read_reply(read_result))
+            if self._time_command:
+                self._command_time = time.time() - start_time
+            return results
 
+        except socket.error, e:
+            self._socket_error(e)
             raise
         finally:
             self._incommand = False
 
+    def next_result(self):
+        """Reads the next result of a query with multiple statements or of a stored procedure call: a :class:`ResultSet`
+        or (affected rows, last row id). Returns None when there are no more results (see :attr:`more_results`).
+        The previous resultset must be read entirely (or discarded) and closed first."""
+        assert self.is_connected(), "make sure connection is connected before reading results"
+        if self._incommand != False: assert False, "overlapped commands not supported"
+        if self.current_resultset: assert False, "pls read prev resultset and close it before reading the next result"
+        if not self.more_results:
+            return None
+        try:
+            self._incommand = True
+            return self._read_result(self.reader.read_packet(), self._binary_results)
+        except socket.error, e:
+            self._socket_error(e)
+            raise
+        finally:
+            self._incommand = False
+
+    def _skip_results(self):
+        """reads and throws away the results that are left of the previous command"""
+        while self.more_results:
+            try:
+                result = self.next_result()
+            except ClientCommandError:
+                continue #belongs to the previous command, ends the results
+            if isinstance(result, ResultSet):
+                result.discard(None)
+                result.close()
+
+    def command(self, cmd, cmd_text):
+        """sends a COM_XXX command with the given text and possibly return a resultset (select)"""
+        #print 'command', cmd, repr(cmd_text), type(cmd_text)
+        return self._command(cmd, cmd_text, self._read_result)
+
+    def _read_reply(self, read_result):
+        """reads the reply to a command that was sent without waiting for the replies of the commands before it.
+        The rows of resultsets are read into memory, so that the next reply can be read, and errors are returned
+        instead of raised. A command with more than one result returns a list of them"""
+        replies = []
+        while True:
+            try:
+                result = read_result(self.reader.read_packet())
+            except ClientError, e:
+                result = e
+            if isinstance(result, ResultSet):
+                result._buffer_rows()
+            replies.append(result)
+            if not self.more_results:
+                break
+        if len(replies) == 1:
+            return replies[0]
+        else:
+            return replies
+
+    def pipeline(self):
+        """Returns a new :class:`Pipeline` for sending several commands in one round-trip"""
+        return Pipeline(self)
+
+    def prepare(self, cmd_text):
+        """Prepares the given statement on the server (COM_STMT_PREPARE) and returns a :class:`PreparedStatement`"""
+        return self._command(COMMAND.STMT_PREPARE, cmd_text, self._read_prepare_result)
+
+    def prepare_cached(self, cmd_text):
+        """Like :meth:`prepare`, but keeps up to :attr:`statement_cache_size` statements prepared
+        on the server. When the cache is full, the least recently used statement is closed."""
+        cache = self._statement_cache
+        statement = cache.pop(cmd_text, None)
+        if statement is not None:
+            #reinserting moves it to the most recently used end
+            self.statement_cache_hits += 1
+            cache[cmd_text] = statement
+            return statement
+
+        self.statement_cache_misses += 1
+        if len(cache) >= self.statement_cache_size:
+            _, lru = cache.popitem(last = False)
+            self.close_statement(lru)
+            self.statement_cache_evictions += 1
+        statement = self.prepare(cmd_text)
+        cache[cmd_text] = statement
+        return statement
+
+    def _pack_execute(self, statement, args, long_data):
+        """builds the payload of a COM_STMT_EXECUTE for the given statement and arguments. File like
+        and iterator arguments are not included, but appended to *long_data* as (param_id, arg)"""
+        args = tuple(args)
+        if len(args) != statement.param_count:
+            raise ClientProgrammingError("statement takes %d arguments, got %d" % (statement.param_count, len(args)))
+        data = [struct.pack('<IBI', statement.statement_id, 0, 1)] #no cursor, 1 iteration
+        if args:
+            encoding = self.reader.reader.encoding or sys.getdefaultencoding()
+            null_bitmap = [0] * ((len(args) + 7) / 8)
+            types = []
+            values = []
+            for i, arg in enumerate(args):
+                if arg is None:
+                    null_bitmap[i / 8] |= 1 << (i % 8)
+                    types.append(chr(FIELD_TYPE._NULL) + '\0')
+                elif is_long_data(arg):
+                    #the value is sent before the execute with COM_STMT_SEND_LONG_DATA
+                    types.append(chr(FIELD_TYPE.BLOB) + '\0')
+                    long_data.append((i, arg))
+                else:
+                    field_type, unsigned, value = pack_binary_value(arg, encoding)
+                    types.append(chr(field_type) + chr(unsigned))
+                    values.append(value)
+            data.append(''.join(map(chr, null_bitmap)))
+            data.append('\1') #new params bound
+            data.extend(types)
+            data.extend(values)
+        return ''.join(data)
+
+    def execute_statement(self, statement, args = ()):
+        """Executes a prepared statement (COM_STMT_EXECUTE) and possibly return a resultset (select).
+        The rows of the resultset are decoded from the binary protocol"""
+        assert statement.connection is self, "statement was not prepared on this connection"
+        long_data = []
+        payload = self._pack_execute(statement, args, long_data)
+        if long_data:
+            send_first = lambda: self._send_long_data(statement, long_data)
+        else:
+            send_first = None
+        return self._command(COMMAND.STMT_EXECUTE, payload, self._read_binary_result, send_first)
+
+    def _send_long_data(self, statement, long_data):
+        """streams the values of file like or iterator arguments to the server in chunks of at most
+        :attr:`long_data_chunk_size` bytes (COM_STMT_SEND_LONG_DATA), the server sends no reply"""
+        encoding = self.reader.reader.encoding or sys.getdefaultencoding()
+        chunk_size = self.long_data_chunk_size
+        for param_id, arg in long_data:
+            if hasattr(arg, 'read'):
+                chunks = iter(lambda: arg.read(chunk_size), '')
+            else:
+                chunks = arg
+            for chunk in chunks:
+                if type(chunk) == unicode:
+                    chunk = chunk.encode(encoding)
+                offset = 0
+                while offset < len(chunk):
+                    length = min(len(chunk) - offset, chunk_size)
+                    writer = self.writer
+                    writer.clear()
+                    if self._compressed_stream is not None:
+                        self._compressed_stream.reset()
+                    writer.write_header(length + 1 + 6 + 4, 0) #command, statement id and param id, header
+                    writer.write_byte(COMMAND.STMT_SEND_LONG_DATA)
+                    writer.write_bytes(struct.pack('<IH', statement.statement_id, param_id))
+                    writer.write_bytes(chunk, offset, length)
+                    writer.flush()
+                    offset += length
+
+    def close_statement(self, statement):
+        """Deallocates a prepared statement on the server (COM_STMT_CLOSE), the server sends no reply"""
+        assert self.is_connected(), "make sure connection is connected before closing a statement"
+        if self._incommand != False: assert False, "overlapped commands not supported"
+        if self.current_resultset: assert False, "overlapped commands not supported, pls read prev resultset and close it"
+        self._send_command(COMMAND.STMT_CLOSE, struct.pack('<I', statement.statement_id))
+
+    def kill_query(self):
+        """Interrupts the statement this connection is executing, by sending KILL QUERY from a separate connection.
+        The server then ends the rows of the resultset being read with an error"""
+        addr, user, password = self._kill_args
+        if type(addr) == tuple:
+            host, port = addr
+        else:
+            host, port = addr, 3306
+        side = Connection()
+        side.connect(host, port, user, password)
+        try:
+            side.query("KILL QUERY %d" % self.thread_id)
+        finally:
+            side.close()
+
     def is_connected(self):
         return self.state == self.STATE_CONNECTED
 
-    def query(self, cmd_text):
-        """Sends a COM_QUERY command with the given text and return a resultset (select)"""
+    def in_autocommit(self):
+        """whether the server reported autocommit mode and no open transaction in its last status"""
+        return bool(self.server_status & SERVER_STATUS.AUTOCOMMIT) and not self.server_status & SERVER_STATUS.IN_TRANS
+
+    def query(self, cmd_text, shared = None):
+        """Sends a COM_QUERY command with the given text and return a resultset (select).
+        If the connection has a :attr:`single_flight`, a select that another connection is executing already
+        waits for that result instead. By default (*shared* is None) selects are only shared while the connection is
+        in autocommit mode outside of a transaction (see :meth:`in_autocommit`), as the result of another connection
+        might not match the snapshot of our transaction. *shared* True shares them anyway, False never shares them.
+        Selects are never shared when the row factory of the connection creates mutable rows (dicts or custom objects),
+        as the greenlets that share a result get the same row objects"""
+        if shared is None:
+            shared = self.in_autocommit()
+        if (shared and self.single_flight is not None and self.reader.reader.row_factory in _immutable_rows
+                and is_shared_select(cmd_text)):
+            return self.single_flight.query(self, cmd_text)
         return self.command(COMMAND.QUERY, cmd_text)
 
     def init_db(self, cmd_text):
@@ -393,12 +1100,40 @@ class Connection(object):
     def set_use_unicode(self, use_unicode):
         self.reader.reader.use_unicode = use_unicode
 
+    def set_converters(self, converters):
+        self.reader.reader.converters = converters
+
+    def set_row_factory(self, row_factory):
+        """Sets the type of the rows returned by the resultsets of this connection: ROW_FACTORY.TUPLE (the default),
+        ROW_FACTORY.DICT, ROW_FACTORY.NAMEDTUPLE or a callable that is called with the field descriptions and the row tuple"""
+        self.reader.reader.row_factory = row_factory
+
     def set_time_command(self, time_command):
         self._time_command = time_command
 
     def get_command_time(self):
         return self._command_time
 
+    def get_max_allowed_packet(self):
+        """Returns the size of the largest packet that both we and the server accept: the smaller of
+        :attr:`max_packet_size` and the servers max_allowed_packet, which is read once per connection"""
+        if self.server_max_allowed_packet is None:
+            #not through query, which might share it, and decoded to a plain tuple whatever
+            #the row factory and converters of the connection are
+            rs = self.command(COMMAND.QUERY, "SELECT @@max_allowed_packet")
+            rs.decoder = RowDecoder(rs.fields, None, False)
+            rows = list(rs)
+            rs.close()
+            self.server_max_allowed_packet = int(rows[0][0])
+        return min(self.max_packet_size, self.server_max_allowed_packet)
+
+    def get_statement_cache_stats(self):
+        """returns a dict with the size, hits, misses and evictions of the prepared statement cache"""
+        return {'size': len(self._statement_cache),
+                'hits': self.statement_cache_hits,
+                'misses': self.statement_cache_misses,
+                'evictions': self.statement_cache_evictions}
+
 Connection.log = logging.getLogger(Connection.__name__)
 
 def connect(*args, **kwargs):
@@ -9,23 +9,46 @@ base aynchronous mysql io library
 
 
 import datetime
+import decimal
+import collections
+import array
 import types
 import sys
 
 cdef extern from "string.h":
     cdef void *memmove(void *, void *, int)
+    cdef void *memset(void *, int, int)
     cdef void *memcpy(void *, void *, int)
     cdef void *memchr(void *, int, int)
      
 cdef extern from "stdlib.h":
     cdef void *calloc(int, int)
+    cdef void *malloc(int)
+    cdef void *realloc(void *, int)
     cdef void free(void *)    
+    cdef double strtod(char *, char **)
 
+cdef extern from "limits.h":
+    cdef long LONG_MAX
+    cdef unsigned long ULONG_MAX
+
+cdef extern from "zlib.h":
+    cdef int Z_OK
+    cdef int uncompress(unsigned char *, unsigned long *, unsigned char *, unsigned long)
+
+cdef extern from "stdio.h":
+    cdef int snprintf(char *, int, char *, ...)
 
 cdef extern from "Python.h":
     object PyString_FromStringAndSize(char *, int)
     object PyString_FromString(char *)
     int PyString_AsStringAndSize(object obj, char **s, Py_ssize_t *len) except -1
+    object PyUnicode_Decode(char *s, Py_ssize_t size, char *encoding, char *errors)
+    int PyString_CheckExact(object)
+    int PyUnicode_CheckExact(object)
+    int PyInt_Check(object)
+    int PyLong_Check(object)
+    int PyFloat_Check(object)
 
 
 cdef enum:
@@ -34,6 +57,10 @@ cdef enum:
     COMMAND_INIT_DB = 2
     COMMAND_QUERY = 3
     COMMAND_LIST = 4
+    COMMAND_STMT_PREPARE = 0x16
+    COMMAND_STMT_EXECUTE = 0x17
+    COMMAND_STMT_SEND_LONG_DATA = 0x18
+    COMMAND_STMT_CLOSE = 0x19
 
 class COMMAND:
     SLEEP = COMMAND_SLEEP
@@ -41,6 +68,10 @@ class COMMAND:
     INIT_DB = COMMAND_INIT_DB
     QUERY = COMMAND_QUERY
     LIST = COMMAND_LIST    
+    STMT_PREPARE = COMMAND_STMT_PREPARE
+    STMT_EXECUTE = COMMAND_STMT_EXECUTE
+    STMT_SEND_LONG_DATA = COMMAND_STMT_SEND_LONG_DATA
+    STMT_CLOSE = COMMAND_STMT_CLOSE
     
 cdef enum:
     PACKET_READ_NONE =  0
@@ -118,6 +149,34 @@ class FIELD_TYPE:
     STRING = FIELD_TYPE_STRING
     GEOMETRY = FIELD_TYPE_GEOMETRY
 
+cdef enum:
+    FIELD_FLAG_NOT_NULL = 1
+    FIELD_FLAG_PRI_KEY = 2
+    FIELD_FLAG_UNIQUE_KEY = 4
+    FIELD_FLAG_MULTIPLE_KEY = 8
+    FIELD_FLAG_BLOB = 16
+    FIELD_FLAG_UNSIGNED = 32
+    FIELD_FLAG_ZEROFILL = 64
+    FIELD_FLAG_BINARY = 128
+    FIELD_FLAG_ENUM = 256
+    FIELD_FLAG_AUTO_INCREMENT = 512
+    FIELD_FLAG_TIMESTAMP = 1024
+    FIELD_FLAG_SET = 2048
+
+class FIELD_FLAG:
+    NOT_NULL = FIELD_FLAG_NOT_NULL
+    PRI_KEY = FIELD_FLAG_PRI_KEY
+    UNIQUE_KEY = FIELD_FLAG_UNIQUE_KEY
+    MULTIPLE_KEY = FIELD_FLAG_MULTIPLE_KEY
+    BLOB = FIELD_FLAG_BLOB
+    UNSIGNED = FIELD_FLAG_UNSIGNED
+    ZEROFILL = FIELD_FLAG_ZEROFILL
+    BINARY = FIELD_FLAG_BINARY
+    ENUM = FIELD_FLAG_ENUM
+    AUTO_INCREMENT = FIELD_FLAG_AUTO_INCREMENT
+    TIMESTAMP = FIELD_FLAG_TIMESTAMP
+    SET = FIELD_FLAG_SET
+
 
 INT_TYPES = set([FIELD_TYPE.TINY, FIELD_TYPE.SHORT, FIELD_TYPE.LONG, FIELD_TYPE.LONGLONG, FIELD_TYPE.INT24])
 FLOAT_TYPES = set([FIELD_TYPE.FLOAT, FIELD_TYPE.DOUBLE])
@@ -125,11 +184,11 @@ BLOB_TYPES = set([FIELD_TYPE.TINY_BLOB, FIELD_TYPE.MEDIUM_BLOB, FIELD_TYPE.LONG_
 STRING_TYPES = set([FIELD_TYPE.VARCHAR, FIELD_TYPE.VAR_STRING, FIELD_TYPE.STRING])
 DATE_TYPES = set([FIELD_TYPE.TIMESTAMP, FIELD_TYPE.DATE, FIELD_TYPE.TIME, FIELD_TYPE.DATETIME, FIELD_TYPE.YEAR, FIELD_TYPE.NEWDATE])
 
-# Not handled:
-# 0x00 FIELD_TYPE_DECIMAL
+DECIMAL_TYPES = set([FIELD_TYPE.DECIMAL, FIELD_TYPE.NEWDECIMAL])
+
+# Returned as is (ENUM and SET columns are sent as FIELD_TYPE_STRING with a flag),
+# register a converter to change that:
 # 0x06 FIELD_TYPE_NULL
-# 0x10 FIELD_TYPE_BIT
-# 0xf6 FIELD_TYPE_NEWDECIMAL
 # 0xf7 FIELD_TYPE_ENUM
 # 0xf8 FIELD_TYPE_SET
 # 0xff FIELD_TYPE_GEOMETRY
@@ -232,6 +291,88 @@ for i in range(192, 211):
 
 
 
+#escaping as done by mysql_real_escape_string
+_unicode_escapes = {0: u'\\0', 10: u'\\n', 13: u'\\r', 92: u'\\\\', 39: u"\\'", 34: u'\\"', 26: u'\\Z'}
+
+cdef object _escape_bytes(object s, int quote):
+    """escapes the str s, optionally surrounding the result with single quotes"""
+    cdef char *src, *buff
+    cdef Py_ssize_t n, i, j
+    cdef unsigned char c, e
+
+    PyString_AsStringAndSize(s, &src, &n)
+    buff = <char *>malloc(2 * n + 2) #worst case every char is escaped
+    if buff == NULL:
+        raise MemoryError()
+    try:
+        j = 0
+        if quote:
+            buff[j] = 39
+            j = j + 1
+        i = 0
+        while i < n:
+            c = src[i]
+            if c == 0: e = 48 #0
+            elif c == 10: e = 110 #n
+            elif c == 13: e = 114 #r
+            elif c == 92 or c == 39 or c == 34: e = c
+            elif c == 26: e = 90 #Z
+            else: e = 0
+            if e:
+                buff[j] = 92
+                buff[j + 1] = e
+                j = j + 2
+            else:
+                buff[j] = c
+                j = j + 1
+            i = i + 1
+        if quote:
+            buff[j] = 39
+            j = j + 1
+        return PyString_FromStringAndSize(buff, j)
+    finally:
+        free(buff)
+
+def escape_string(s):
+    """Escapes the special characters in the str or unicode *s* so that it can be used in a SQL string literal."""
+    if PyUnicode_CheckExact(s):
+        return s.translate(_unicode_escapes)
+    else:
+        return _escape_bytes(s, 0)
+
+cdef object _encode_arg(object arg, object charset):
+    cdef char buff[32]
+    cdef int n
+    if PyString_CheckExact(arg):
+        return _escape_bytes(arg, 1)
+    elif PyUnicode_CheckExact(arg):
+        return "'%s'" % arg.translate(_unicode_escapes).encode(charset)
+    elif PyInt_Check(arg) or PyLong_Check(arg) or PyFloat_Check(arg):
+        return str(arg)
+    elif arg is None:
+        return 'null'
+    elif isinstance(arg, datetime.datetime):
+        n = snprintf(buff, 32, "'%04d-%02d-%02d %02d:%02d:%02d'", <int>arg.year, <int>arg.month, <int>arg.day,
+                     <int>arg.hour, <int>arg.minute, <int>arg.second)
+        return PyString_FromStringAndSize(buff, n)
+    elif isinstance(arg, datetime.date):
+        n = snprintf(buff, 32, "'%04d-%02d-%02d'", <int>arg.year, <int>arg.month, <int>arg.day)
+        return PyString_FromStringAndSize(buff, n)
+    elif isinstance(arg, decimal.Decimal):
+        return str(arg)
+    else:
+        assert False, "unknown argument type: %s %s" % (type(arg), repr(arg))
+
+def encode_args(object args, object charset):
+    """Encodes the query arguments *args* into a tuple of SQL literals, ready to be
+    substituted in a query with the % operator. unicode arguments are encoded with *charset*."""
+    params = []
+    add = params.append
+    for arg in args:
+        add(_encode_arg(arg, charset))
+    return tuple(params)
+
+
 class BufferError(Exception):
     pass
 
@@ -261,6 +402,7 @@ cdef class Buffer:
     cdef Buffer _parent
     cdef int _capacity
     cdef int _limit
+    cdef Py_ssize_t _view_len #shape of the last exported buffer view
     
     def __cinit__(self, int capacity, Buffer parent = None):
         if parent is not None: 
@@ -314,6 +456,21 @@ cdef class Buffer:
             raise BufferInvalidArgumentError("dst start + length must <= dst capacity")
         #now we can safely copy!
         memcpy(self._buff + dst_start, src._buff + src_start, length)        
+
+    def uncompress(self, Buffer src, int src_start, int length, int dst_start, int uncompressed_length):
+        """Decompresses (zlib) *length* bytes from buffer *src*, starting at position *src_start*, into this
+        buffer at position *dst_start*. The data must decompress to exactly *uncompressed_length* bytes.
+        Like :meth:`copy`, this does not change the position or limit of either buffer."""
+        cdef unsigned long n
+        if length < 0 or uncompressed_length < 0:
+            raise BufferInvalidArgumentError("length must be >= 0")
+        if src_start < 0 or src_start + length > src._capacity:
+            raise BufferInvalidArgumentError("src start + length must <= src capacity")
+        if dst_start < 0 or dst_start + uncompressed_length > self._capacity:
+            raise BufferInvalidArgumentError("dst start + uncompressed length must <= dst capacity")
+        n = uncompressed_length
+        if uncompress(self._buff + dst_start, &n, src._buff + src_start, length) != Z_OK or n != uncompressed_length:
+            raise BufferError("could not uncompress data")
         
     def clear(self):
         """Prepares the buffer for relative read operations. The buffers :attr:`limit` will set to the buffers :attr:`capacity` and
@@ -426,6 +583,40 @@ cdef class Buffer:
         if b > 0: self._position = self._position + b
         return b, self._limit - self._position
         
+    #the buffer protocol exposes the bytes between position and limit, this allows
+    #socket.recv_into to write directly into the free part of the buffer, without a
+    #temporary string. The buffer's position is not updated, the caller must skip the received bytes.
+    def __getbuffer__(self, Py_buffer *info, int flags):
+        self._view_len = self._limit - self._position
+        info.buf = <void *>(self._buff + self._position)
+        info.len = self._view_len
+        info.readonly = 0
+        info.itemsize = 1
+        info.format = NULL #unsigned bytes
+        info.ndim = 1
+        info.shape = &self._view_len
+        info.strides = NULL
+        info.suboffsets = NULL
+        info.internal = NULL
+        info.obj = self
+
+    def __releasebuffer__(self, Py_buffer *info):
+        pass
+
+    #old style buffer protocol (python < 2.7)
+    def __getsegcount__(self, Py_ssize_t *lenp):
+        if lenp != NULL:
+            lenp[0] = self._limit - self._position
+        return 1
+
+    def __getreadbuffer__(self, Py_ssize_t i, void **p):
+        p[0] = <void *>(self._buff + self._position)
+        return self._limit - self._position
+
+    def __getwritebuffer__(self, Py_ssize_t i, void **p):
+        p[0] = <void *>(self._buff + self._position)
+        return self._limit - self._position
+
     def compact(self):
         """Prepares the buffer again for relative reading, but any left over data still present in the buffer (the bytes between
         the current :attr:`position` and current :attr:`limit`) will be copied to the start of the buffer. The position of the buffer
@@ -650,7 +841,547 @@ cdef class Buffer:
 class PacketReadError(Exception):
     pass
 
-MAX_PACKET_SIZE = 4 * 1024 * 1024 #4mb
+cdef enum:
+    CONVERT_BYTES = 0
+    CONVERT_INT = 1
+    CONVERT_FLOAT = 2
+    CONVERT_STRING = 3
+    CONVERT_DATE = 4
+    CONVERT_DATETIME = 5
+    CONVERT_TIME = 6
+    CONVERT_DECIMAL = 7
+    CONVERT_BIT = 8
+
+cdef int _parse_digits(unsigned char *p, int n):
+    """parses n decimal digits at p, returns -1 if there is anything else"""
+    cdef int i, v
+    v = 0
+    i = 0
+    while i < n:
+        if p[i] < c'0' or p[i] > c'9':
+            return -1
+        v = v * 10 + (p[i] - c'0')
+        i = i + 1
+    return v
+
+cdef int _parse_fraction(unsigned char *p, int n):
+    """parses the fractional seconds ('.' followed by 1 to 6 digits) at p into microseconds, returns -1 if malformed"""
+    cdef int v
+    if n == 0:
+        return 0
+    if n < 2 or n > 7 or p[0] != c'.':
+        return -1
+    v = _parse_digits(p + 1, n - 1)
+    if v == -1:
+        return -1
+    n = n - 1
+    while n < 6:
+        v = v * 10
+        n = n + 1
+    return v
+
+cdef _parse_date(unsigned char *p, int n, int t):
+    """parses a text protocol DATE ('YYYY-MM-DD') or DATETIME/TIMESTAMP ('YYYY-MM-DD HH:MM:SS[.ffffff]').
+    zero dates and empty values are returned as None"""
+    cdef int year, month, day, hour, minute, second, microsecond
+
+    if n == 0:
+        return None
+    year = month = day = -1
+    if n >= 10 and p[4] == c'-' and p[7] == c'-':
+        year = _parse_digits(p, 4)
+        month = _parse_digits(p + 5, 2)
+        day = _parse_digits(p + 8, 2)
+    if year == -1 or month == -1 or day == -1:
+        raise ValueError("Unhandled date format: %r" % PyString_FromStringAndSize(<char *>p, n))
+
+    if t == FIELD_TYPE_DATE or t == FIELD_TYPE_NEWDATE:
+        if n != 10:
+            raise ValueError("Unhandled date format: %r" % PyString_FromStringAndSize(<char *>p, n))
+        if year == 0 and month == 0 and day == 0:
+            return None
+        try:
+            return datetime.date(year, month, day)
+        except ValueError:
+            raise ValueError("Unhandled date format: %r" % PyString_FromStringAndSize(<char *>p, n))
+
+    hour = minute = second = microsecond = -1
+    if n >= 19 and p[10] == c' ' and p[13] == c':' and p[16] == c':':
+        hour = _parse_digits(p + 11, 2)
+        minute = _parse_digits(p + 14, 2)
+        second = _parse_digits(p + 17, 2)
+        microsecond = _parse_fraction(p + 19, n - 19)
+    if hour == -1 or minute == -1 or second == -1 or microsecond == -1:
+        raise ValueError("Unhandled datetime format: %r" % PyString_FromStringAndSize(<char *>p, n))
+
+    if year == 0 and month == 0 and day == 0:
+        return None
+    try:
+        return datetime.datetime(year, month, day, hour, minute, second, microsecond)
+    except ValueError:
+        raise ValueError("Unhandled datetime format: %r" % PyString_FromStringAndSize(<char *>p, n))
+
+cdef _parse_time(unsigned char *p, int n):
+    """parses a text protocol TIME ('[-]HHH:MM:SS[.ffffff]') into a timedelta, empty values are returned as None"""
+    cdef int i, negative, hour, minute, second, microsecond
+
+    if n == 0:
+        return None
+    negative = 0
+    i = 0
+    if n > 0 and p[0] == c'-':
+        negative = 1
+        i = 1
+    #the hours take 2 or 3 digits, look for the first ':'
+    while i < n and p[i] != c':':
+        i = i + 1
+
+    hour = minute = second = microsecond = -1
+    if i - negative >= 1 and i + 6 <= n and p[i + 3] == c':':
+        hour = _parse_digits(p + negative, i - negative)
+        minute = _parse_digits(p + i + 1, 2)
+        second = _parse_digits(p + i + 4, 2)
+        microsecond = _parse_fraction(p + i + 6, n - i - 6)
+    if hour == -1 or minute == -1 or second == -1 or microsecond == -1:
+        raise ValueError("Unhandled time format: %r" % PyString_FromStringAndSize(<char *>p, n))
+
+    td = datetime.timedelta(0, hour * 3600 + minute * 60 + second, microsecond)
+    if negative:
+        return -td
+    else:
+        return td
+
+cdef struct FieldDecoder:
+    int type
+    int unsigned
+    int converter
+    int custom #whether a user converter is called on the (non NULL) value afterwards
+    char *codec #charset to decode string values with, NULL for binary strings
+
+cdef enum:
+    ROW_TUPLE = 0
+    ROW_DICT = 1
+    ROW_NAMEDTUPLE = 2
+    ROW_CUSTOM = 3
+
+class ROW_FACTORY:
+    TUPLE = 'tuple'
+    DICT = 'dict'
+    NAMEDTUPLE = 'namedtuple'
+
+_namedtuple_cache = {} #column names -> namedtuple class
+
+def namedtuple_class(names):
+    """Returns the (cached) namedtuple class for rows with the given column names"""
+    names = tuple(names)
+    try:
+        return _namedtuple_cache[names]
+    except KeyError:
+        cls = collections.namedtuple('Row', names, rename = True)
+        _namedtuple_cache[names] = cls
+        return cls
+
+cdef int _bit_count(int n):
+    cdef int count = 0
+    while n:
+        n = n & (n - 1)
+        count = count + 1
+    return count
+
+cdef object _find_converter(object converters, int t, int flags):
+    """looks up the user converter for a column, keys of the form (type, flags) take precedence
+    over just the type, they match when all of the given flags are set on the column.
+    When several of them match, the most specific one (with the most flags) wins, between keys with
+    the same number of flags the one with the highest flag bits"""
+    cdef int key_flags, bits
+    cdef int best_bits = -1
+    cdef int best_flags = 0
+    cdef object best = None
+    if not converters:
+        return None
+    for key, converter in converters.iteritems():
+        if type(key) is tuple and key[0] == t:
+            key_flags = key[1]
+            if (flags & key_flags) == key_flags:
+                bits = _bit_count(key_flags)
+                if bits > best_bits or (bits == best_bits and key_flags > best_flags):
+                    best = converter
+                    best_bits = bits
+                    best_flags = key_flags
+    if best_bits >= 0:
+        return best
+    return converters.get(t)
+
+def find_converter(converters, field_type, flags):
+    """Returns the callable of *converters* (see :class:`RowDecoder`) that is applied to a column with the
+    given FIELD_TYPE and FIELD_FLAG bits, or None"""
+    return _find_converter(converters, field_type, flags)
+
+cdef class RowDecoder:
+    """The field descriptions of a resultset, compiled into an array of converters, so that
+    the row reading loop does not have to look up the types and charsets for every field of every row.
+    Use :meth:`PacketReader.compile_fields` to create one.
+
+    *converters* optionally maps a FIELD_TYPE, or a tuple (FIELD_TYPE, FIELD_FLAG bits), to a callable.
+    When more than one key matches a column, the tuple with the most flags wins (see :func:`find_converter`).
+    The callable is called from the row loop with each non NULL value of a matching column, after
+    the built in conversion (for instance NEWDECIMAL to Decimal, BIT to int, strings are decoded) has been done.
+
+    *row_factory* determines what kind of object is created for each row, see :meth:`set_row_factory`."""
+
+    cdef readonly object fields
+    cdef int field_count
+    cdef FieldDecoder *columns
+    cdef object codecs #keeps the strings alive that columns[i].codec points to
+    cdef object encoding #if not None, decoded strings are encoded again in this encoding
+    cdef object custom #the user converter for each column, or None
+    cdef int row_type
+    cdef object names #column names, for dict rows
+    cdef object row_class #namedtuple class or custom factory
+
+    def __cinit__(self, object fields, object encoding, object use_unicode, object converters = None, object row_factory = None):
+        self.columns = NULL
+
+    def __init__(self, object fields, object encoding, object use_unicode, object converters = None, object row_factory = None):
+        cdef int i, t
+        cdef FieldDecoder *column
+
+        self.fields = fields
+        self.field_count = len(fields)
+        self.codecs = []
+        self.custom = []
+        self.encoding = None
+        if not use_unicode:
+            self.encoding = encoding
+        decode = encoding or use_unicode
+
+        self.columns = <FieldDecoder *>calloc(self.field_count + 1, sizeof(FieldDecoder))
+        if self.columns == NULL:
+            raise MemoryError()
+
+        i = 0
+        for field in fields:
+            column = &self.columns[i]
+            t = field[1]
+            column.type = t
+            column.unsigned = field[3] & FIELD_FLAG_UNSIGNED
+            column.codec = NULL
+            if t in INT_TYPES:
+                column.converter = CONVERT_INT
+            elif t in FLOAT_TYPES:
+                column.converter = CONVERT_FLOAT
+            elif t == FIELD_TYPE_YEAR:
+                column.converter = CONVERT_INT
+            elif t == FIELD_TYPE_DATE or t == FIELD_TYPE_NEWDATE:
+                column.converter = CONVERT_DATE
+            elif t == FIELD_TYPE_DATETIME or t == FIELD_TYPE_TIMESTAMP:
+                column.converter = CONVERT_DATETIME
+            elif t == FIELD_TYPE_TIME:
+                column.converter = CONVERT_TIME
+            elif t in DECIMAL_TYPES:
+                column.converter = CONVERT_DECIMAL
+            elif t == FIELD_TYPE_BIT:
+                column.converter = CONVERT_BIT
+            elif t in STRING_TYPES and decode:
+                column.converter = CONVERT_STRING
+                charsetnr = field[2]
+                codec = charset_nr[ord(charsetnr[1]) << 8 | ord(charsetnr[0])]
+                if codec != 'binary':
+                    self.codecs.append(codec)
+                    column.codec = codec
+            else:
+                column.converter = CONVERT_BYTES
+            converter = _find_converter(converters, t, field[3])
+            column.custom = converter is not None
+            self.custom.append(converter)
+            i = i + 1
+
+        self.set_row_factory(row_factory)
+
+    def set_row_factory(self, object row_factory):
+        """Sets the type of the rows created. *row_factory* is one of ROW_FACTORY.TUPLE (or None), ROW_FACTORY.DICT
+        (keyed by column name), ROW_FACTORY.NAMEDTUPLE, or a callable which is called with the field descriptions
+        and a tuple of the values of each row"""
+        self.names = [field[0] for field in self.fields]
+        self.row_class = None
+        if row_factory is None or row_factory == ROW_FACTORY.TUPLE:
+            self.row_type = ROW_TUPLE
+        elif row_factory == ROW_FACTORY.DICT:
+            self.row_type = ROW_DICT
+        elif row_factory == ROW_FACTORY.NAMEDTUPLE:
+            self.row_type = ROW_NAMEDTUPLE
+            self.row_class = namedtuple_class(self.names)
+        elif callable(row_factory):
+            self.row_type = ROW_CUSTOM
+            self.row_class = row_factory
+        else:
+            raise ValueError("unknown row factory: %r" % (row_factory, ))
+
+    def make_row(self, object values):
+        """creates a row from a sequence with a value for each field, using the row factory"""
+        return self._make_row(values)
+
+    cdef object _make_row(self, object row):
+        cdef int i
+        if self.row_type == ROW_TUPLE:
+            return tuple(row)
+        elif self.row_type == ROW_DICT:
+            d = {}
+            names = self.names
+            i = 0
+            while i < self.field_count:
+                d[names[i]] = row[i]
+                i = i + 1
+            return d
+        elif self.row_type == ROW_NAMEDTUPLE:
+            return tuple.__new__(self.row_class, row)
+        else:
+            return self.row_class(self.fields, tuple(row))
+
+    def __dealloc__(self):
+        free(self.columns)
+
+    def __len__(self):
+        return self.field_count
+
+cdef enum:
+    COLUMN_OBJECT = 0
+    COLUMN_LONG = 1
+    COLUMN_ULONG = 2
+    COLUMN_DOUBLE = 3
+
+cdef struct ColumnData:
+    int kind
+    char *data #one C long or double per row
+    unsigned char *nulls #one bit per row, set when the value is NULL
+
+cdef int _parse_long(unsigned char *p, int n, int unsigned, long *v):
+    """parses a text protocol integer, returns -1 if it is malformed or does not fit"""
+    cdef int i, negative
+    cdef unsigned long u, limit, digit
+
+    negative = 0
+    i = 0
+    if n > 0 and p[0] == c'-' and not unsigned:
+        negative = 1
+        i = 1
+    if i == n:
+        return -1
+    if unsigned:
+        limit = ULONG_MAX
+    elif negative:
+        limit = (<unsigned long>LONG_MAX) + 1
+    else:
+        limit = LONG_MAX
+    u = 0
+    while i < n:
+        if p[i] < c'0' or p[i] > c'9':
+            return -1
+        digit = p[i] - c'0'
+        if u > (limit - digit) / 10:
+            return -1
+        u = u * 10 + digit
+        i = i + 1
+    if negative:
+        v[0] = -<long>u
+    else:
+        v[0] = <long>u
+    return 0
+
+cdef class ColumnBuilder:
+    """Collects the values of a resultset per column instead of per row. INT and FLOAT
+    columns are stored in C arrays, with a separate NULL bitmap, all other columns in lists.
+    Use :meth:`PacketReader.read_columns` to fill it."""
+
+    cdef RowDecoder decoder
+    cdef int field_count
+    cdef int row_count
+    cdef int capacity
+    cdef ColumnData *columns
+    cdef object lists
+
+    def __cinit__(self, RowDecoder decoder):
+        self.columns = NULL
+
+    def __init__(self, RowDecoder decoder):
+        cdef int i
+        cdef ColumnData *column
+        cdef FieldDecoder *field
+
+        self.decoder = decoder
+        self.field_count = decoder.field_count
+        self.row_count = 0
+        self.capacity = 0
+        self.lists = []
+
+        self.columns = <ColumnData *>calloc(self.field_count + 1, sizeof(ColumnData))
+        if self.columns == NULL:
+            raise MemoryError()
+
+        i = 0
+        while i < self.field_count:
+            column = &self.columns[i]
+            field = &decoder.columns[i]
+            if field.custom:
+                column.kind = COLUMN_OBJECT
+            elif field.converter == CONVERT_INT and field.type == FIELD_TYPE_LONGLONG:
+                if sizeof(long) < 8:
+                    column.kind = COLUMN_OBJECT #does not fit
+                elif field.unsigned:
+                    column.kind = COLUMN_ULONG
+                else:
+                    column.kind = COLUMN_LONG
+            elif field.converter == CONVERT_INT:
+                if field.unsigned:
+                    column.kind = COLUMN_ULONG
+                else:
+                    column.kind = COLUMN_LONG
+            elif field.converter == CONVERT_FLOAT:
+                column.kind = COLUMN_DOUBLE
+            else:
+                column.kind = COLUMN_OBJECT
+            if column.kind == COLUMN_OBJECT:
+                self.lists.append([])
+            else:
+                self.lists.append(None)
+            i = i + 1
+
+    def __dealloc__(self):
+        cdef int i
+        if self.columns != NULL:
+            i = 0
+            while i < self.field_count:
+                free(self.columns[i].data)
+                free(self.columns[i].nulls)
+                i = i + 1
+            free(self.columns)
+
+    cdef int _reserve(self) except -1:
+        """makes sure there is room for one more row in the C arrays"""
+        cdef int i, capacity
+        cdef char *data
+        cdef unsigned char *nulls
+        cdef ColumnData *column
+
+        if self.row_count < self.capacity:
+            return 0
+        capacity = self.capacity * 2
+        if capacity == 0:
+            capacity = 1024
+        i = 0
+        while i < self.field_count:
+            column = &self.columns[i]
+            if column.kind != COLUMN_OBJECT:
+                data = <char *>realloc(column.data, capacity * 8)
+                if data == NULL:
+                    raise MemoryError()
+                column.data = data
+                nulls = <unsigned char *>realloc(column.nulls, capacity / 8)
+                if nulls == NULL:
+                    raise MemoryError()
+                memset(nulls + self.capacity / 8, 0, (capacity - self.capacity) / 8)
+                column.nulls = nulls
+            i = i + 1
+        self.capacity = capacity
+        return 0
+
+    def __len__(self):
+        return self.row_count
+
+    def add_rows(self, rows):
+        """Adds rows that were decoded already, e.g. the rows of a resultset that were read into memory.
+        The rows are sequences with a value for each field, or dicts keyed by column name"""
+        cdef int i, kind
+        cdef ColumnData *column
+
+        for row in rows:
+            if isinstance(row, dict):
+                row = [row[name] for name in self.decoder.names]
+            self._reserve()
+            i = 0
+            while i < self.field_count:
+                column = &self.columns[i]
+                kind = column.kind
+                value = row[i]
+                if kind == COLUMN_OBJECT:
+                    self.lists[i].append(value)
+                elif value is None:
+                    column.nulls[self.row_count / 8] |= 1 << (self.row_count % 8)
+                    if kind == COLUMN_DOUBLE:
+                        (<double *>column.data)[self.row_count] = 0.0
+                    else:
+                        (<long *>column.data)[self.row_count] = 0
+                elif kind == COLUMN_DOUBLE:
+                    (<double *>column.data)[self.row_count] = value
+                elif kind == COLUMN_ULONG:
+                    (<unsigned long *>column.data)[self.row_count] = value
+                else:
+                    (<long *>column.data)[self.row_count] = value
+                i = i + 1
+            self.row_count = self.row_count + 1
+
+    def get_columns(self):
+        """Returns a list with one column per field and a list with the NULL bitmaps.
+        Numeric columns are an array.array ('l', 'L' or 'd'), NULL values are stored as 0 and have their bit set
+        in the bitmap, which is an array.array('B') with the bit for row i at (bitmap[i / 8] >> (i % 8)) & 1.
+        Other columns are a list containing None for NULL values, and have None as their bitmap."""
+        cdef int i, size
+        cdef ColumnData *column
+
+        columns = []
+        nulls = []
+        i = 0
+        while i < self.field_count:
+            column = &self.columns[i]
+            if column.kind == COLUMN_OBJECT:
+                columns.append(self.lists[i])
+                nulls.append(None)
+            else:
+                if column.kind == COLUMN_LONG:
+                    a = array.array('l')
+                    size = sizeof(long)
+                elif column.kind == COLUMN_ULONG:
+                    a = array.array('L')
+                    size = sizeof(long)
+                else:
+                    a = array.array('d')
+                    size = sizeof(double)
+                if self.row_count:
+                    a.fromstring(PyString_FromStringAndSize(column.data, self.row_count * size))
+                columns.append(a)
+                bitmap = array.array('B')
+                if self.row_count:
+                    bitmap.fromstring(PyString_FromStringAndSize(<char *>column.nulls, (self.row_count + 7) / 8))
+                nulls.append(bitmap)
+            i = i + 1
+        return columns, nulls
+
+MAX_PACKET_SIZE = 32 * 1024 * 1024 #32mb, default limit for the size of a (possibly multi packet) packet
+MAX_PAYLOAD_LENGTH = 0xFFFFFF #larger payloads are split over multiple packets
+
+#buffers for packets that do not fit in the read buffer are shared between all readers. they
+#come in size classes (powers of 2), at most OVERSIZE_POOL_COUNT idle buffers are kept per class
+#and classes larger than OVERSIZE_POOL_MAX are never kept.
+OVERSIZE_POOL_COUNT = 4
+OVERSIZE_POOL_MAX = 4 * 1024 * 1024
+_oversize_pool = {} #capacity -> list of idle buffers
+
+cdef Buffer _get_oversize_buffer(int length):
+    cdef int size
+    size = 64 * 1024
+    while size < length:
+        size = size * 2
+    idle = _oversize_pool.get(size)
+    if idle:
+        return idle.pop()
+    return Buffer(size)
+
+cdef _put_oversize_buffer(Buffer buffer):
+    if buffer._capacity <= OVERSIZE_POOL_MAX:
+        idle = _oversize_pool.setdefault(buffer._capacity, [])
+        if len(idle) < OVERSIZE_POOL_COUNT:
+            buffer.clear()
+            idle.append(buffer)
             
 cdef class PacketReader:
 
@@ -663,21 +1394,29 @@ cdef class PacketReader:
     
     cdef public object encoding
     cdef public object use_unicode
+    cdef public object converters #user converters by field type, see RowDecoder
+    cdef public object row_factory #type of the rows, see RowDecoder.set_row_factory
     
     cdef readonly Buffer buffer #the current read buffer
     cdef readonly Buffer packet #the current packet (could be normal or oversize packet):
     
     cdef Buffer normal_packet #the normal packet
     cdef Buffer oversize_packet #if we are reading an oversize packet, this is where we keep the data    
+    cdef int continued #whether the current packet continues in the next packet (its payload was MAX_PAYLOAD_LENGTH)
+    cdef public int max_packet_size #limit for the size of oversize packets, 0 means MAX_PACKET_SIZE
     
     def __init__(self, Buffer buffer):
         self.oversize = 0
         self.encoding = None
         self.use_unicode = False
+        self.converters = None
+        self.row_factory = None
         self.buffer = buffer
 
         self.normal_packet = buffer.duplicate()
-        self.oversize_packet = buffer.duplicate()
+        self.oversize_packet = None
+        self.continued = 0
+        self.max_packet_size = 0
         self.packet = self.normal_packet         
 
     cdef int _read(self) except PACKET_READ_ERROR:
@@ -756,39 +1495,90 @@ cdef class PacketReader:
     def read(self):
         return self._read()
         
+    cdef int _grow_oversize(self, int length) except -1:
+        """makes sure the oversize packet can hold *length* bytes (including room for the header), keeping its contents"""
+        cdef int max_packet_size
+        cdef Buffer packet
+
+        max_packet_size = self.max_packet_size or MAX_PACKET_SIZE
+        if length - 4 > max_packet_size:
+            raise PacketReadError("oversized packet will not fit in MAX_PACKET_SIZE, length: %d, MAX_PACKET_SIZE: %d" % (length - 4, max_packet_size))
+        if self.oversize_packet is None:
+            self.oversize_packet = _get_oversize_buffer(length)
+            self.oversize_packet._position = 4
+            self.oversize_packet._limit = 4
+        elif self.oversize_packet._capacity < length:
+            packet = _get_oversize_buffer(length)
+            packet.copy(self.oversize_packet, 0, 0, self.oversize_packet._limit)
+            packet._position = 4
+            packet._limit = self.oversize_packet._limit
+            _put_oversize_buffer(self.oversize_packet)
+            self.oversize_packet = packet
+        return 0
+
     cdef int _read_packet(self) except PACKET_READ_ERROR:
-        cdef int r, size, max_packet_size
+        cdef int r, start
+
+        if self.packet is self.oversize_packet:
+            #the previous packet was an oversize packet and is done with, release its buffer
+            _put_oversize_buffer(self.oversize_packet)
+            self.oversize_packet = None
+            self.packet = self.normal_packet
+
         r = self._read()
-        if r & PACKET_READ_TRUE:
-            if (r & PACKET_READ_START) and (r & PACKET_READ_END):
-                #normal sized packet, read entirely
-                self.packet = self.normal_packet
-                self.packet._position, self.packet._limit = self.start + 4, self.end
-            elif (r & PACKET_READ_START) and not (r & PACKET_READ_END):
-                #print 'start of oversize', self.end - self.start, self.length
-                #first create oversize_packet if necessary:
-                if self.oversize_packet._capacity < self.length:
-                    #find first size multiple of 2 that will fit the oversize packet
-                    size = self.buffer._capacity
-                    while size < self.length:
-                        size = size * 2
-                    if size >= MAX_PACKET_SIZE:
-                        raise PacketReadError("oversized packet will not fit in MAX_PACKET_SIZE, length: %d, MAX_PACKET_SIZE: %d" % (self.length, MAX_PACKET_SIZE))
-                    #print 'createing oversize packet', size
-                    self.oversize_packet = Buffer(size)
-                self.oversize_packet.copy(self.buffer, self.start, 0, self.end - self.start)
-                self.packet = self.oversize_packet
-                self.packet._position, self.packet._limit = 4, self.end - self.start
+        if not (r & PACKET_READ_TRUE):
+            return r
+
+        if (r & PACKET_READ_START) and (r & PACKET_READ_END) and not self.continued and self.length - 4 < MAX_PAYLOAD_LENGTH:
+            #normal sized packet, read entirely
+            self.packet = self.normal_packet
+            self.packet._position, self.packet._limit = self.start + 4, self.end
+            return r
+
+        #the packet is larger than the read buffer and/or is split over multiple packets,
+        #its payload is collected in the oversize packet (behind 4 bytes of room for the header)
+        if r & PACKET_READ_START:
+            if self.continued:
+                self._grow_oversize(self.oversize_packet._limit + self.length - 4)
             else:
-                #end or middle part of oversized packet
-                self.oversize_packet.copy(self.buffer, self.start, self.oversize_packet._limit, self.end - self.start)
-                self.oversize_packet._limit = self.oversize_packet._limit + (self.end - self.start) 
-                
+                self._grow_oversize(self.length)
+            start = self.start + 4 #skip the header of each packet
+        else:
+            start = self.start
+        self.oversize_packet.copy(self.buffer, start, self.oversize_packet._limit, self.end - start)
+        self.oversize_packet._limit = self.oversize_packet._limit + (self.end - start)
+
+        if r & PACKET_READ_END:
+            if self.length - 4 == MAX_PAYLOAD_LENGTH:
+                #the payload continues in the next packet
+                self.continued = 1
+                return r & ~PACKET_READ_END
+            self.continued = 0
+            self.packet = self.oversize_packet
+            self.packet._position = 4
         return r
 
     def read_packet(self):
         return self._read_packet()
 
+    cdef int _is_eof(self):
+        """whether the current packet is an EOF packet. A row can start with 0xFE as well, as the length prefix of
+        a value of 16MB or more, but then it is longer than an EOF packet"""
+        cdef Buffer packet
+        packet = self.packet
+        return packet._buff[packet._position] == 0xFE and packet._limit - packet._position < 9
+
+    cdef int _eof_status(self):
+        cdef Buffer packet
+        packet = self.packet
+        if self._is_eof() and packet._limit - packet._position >= 5:
+            return packet._buff[packet._position + 3] | (packet._buff[packet._position + 4] << 8)
+        return 0
+
+    def eof_status(self):
+        """returns the server status flags of the current packet when it is an EOF packet, otherwise 0"""
+        return self._eof_status()
+
     cdef _read_length_coded_binary(self):
         cdef unsigned int n, v
         cdef unsigned long long vw
@@ -831,51 +1621,84 @@ cdef class PacketReader:
 
     def read_length_coded_binary(self):
         return self._read_length_coded_binary()
+
+    cdef int _peek_length(self, unsigned long long *length, int *width) except -1:
+        """looks at the length at the start of a length coded string, without updating the position.
+        returns 1 for a NULL value, otherwise 0 with the length of the string and the width of the length"""
+        cdef unsigned int n
+        cdef Buffer packet
+
+        packet = self.packet
+        if packet._position + 1 > packet._limit: raise  BufferUnderflowError()
+        n = packet._buff[packet._position]
+        if n < 251:
+            length[0] = n
+            width[0] = 1
+        elif n == 251:
+            return 1
+        elif n == 252:
+            if packet._position + 3 > packet._limit: raise  BufferUnderflowError()
+            length[0] = packet._buff[packet._position + 1] | ((packet._buff[packet._position + 2]) << 8)
+            width[0] = 3
+        elif n == 253:
+            #24 bit word
+            if packet._position + 4 > packet._limit: raise  BufferUnderflowError()
+            length[0] = packet._buff[packet._position + 1] | ((packet._buff[packet._position + 2]) << 8) | ((packet._buff[packet._position + 3]) << 16)
+            width[0] = 4
+        elif n == 254:
+            #64 bit word
+            if packet._position + 9 > packet._limit: raise  BufferUnderflowError()
+            length[0] = 0
+            length[0] |= (<unsigned long long>packet._buff[packet._position + 1]) << 0
+            length[0] |= (<unsigned long long>packet._buff[packet._position + 2]) << 8
+            length[0] |= (<unsigned long long>packet._buff[packet._position + 3]) << 16
+            length[0] |= (<unsigned long long>packet._buff[packet._position + 4]) << 24
+            length[0] |= (<unsigned long long>packet._buff[packet._position + 5]) << 32
+            length[0] |= (<unsigned long long>packet._buff[packet._position + 6]) << 40
+            length[0] |= (<unsigned long long>packet._buff[packet._position + 7]) << 48
+            length[0] |= (<unsigned long long>packet._buff[packet._position + 8]) << 56
+            width[0] = 9
+        else:
+            assert False, 'not implemented yet, n: %02x' % n
+        return 0
             
     cdef _read_bytes_length_coded(self):
-        cdef unsigned int n, w
+        cdef unsigned long long n
+        cdef int w
         cdef Buffer packet
         
         packet = self.packet
-        if packet._position + 1 > packet._limit: raise  BufferUnderflowError()        
-        n = packet._buff[packet._position]
-        w = 1
-        if n >= 251:
-            if n == 251:
-                packet._position = packet._position + 1
-                return None
-            elif n == 252:
-                if packet._position + 2 > packet._limit: raise  BufferUnderflowError()
-                n = packet._buff[packet._position + 1] | ((packet._buff[packet._position + 2]) << 8)  
-                w = 3
-            elif n == 253:
-                #24 bit word
-                if packet._position + 4 > packet._limit: raise  BufferUnderflowError()
-                n = packet._buff[packet._position + 1] | ((packet._buff[packet._position + 2]) << 8) | ((packet._buff[packet._position + 3]) << 16)
-                w = 4
-            elif n == 254:
-                #64 bit word
-                if packet._position + 9 > packet._limit: raise  BufferUnderflowError()
-                n = 0
-                n |= (<unsigned long long>packet._buff[packet._position + 1]) << 0
-                n |= (<unsigned long long>packet._buff[packet._position + 2]) << 8
-                n |= (<unsigned long long>packet._buff[packet._position + 3]) << 16
-                n |= (<unsigned long long>packet._buff[packet._position + 4]) << 24
-                n |= (<unsigned long long>packet._buff[packet._position + 5]) << 32
-                n |= (<unsigned long long>packet._buff[packet._position + 6]) << 40
-                n |= (<unsigned long long>packet._buff[packet._position + 7]) << 48
-                n |= (<unsigned long long>packet._buff[packet._position + 8]) << 56
-                w = 9
-           
-            else:
-                assert False, 'not implemented yet, n: %02x' % n
-        
-        if (n + w) > (packet._limit - packet._position):
+        if self._peek_length(&n, &w):
+            packet._position = packet._position + 1
+            return None
+        if (n + w) > <unsigned long long>(packet._limit - packet._position):
             raise BufferUnderflowError()
         packet._position = packet._position + w
         s = PyString_FromStringAndSize(<char *>(packet._buff + packet._position), n)
         packet._position = packet._position + n
         return s
+
+    cdef _read_string(self, RowDecoder decoder, FieldDecoder *column):
+        """reads a length coded string and decodes it straight from the packet with the column's codec"""
+        cdef unsigned long long n
+        cdef int w
+        cdef Buffer packet
+
+        if column.codec == NULL:
+            s = self._read_bytes_length_coded()
+        else:
+            packet = self.packet
+            if self._peek_length(&n, &w):
+                packet._position = packet._position + 1
+                return None
+            if (n + w) > <unsigned long long>(packet._limit - packet._position):
+                raise BufferUnderflowError()
+            packet._position = packet._position + w
+            s = PyUnicode_Decode(<char *>(packet._buff + packet._position), n, column.codec, NULL)
+            packet._position = packet._position + n
+        if s is not None and decoder.encoding is not None:
+            s = s.encode(decoder.encoding)
+        return s
         
     def read_bytes_length_coded(self):
         return self._read_bytes_length_coded()
@@ -899,9 +1722,15 @@ cdef class PacketReader:
         packet._skip(n) #org_name
         packet._skip(1)
         charsetnr = packet._read_bytes(2)
-        n = packet._skip(4)
-        n = packet.read_byte() #type
-        return (name, n, charsetnr)
+        packet._skip(4) #length
+        n = packet._read_byte() #type
+        flags = packet.read_short()
+        return (name, n, charsetnr, flags)
+
+    def compile_fields(self, object fields):
+        """Returns a :class:`RowDecoder` for the given field descriptions, using the current
+        encoding, use_unicode, converters and row_factory settings"""
+        return RowDecoder(fields, self.encoding, self.use_unicode, self.converters, self.row_factory)
         
     cdef _string_to_int(self, object s):
         if s == None:
@@ -915,123 +1744,515 @@ cdef class PacketReader:
         else:
             return float(s)
 
-    cdef _read_datestring(self):
-        cdef unsigned int n
+    cdef _string_to_decimal(self, object s):
+        if s == None:
+            return None
+        else:
+            return decimal.Decimal(s)
+
+    cdef _read_bit(self):
+        """reads a BIT value, which is sent as a big endian binary string, as an integer"""
+        cdef unsigned long long n, v
+        cdef int w
+        cdef unsigned char *p
         cdef Buffer packet
 
         packet = self.packet
-        if packet._position + 1 > packet._limit: raise BufferUnderflowError()
-        n = packet._buff[packet._position]
-
-        if n == 251:
+        if self._peek_length(&n, &w):
             packet._position = packet._position + 1
             return None
-        
-        packet._position = packet._position + 1
-        s = PyString_FromStringAndSize(<char *>(packet._buff + packet._position), n)
-        packet._position = packet._position + n
-        return s
-
-
-    cdef _datestring_to_date(self, object s):
-        if not s or s == "0000-00-00":
-            return None
-
-        parts = s.split("-")
-        try:
-            assert len(parts) == 3
-            d = datetime.date(*map(int, parts))
-        except (AssertionError, ValueError):
-            raise ValueError("Unhandled date format: %r" % (s, ))
-        
-        return d
+        if (n + w) > <unsigned long long>(packet._limit - packet._position):
+            raise BufferUnderflowError()
+        if n > 8:
+            raise ValueError("Unhandled bit value of %d bytes" % n)
+        p = packet._buff + packet._position + w
+        packet._position = packet._position + w + n
+        v = 0
+        while n > 0:
+            v = (v << 8) | p[0]
+            p = p + 1
+            n = n - 1
+        return v
+
+    cdef _read_temporal(self, int t):
+        """reads a length coded DATE, DATETIME, TIMESTAMP or TIME value of a text protocol row
+        and parses it in place"""
+        cdef unsigned long long n
+        cdef int w
+        cdef unsigned char *p
+        cdef Buffer packet
 
-    cdef _datestring_to_datetime(self, object s):
-        if not s:
+        packet = self.packet
+        if self._peek_length(&n, &w):
+            packet._position = packet._position + 1
             return None
-            
-        datestring, timestring = s.split(" ")
+        if (n + w) > <unsigned long long>(packet._limit - packet._position):
+            raise BufferUnderflowError()
+        p = packet._buff + packet._position + w
+        packet._position = packet._position + w + n
 
-        _date = self._datestring_to_date(datestring)
-        if _date is None:
-            return None
+        if t == FIELD_TYPE_TIME:
+            return _parse_time(p, n)
+        else:
+            return _parse_date(p, n, t)
+
+    cdef inline object _read_value(self, RowDecoder decoder, FieldDecoder *column, int i):
+        """reads and converts the value of column i of a text protocol row"""
+        cdef int c
+
+        c = column.converter
+        if c == CONVERT_INT:
+            v = self._string_to_int(self._read_bytes_length_coded())
+        elif c == CONVERT_STRING:
+            v = self._read_string(decoder, column)
+        elif c == CONVERT_FLOAT:
+            v = self._string_to_float(self._read_bytes_length_coded())
+        elif c == CONVERT_DATE or c == CONVERT_DATETIME or c == CONVERT_TIME:
+            v = self._read_temporal(column.type)
+        elif c == CONVERT_DECIMAL:
+            v = self._string_to_decimal(self._read_bytes_length_coded())
+        elif c == CONVERT_BIT:
+            v = self._read_bit()
+        else:
+            v = self._read_bytes_length_coded()
 
-        parts = timestring.split(":")
-        try:
-            assert len(parts) == 3
-            d = datetime.datetime(_date.year, _date.month, _date.day, *map(int, parts))
-        except (AssertionError, ValueError):
-            raise ValueError("Unhandled datetime format: %r" % (s, ))
+        if column.custom and v is not None:
+            v = decoder.custom[i](v)
+        return v
 
-        return d
-    cdef int _read_row(self, object row, object fields, int field_count) except PACKET_READ_ERROR:
+    cdef int _read_row(self, object row, RowDecoder decoder) except PACKET_READ_ERROR:
         cdef int i, r
-        cdef int decode
-        
-        if self.encoding: 
-            decode = 1
-            encoding = self.encoding
-        else:
-            decode = 0
+        cdef FieldDecoder *column
 
         r = self._read_packet()
         if r & PACKET_READ_END: #whole packet recv                    
-            if self.packet._buff[self.packet._position] == 0xFE: 
+            if self._is_eof():
                 return r | PACKET_READ_EOF
             else:
                 i = 0
-                int_types = INT_TYPES
-                float_types = FLOAT_TYPES
-                string_types = STRING_TYPES
-                date_type = FIELD_TYPE.DATE
-                datetime_type = FIELD_TYPE.DATETIME
-                while i < field_count:
-                    t = fields[i][1] #type_code
-                    if t in int_types:
-                        row[i] = self._string_to_int(self._read_bytes_length_coded())
-                    elif t in string_types:
-                        row[i] = self._read_bytes_length_coded()
-                        if row[i] is not None and (self.encoding or self.use_unicode):
-                            bytes = fields[i][2]
-                            nr = ord(bytes[1]) << 8 | ord(bytes[0])
-                            if charset_nr[nr] != 'binary':
-                                row[i] = row[i].decode(charset_nr[nr])
-                            if not self.use_unicode:
-                                row[i] = row[i].encode(self.encoding)
-
-                    elif t in float_types:
-                        row[i] = self._string_to_float(self._read_bytes_length_coded())
-                    elif t  == date_type:
-                        row[i] = self._datestring_to_date(self._read_datestring())
-                    elif t  == datetime_type:
-                        row[i] = self._datestring_to_datetime(self._read_datestring())
-                    else:
-                        row[i] = self._read_bytes_length_coded()
-
+                column = decoder.columns
+                while i < decoder.field_count:
+                    row[i] = self._read_value(decoder, column, i)
                     i = i + 1
+                    column = column + 1
         return r
     
     def read_rows(self, object fields, int row_count):
-        cdef int r, i, field_count
-        field_count = len(fields)
+        """Reads at most *row_count* rows from the buffer. *fields* is a :class:`RowDecoder`, or
+        a list of field descriptions which will then be compiled for this call only"""
+        cdef int r, i
+        cdef RowDecoder decoder
+        if isinstance(fields, RowDecoder):
+            decoder = fields
+        else:
+            decoder = self.compile_fields(fields)
         i = 0
         r = 0
         rows = []
-        row = [None] * field_count
+        row = [None] * decoder.field_count
         add = rows.append
         #print "Reading fields", len(fields)
         while i < row_count:
-            r = self._read_row(row, fields, field_count)
+            r = self._read_row(row, decoder)
             if r & PACKET_READ_END:
                 if r & PACKET_READ_EOF:
                     break
                 else:
-                    add(tuple(row))
+                    add(decoder._make_row(row))
             if not (r & PACKET_READ_MORE):
                 break
             i = i + 1
         return r, rows
-    
+
+    def skip_rows(self):
+        """Skips row packets until the EOF packet is found or more data is needed. Only the packet headers
+        are looked at, rows are not decoded nor collected, also not when they are larger than the buffer.
+        An ERROR packet (e.g. after KILL QUERY) also ends the rows, in both cases :attr:`command` is the first byte
+        of the packet and :attr:`packet` holds it."""
+        cdef int r
+
+        if self.oversize_packet is not None:
+            #stop collecting (or release) the current oversize packet, the rest of it is skipped
+            _put_oversize_buffer(self.oversize_packet)
+            self.oversize_packet = None
+            self.packet = self.normal_packet
+
+        while 1:
+            r = self._read()
+            if (r & PACKET_READ_START) and not self.continued and ((self.command == 0xFE and self.length < 4 + 9) or self.command == 0xFF):
+                #EOF or ERROR, packets that fit in the buffer are always complete when they are started
+                self.packet._position, self.packet._limit = self.start + 4, self.end
+                return r | PACKET_READ_EOF
+            if r & PACKET_READ_END:
+                self.continued = self.length - 4 == MAX_PAYLOAD_LENGTH
+            if not (r & PACKET_READ_MORE):
+                return r
+
+    cdef _read_binary_datetime(self, int t):
+        """reads a DATE, DATETIME or TIMESTAMP value from a binary protocol row"""
+        cdef int n
+        cdef unsigned int year, month, day, hour, minute, second, microsecond
+        cdef unsigned char *p
+        cdef Buffer packet
+
+        packet = self.packet
+        n = packet._read_byte()
+        p = packet._buff + packet._position
+        packet._skip(n)
+
+        if n == 0:
+            return None #zero date
+
+        year = p[0] | (p[1] << 8)
+        month = p[2]
+        day = p[3]
+        if year == 0 and month == 0 and day == 0:
+            return None
+        if t == FIELD_TYPE_DATE or t == FIELD_TYPE_NEWDATE:
+            return datetime.date(year, month, day)
+
+        hour = 0
+        minute = 0
+        second = 0
+        microsecond = 0
+        if n >= 7:
+            hour = p[4]
+            minute = p[5]
+            second = p[6]
+        if n >= 11:
+            microsecond = p[7] | (p[8] << 8) | (p[9] << 16) | (p[10] << 24)
+        return datetime.datetime(year, month, day, hour, minute, second, microsecond)
+
+    cdef _read_binary_time(self):
+        """reads a TIME value from a binary protocol row"""
+        cdef int n
+        cdef unsigned int days, hour, minute, second, microsecond
+        cdef unsigned char *p
+        cdef Buffer packet
+
+        packet = self.packet
+        n = packet._read_byte()
+        p = packet._buff + packet._position
+        packet._skip(n)
+
+        if n == 0:
+            return datetime.timedelta(0)
+
+        days = p[1] | (p[2] << 8) | (p[3] << 16) | (p[4] << 24)
+        hour = p[5]
+        minute = p[6]
+        second = p[7]
+        microsecond = 0
+        if n >= 12:
+            microsecond = p[8] | (p[9] << 8) | (p[10] << 16) | (p[11] << 24)
+        td = datetime.timedelta(days, hour * 3600 + minute * 60 + second, microsecond)
+        if p[0]:
+            return -td
+        else:
+            return td
+
+    cdef _read_binary_value(self, RowDecoder decoder, FieldDecoder *column):
+        """reads a single non NULL value from a binary protocol row"""
+        cdef unsigned char *p
+        cdef unsigned long long v
+        cdef int i, t, unsigned
+        cdef float f
+        cdef double d
+        cdef Buffer packet
+
+        t = column.type
+        unsigned = column.unsigned
+        packet = self.packet
+        p = packet._buff + packet._position
+
+        if t == FIELD_TYPE_TINY:
+            packet._skip(1)
+            if unsigned:
+                return p[0]
+            else:
+                return <signed char>p[0]
+        elif t == FIELD_TYPE_SHORT or t == FIELD_TYPE_YEAR:
+            packet._skip(2)
+            if unsigned or t == FIELD_TYPE_YEAR:
+                return <unsigned short>(p[0] | (p[1] << 8))
+            else:
+                return <short>(p[0] | (p[1] << 8))
+        elif t == FIELD_TYPE_LONG or t == FIELD_TYPE_INT24:
+            packet._skip(4)
+            v = p[0] | (p[1] << 8) | (p[2] << 16) | ((<unsigned long long>p[3]) << 24)
+            if unsigned:
+                return <unsigned int>v
+            else:
+                return <int>v
+        elif t == FIELD_TYPE_LONGLONG:
+            packet._skip(8)
+            v = 0
+            i = 0
+            while i < 8:
+                v |= (<unsigned long long>p[i]) << (8 * i)
+                i = i + 1
+            if unsigned:
+                return v
+            else:
+                return <long long>v
+        elif t == FIELD_TYPE_FLOAT:
+            packet._skip(4)
+            memcpy(&f, p, 4)
+            return f
+        elif t == FIELD_TYPE_DOUBLE:
+            packet._skip(8)
+            memcpy(&d, p, 8)
+            return d
+        elif t == FIELD_TYPE_DATE or t == FIELD_TYPE_DATETIME or t == FIELD_TYPE_TIMESTAMP or t == FIELD_TYPE_NEWDATE:
+            return self._read_binary_datetime(t)
+        elif t == FIELD_TYPE_TIME:
+            return self._read_binary_time()
+        elif column.converter == CONVERT_STRING:
+            return self._read_string(decoder, column)
+        elif column.converter == CONVERT_DECIMAL:
+            return self._string_to_decimal(self._read_bytes_length_coded())
+        elif column.converter == CONVERT_BIT:
+            return self._read_bit()
+        else:
+            return self._read_bytes_length_coded()
+
+    cdef int _read_binary_row(self, object row, RowDecoder decoder) except PACKET_READ_ERROR:
+        cdef int i, r, field_count
+        cdef unsigned char *null_bitmap
+        cdef Buffer packet
+
+        r = self._read_packet()
+        if r & PACKET_READ_END: #whole packet recv
+            packet = self.packet
+            if self._is_eof():
+                return r | PACKET_READ_EOF
+            #packet header (0x00) followed by the NULL bitmap, which starts at bit 2
+            field_count = decoder.field_count
+            null_bitmap = packet._buff + packet._position + 1
+            packet._skip(1 + (field_count + 9) / 8)
+            i = 0
+            while i < field_count:
+                if null_bitmap[(i + 2) / 8] & (1 << ((i + 2) % 8)):
+                    row[i] = None
+                else:
+                    row[i] = self._read_binary_value(decoder, &decoder.columns[i])
+                    if decoder.columns[i].custom:
+                        row[i] = decoder.custom[i](row[i])
+                i = i + 1
+        return r
+
+    def read_binary_rows(self, object fields, int row_count):
+        """like read_rows, but for the rows of a prepared statement result (binary protocol)"""
+        cdef int r, i
+        cdef RowDecoder decoder
+        if isinstance(fields, RowDecoder):
+            decoder = fields
+        else:
+            decoder = self.compile_fields(fields)
+        i = 0
+        r = 0
+        rows = []
+        row = [None] * decoder.field_count
+        add = rows.append
+        while i < row_count:
+            r = self._read_binary_row(row, decoder)
+            if r & PACKET_READ_END:
+                if r & PACKET_READ_EOF:
+                    break
+                else:
+                    add(decoder._make_row(row))
+            if not (r & PACKET_READ_MORE):
+                break
+            i = i + 1
+        return r, rows
+
+    cdef int _read_column_row(self, ColumnBuilder builder) except PACKET_READ_ERROR:
+        cdef int i, r, w, kind
+        cdef unsigned long long n
+        cdef unsigned char *p
+        cdef char buff[64]
+        cdef char *end
+        cdef long v
+        cdef RowDecoder decoder
+        cdef ColumnData *column
+        cdef Buffer packet
+
+        r = self._read_packet()
+        if r & PACKET_READ_END:
+            packet = self.packet
+            if self._is_eof():
+                return r | PACKET_READ_EOF
+            builder._reserve()
+            decoder = builder.decoder
+            i = 0
+            while i < builder.field_count:
+                column = &builder.columns[i]
+                kind = column.kind
+                if kind == COLUMN_OBJECT:
+                    builder.lists[i].append(self._read_value(decoder, &decoder.columns[i], i))
+                elif self._peek_length(&n, &w):
+                    packet._position = packet._position + 1
+                    column.nulls[builder.row_count / 8] |= 1 << (builder.row_count % 8)
+                    if kind == COLUMN_DOUBLE:
+                        (<double *>column.data)[builder.row_count] = 0.0
+                    else:
+                        (<long *>column.data)[builder.row_count] = 0
+                else:
+                    if (n + w) > <unsigned long long>(packet._limit - packet._position):
+                        raise BufferUnderflowError()
+                    p = packet._buff + packet._position + w
+                    packet._position = packet._position + w + n
+                    if kind == COLUMN_DOUBLE:
+                        if n >= 64 or n == 0:
+                            raise ValueError("Unhandled float format: %r" % PyString_FromStringAndSize(<char *>p, n))
+                        memcpy(buff, p, n)
+                        buff[n] = 0
+                        (<double *>column.data)[builder.row_count] = strtod(buff, &end)
+                        if end != buff + n:
+                            #not all of the value was a number
+                            raise ValueError("Unhandled float format: %r" % PyString_FromStringAndSize(<char *>p, n))
+                    else:
+                        if _parse_long(p, n, kind == COLUMN_ULONG, &v) == -1:
+                            raise ValueError("Unhandled integer format: %r" % PyString_FromStringAndSize(<char *>p, n))
+                        (<long *>column.data)[builder.row_count] = v
+                i = i + 1
+            builder.row_count = builder.row_count + 1
+        return r
+
+    cdef int _read_binary_column_row(self, ColumnBuilder builder) except PACKET_READ_ERROR:
+        cdef int i, r, kind
+        cdef unsigned char *null_bitmap
+        cdef RowDecoder decoder
+        cdef ColumnData *column
+        cdef Buffer packet
+
+        r = self._read_packet()
+        if r & PACKET_READ_END:
+            packet = self.packet
+            if self._is_eof():
+                return r | PACKET_READ_EOF
+            builder._reserve()
+            decoder = builder.decoder
+            null_bitmap = packet._buff + packet._position + 1
+            packet._skip(1 + (builder.field_count + 9) / 8)
+            i = 0
+            while i < builder.field_count:
+                column = &builder.columns[i]
+                kind = column.kind
+                if null_bitmap[(i + 2) / 8] & (1 << ((i + 2) % 8)):
+                    if kind == COLUMN_OBJECT:
+                        builder.lists[i].append(None)
+                    else:
+                        column.nulls[builder.row_count / 8] |= 1 << (builder.row_count % 8)
+                        if kind == COLUMN_DOUBLE:
+                            (<double *>column.data)[builder.row_count] = 0.0
+                        else:
+                            (<long *>column.data)[builder.row_count] = 0
+                else:
+                    v = self._read_binary_value(decoder, &decoder.columns[i])
+                    if kind == COLUMN_OBJECT:
+                        if decoder.columns[i].custom:
+                            v = decoder.custom[i](v)
+                        builder.lists[i].append(v)
+                    elif kind == COLUMN_DOUBLE:
+                        (<double *>column.data)[builder.row_count] = v
+                    elif kind == COLUMN_ULONG:
+                        (<unsigned long *>column.data)[builder.row_count] = v
+                    else:
+                        (<long *>column.data)[builder.row_count] = v
+                i = i + 1
+            builder.row_count = builder.row_count + 1
+        return r
+
+    def read_columns(self, ColumnBuilder builder, int row_count, int binary = 0):
+        """Reads at most *row_count* rows from the buffer into the columns of *builder*, returns the read result"""
+        cdef int r, i
+        i = 0
+        r = 0
+        while i < row_count:
+            if binary:
+                r = self._read_binary_column_row(builder)
+            else:
+                r = self._read_column_row(builder)
+            if r & PACKET_READ_EOF:
+                break
+            if not (r & PACKET_READ_MORE):
+                break
+            i = i + 1
+        return r
+
+cdef class RowIterator:
+    """Iterates over the rows of a resultset, decoding each row straight from the buffer of *stream*
+    (a BufferedPacketReader). The stream is only asked to receive more data when the buffer does not
+    hold a complete row anymore, after the EOF packet the stream's eof attribute is set."""
+
+    cdef object stream
+    cdef PacketReader reader
+    cdef RowDecoder decoder
+    cdef int binary
+    cdef object row #reused for decoding the values
+    cdef readonly int started #whether a row was requested
+    cdef readonly int eof #whether the EOF packet was read
+
+    def __init__(self, stream, RowDecoder decoder, int binary = 0):
+        self.stream = stream
+        self.reader = stream.reader
+        self.decoder = decoder
+        self.binary = binary
+        self.row = [None] * decoder.field_count
+        self.started = 0
+        self.eof = 0
+
+    cdef object _next(self):
+        """returns the next row, when there is none eof is set"""
+        cdef int r
+        self.started = 1
+        while not self.eof:
+            if self.binary:
+                r = self.reader._read_binary_row(self.row, self.decoder)
+            else:
+                r = self.reader._read_row(self.row, self.decoder)
+            if r & PACKET_READ_END:
+                if r & PACKET_READ_EOF:
+                    self.eof = 1
+                    self.stream.server_status = self.reader._eof_status()
+                    self.stream.eof = True
+                    break
+                return self.decoder._make_row(self.row)
+            if not (r & PACKET_READ_MORE):
+                self.stream._read_more()
+        return None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        row = self._next()
+        if self.eof:
+            raise StopIteration
+        return row
+
+    def read_many(self, int n):
+        """returns a list of the next (at most) *n* rows"""
+        rows = []
+        while n > 0:
+            row = self._next()
+            if self.eof:
+                break
+            rows.append(row)
+            n = n - 1
+        return rows
+
+    def read_all(self):
+        """returns a list of the remaining rows"""
+        rows = []
+        while 1:
+            row = self._next()
+            if self.eof:
+                break
+            rows.append(row)
+        return rows
+
 cdef enum:
     PROXY_STATE_UNDEFINED = -2
     PROXY_STATE_ERROR = -1
@@ -0,0 +1,156 @@
+# Copyright (C) 2009, Hyves (Startphone Ltd.)
+#
+# This module is part of the Concurrence Framework and is released under
+# the New BSD License: http://www.opensource.org/licenses/bsd-license.php
+
+#batches lookups by key of concurrent greenlets into single 'WHERE key IN (...)' queries. greenlets
+#that ask for a key within the same short window wait for a shared query, which is executed
+#by a separate greenlet, and get the rows of their own key from its result
+
+from __future__ import with_statement
+
+import logging
+
+import gevent
+from gevent.event import AsyncResult
+
+import geventmysql
+
+try:
+    #newer gevent
+    from gevent.lock import Semaphore
+except ImportError:
+    from gevent.coros import Semaphore
+
+class BatchLoader(object):
+    """Loads rows by key for many greenlets with as few queries as possible.
+    *query* is a select with a single ``IN (%s)`` placeholder, e.g. ``select id, name from user where id in (%s)``,
+    which is expanded to the keys of the batch. *source* is a :class:`geventmysql.Connection`, or a
+    :class:`geventmysql.pool.Pool` from which a connection is taken for each batch. *key_column* is the index or name of
+    the column that holds the key of a row. A batch is executed *window* seconds after its first key was requested,
+    or as soon as it holds *max_batch_size* keys. The rows are tuples, whatever the row factory of the connection is.
+
+    Rows are handed out by comparing the value of their key column with the requested keys, so the keys must be of
+    the type the column is returned as (e.g. 1, not '1'), and match it exactly, while the server compares them
+    according to the collation of the column (e.g. case insensitive). *normalize_key* is a callable that is applied to
+    both the requested keys and the key column values before comparing them, e.g. ``lambda key: key.lower()``.
+
+    A connection must be in autocommit mode, otherwise the first batch would start a transaction that
+    lasts for the life of the connection, and all later batches would read from its (stale) snapshot.
+    A pool must be autocommitting or end the transaction when a connection is released (*reset_on_release*)."""
+
+    def __init__(self, source, query, key_column = 0, max_batch_size = 100, window = 0.001, normalize_key = None):
+        assert query.count('%s') == 1, "query must have a single %s placeholder for the keys"
+        if hasattr(source, 'acquire'):
+            autocommit = source.reset_on_release or source.kwargs.get('autocommit', False)
+        else:
+            autocommit = source.kwargs.get('autocommit', False)
+        if not autocommit:
+            raise geventmysql.ProgrammingError("a batch loader needs an autocommit connection, or a pool that resets its connections")
+        self.source = source
+        self.query = query
+        self.key_column = key_column
+        self.max_batch_size = max_batch_size
+        self.window = window
+        self.normalize_key = normalize_key
+
+        self.batches = 0 #number of queries executed
+        self.loads = 0 #number of keys requested
+
+        self._batch = {} #normalized key -> (key, AsyncResult) of the batch being collected
+        self._timer = None #greenlet that executes the batch being collected when the window has passed
+        self._lock = Semaphore() #a single connection can only execute one batch at a time
+
+    def load(self, key):
+        """Returns the list of rows with the given key (empty if there are none)"""
+        return self._request(key).get()
+
+    def load_many(self, keys):
+        """Returns a list with the list of rows of each of the given keys"""
+        waiters = [self._request(key) for key in keys]
+        return [waiter.get() for waiter in waiters]
+
+    def _request(self, key):
+        self.loads += 1
+        if self.normalize_key is not None:
+            normalized = self.normalize_key(key)
+        else:
+            normalized = key
+        if normalized in self._batch:
+            waiter = self._batch[normalized][1]
+        else:
+            waiter = AsyncResult()
+            self._batch[normalized] = (key, waiter)
+            if len(self._batch) >= self.max_batch_size:
+                self._dispatch()
+            elif self._timer is None:
+                self._timer = gevent.spawn_later(self.window, self._dispatch)
+        return waiter
+
+    def _dispatch(self):
+        """starts executing the batch being collected, a new batch is started for the next key"""
+        batch = self._batch
+        self._batch = {}
+        if self._timer is not None:
+            if self._timer is not gevent.getcurrent():
+                self._timer.kill()
+            self._timer = None
+        if batch:
+            gevent.spawn(self._execute, batch)
+
+    def _execute(self, batch):
+        try:
+            self.batches += 1
+            rows = self._fetch([key for key, _ in batch.values()])
+            results = dict([(normalized, []) for normalized in batch])
+            unmatched = 0
+            for key, row in rows:
+                if self.normalize_key is not None:
+                    key = self.normalize_key(key)
+                if key in results:
+                    results[key].append(row)
+                else:
+                    unmatched += 1
+            if unmatched:
+                self.log.warning("%d rows did not match a requested key, make sure the keys have the type of the key column, or use normalize_key", unmatched)
+        except Exception, e:
+            self.log.exception("an error occurred while loading batch")
+            for _, waiter in batch.values():
+                waiter.set_exception(e)
+        else:
+            for normalized, (_, waiter) in batch.items():
+                waiter.set(results[normalized])
+        finally:
+            #we might have been killed, the waiting greenlets must not wait forever
+            for _, waiter in batch.values():
+                if not waiter.ready():
+                    waiter.set_exception(geventmysql.Error("loading batch was interrupted"))
+
+    def _fetch(self, keys):
+        """executes the query for the given keys, returns a list of (key, row)"""
+        qry = self.query.replace('%s', ', '.join(['%s'] * len(keys)))
+        if hasattr(self.source, 'acquire'):
+            #a pool, every batch gets its own connection
+            with self.source.connection() as cnn:
+                return self._query(cnn, qry, keys)
+        else:
+            #batches that overlap wait for their turn on the connection
+            self._lock.acquire()
+            try:
+                return self._query(self.source, qry, keys)
+            finally:
+                self._lock.release()
+
+    def _query(self, cnn, qry, keys):
+        #tuple rows, so that an integer key_column works with any row factory of the connection
+        cur = cnn.cursor(row_factory = geventmysql.ROW_FACTORY.TUPLE)
+        try:
+            cur.execute(qry, tuple(keys))
+            key_column = self.key_column
+            if not isinstance(key_column, int):
+                key_column = [d[0] for d in cur.description].index(key_column)
+            return [(row[key_column], row) for row in cur.fetchall()]
+        finally:
+            cur.close()
+
+BatchLoader.log = logging.getLogger(BatchLoader.__name__)
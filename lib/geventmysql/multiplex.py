@@ -0,0 +1,151 @@
+# Copyright (C) 2009, Hyves (Startphone Ltd.)
+#
+# This module is part of the Concurrence Framework and is released under
+# the New BSD License: http://www.opensource.org/licenses/bsd-license.php
+
+#a mysql connection that is shared by many greenlets at the same time. the commands of all
+#greenlets are sent to the server as they come in, and the replies, which the server sends in the
+#same order, are handed back by a single reader greenlet. because all greenlets share the session,
+#only autocommitted statements that don't depend on session state can be used.
+
+import re
+import logging
+import collections
+
+import gevent
+from gevent.event import Event, AsyncResult
+
+from geventmysql import client
+from geventmysql._mysql import Buffer
+from geventmysql.mysql import BufferedPacketWriter, COMMAND
+
+#statements that start or end transactions or change session state that other greenlets would see
+_session_statement = re.compile(r"\s*(BEGIN|START\s+TRANSACTION|COMMIT|ROLLBACK|SAVEPOINT|SET|LOCK|UNLOCK|USE)\b", re.IGNORECASE)
+
+class MultiplexedConnection(object):
+    """A connection to a MySQL server that can be used by many greenlets concurrently.
+    Commands are queued and written to the socket in batches by a writer greenlet, without
+    waiting for the replies to the commands before them. A reader greenlet reads the replies in order and hands
+    each one to the greenlet that is waiting for it. The rows of resultsets are read into memory before that.
+    The connection is always in autocommit mode, statements that start transactions or change session state are refused.
+    All arguments are passed to :meth:`client.Connection.connect`."""
+
+    def __init__(self, *args, **kwargs):
+        if kwargs.get('autocommit', True) != True:
+            raise client.ClientProgrammingError("a multiplexed connection can only be used in autocommit mode")
+        if kwargs.get('compress') or kwargs.get('local_infile') or kwargs.get('multi_statements'):
+            raise client.ClientProgrammingError("compress, local_infile and multi_statements can not be multiplexed")
+        kwargs['autocommit'] = True
+
+        self.client = client.connect(*args, **kwargs)
+        self.closed = False
+        self.error = None #the exception that broke the connection
+
+        #the reader uses the buffer of the client, the writer gets its own, so that they can run at the same time
+        self.writer = BufferedPacketWriter(self.client.socket, Buffer(1024 * 16))
+        self.client._incommand = True #the client is ours now, it can not be used directly anymore
+
+        self._queue = [] #(cmd, cmd_text, read_result, waiter) of commands that were not sent yet
+        self._replies = collections.deque() #(read_result, waiter) of commands that were sent, in order
+        self._send_event = Event()
+        self._reply_event = Event()
+        self._sender = gevent.spawn(self._send_loop)
+        self._receiver = gevent.spawn(self._receive_loop)
+
+    def _send_loop(self):
+        writer = self.writer
+        try:
+            while True:
+                self._send_event.wait()
+                self._send_event.clear()
+                #everything that was queued since we last ran is sent in one go
+                queue, self._queue = self._queue, []
+                if not queue:
+                    continue
+                writer.clear()
+                for cmd, cmd_text, read_result, waiter in queue:
+                    writer.write_command(cmd, cmd_text)
+                    self._replies.append((read_result, waiter))
+                writer.flush()
+                self._reply_event.set()
+        except gevent.GreenletExit:
+            pass
+        except Exception, e:
+            self.log.exception("an error occurred while sending commands")
+            self._fail(e)
+
+    def _receive_loop(self):
+        replies = self._replies
+        try:
+            while True:
+                while not replies:
+                    self._reply_event.wait()
+                    self._reply_event.clear()
+                read_result, waiter = replies[0]
+                result = self.client._read_reply(read_result)
+                replies.popleft()
+                waiter.set(result)
+        except gevent.GreenletExit:
+            pass
+        except Exception, e:
+            self.log.exception("an error occurred while reading replies")
+            self._fail(e)
+
+    def _fail(self, e):
+        """the connection can not be used anymore, all waiting greenlets get the error *e*"""
+        self.error = e
+        self.close()
+
+    def is_connected(self):
+        return not self.closed
+
+    def command(self, cmd, cmd_text):
+        """Sends a COM_XXX command with the given text and waits for its result, a :class:`client.ResultSet`
+        of which the rows were already read, or (affected rows, last row id)"""
+        assert type(cmd_text) == str #as opposed to unicode
+        if self.closed:
+            raise client.ClientProgrammingError("connection is closed")
+        waiter = AsyncResult()
+        self._queue.append((cmd, cmd_text, self.client._read_result, waiter))
+        self._send_event.set()
+        #if we are killed while waiting, the reply is still read and thrown away by the reader
+        result = waiter.get()
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def query(self, cmd_text):
+        """Sends a COM_QUERY command with the given text and waits for its result, see :meth:`command`"""
+        if _session_statement.match(cmd_text):
+            raise client.ClientProgrammingError("transactions and session statements can not be used on a multiplexed connection")
+        return self.command(COMMAND.QUERY, cmd_text)
+
+    def close(self):
+        """Closes the connection, greenlets that are still waiting for a reply get an error"""
+        if self.closed:
+            return
+        self.closed = True
+        current = gevent.getcurrent()
+        for greenlet in (self._sender, self._receiver):
+            if greenlet is not current:
+                greenlet.kill()
+
+        error = self.error or client.ClientError("connection was closed while waiting for the reply")
+        for _, waiter in self._replies:
+            waiter.set_exception(error)
+        for _, _, _, waiter in self._queue:
+            waiter.set_exception(error)
+        self._replies.clear()
+        self._queue = []
+
+        self.client._incommand = False
+        self.client.current_resultset = None
+        try:
+            self.client.close()
+        except Exception:
+            self.log.exception("an error occurred while closing multiplexed connection")
+
+MultiplexedConnection.log = logging.getLogger(MultiplexedConnection.__name__)
+
+def connect(*args, **kwargs):
+    return MultiplexedConnection(*args, **kwargs)
@@ -5,6 +5,10 @@
 
 import sys
 import os
+import zlib
+import struct
+import decimal
+import datetime
 
 from geventmysql import _mysql
 
@@ -15,11 +19,19 @@ CLIENT_STATES = _mysql.CLIENT_STATES
 READ_RESULT_STATES = _mysql.READ_RESULT_STATES
 AUTH_RESULT_STATES = _mysql.AUTH_RESULT_STATES
 COMMAND = _mysql.COMMAND
+FIELD_TYPE = _mysql.FIELD_TYPE
+FIELD_FLAG = _mysql.FIELD_FLAG
+ROW_FACTORY = _mysql.ROW_FACTORY
 
 PacketReader = _mysql.PacketReader
+MAX_PAYLOAD_LENGTH = _mysql.MAX_PAYLOAD_LENGTH
+RowDecoder = _mysql.RowDecoder
+ColumnBuilder = _mysql.ColumnBuilder
+RowIterator = _mysql.RowIterator
 PacketReadError = _mysql.PacketReadError
 ProxyProtocol = _mysql.ProxyProtocol
 
+from geventmysql._mysql import Buffer
 from geventmysql.buffered import BufferedWriter, BufferedReader
 
 
@@ -30,7 +42,22 @@ class COMMAND:
     QUERY = 0x03
     LIST = 0x04
     PING = 0x0e
+    STMT_PREPARE = 0x16
+    STMT_EXECUTE = 0x17
+    STMT_SEND_LONG_DATA = 0x18
+    STMT_CLOSE = 0x19
     
+class SERVER_STATUS(object):
+    IN_TRANS = 1    # Transaction has started */
+    AUTOCOMMIT = 2    # Server in auto_commit mode */
+    MORE_RESULTS_EXISTS = 8    # Multi query - next query exists */
+    NO_GOOD_INDEX_USED = 16
+    NO_INDEX_USED = 32
+    CURSOR_EXISTS = 64
+    LAST_ROW_SENT = 128
+    DB_DROPPED = 256
+    NO_BACKSLASH_ESCAPES = 512
+
 class CAPS(object):
     LONG_PASSWORD =   1   # new more secure passwords 
     FOUND_ROWS = 2    #Found instead of affected rows
@@ -76,6 +103,86 @@ class CAPS(object):
             if caps & value:
                 print name
 
+def pack_length_coded_binary(n):
+    """returns n encoded as a mysql length coded binary"""
+    if n < 251:
+        return chr(n)
+    elif n < 0x10000:
+        return struct.pack('<BH', 252, n)
+    elif n < 0x1000000:
+        return struct.pack('<BI', 253, n)[:4]
+    else:
+        return struct.pack('<BQ', 254, n)
+
+def pack_binary_value(value, encoding):
+    """returns (field type, unsigned flag, bytes) for sending value as a
+    parameter of a prepared statement in the binary protocol"""
+    if isinstance(value, bool):
+        return FIELD_TYPE.TINY, 0, chr(int(value))
+    elif isinstance(value, (int, long)):
+        if -0x8000000000000000 <= value <= 0x7FFFFFFFFFFFFFFF:
+            return FIELD_TYPE.LONGLONG, 0, struct.pack('<q', value)
+        elif 0 <= value <= 0xFFFFFFFFFFFFFFFF:
+            return FIELD_TYPE.LONGLONG, 0x80, struct.pack('<Q', value)
+        else:
+            s = str(value)
+            return FIELD_TYPE.NEWDECIMAL, 0, pack_length_coded_binary(len(s)) + s
+    elif isinstance(value, float):
+        return FIELD_TYPE.DOUBLE, 0, struct.pack('<d', value)
+    elif isinstance(value, str):
+        return FIELD_TYPE.VAR_STRING, 0, pack_length_coded_binary(len(value)) + value
+    elif isinstance(value, unicode):
+        s = value.encode(encoding)
+        return FIELD_TYPE.VAR_STRING, 0, pack_length_coded_binary(len(s)) + s
+    elif isinstance(value, datetime.datetime):
+        if value.microsecond:
+            return FIELD_TYPE.DATETIME, 0, struct.pack('<BHBBBBBI', 11, value.year, value.month, value.day,
+                                                       value.hour, value.minute, value.second, value.microsecond)
+        else:
+            return FIELD_TYPE.DATETIME, 0, struct.pack('<BHBBBBB', 7, value.year, value.month, value.day,
+                                                       value.hour, value.minute, value.second)
+    elif isinstance(value, datetime.date):
+        return FIELD_TYPE.DATE, 0, struct.pack('<BHBB', 4, value.year, value.month, value.day)
+    elif isinstance(value, datetime.timedelta):
+        td = abs(value)
+        hours, seconds = divmod(td.seconds, 3600)
+        minutes, seconds = divmod(seconds, 60)
+        return FIELD_TYPE.TIME, 0, struct.pack('<BBIBBBI', 12, value < datetime.timedelta(0), td.days,
+                                               hours, minutes, seconds, td.microseconds)
+    elif isinstance(value, decimal.Decimal):
+        s = str(value)
+        return FIELD_TYPE.NEWDECIMAL, 0, pack_length_coded_binary(len(s)) + s
+    else:
+        assert False, "unknown argument type: %s %s" % (type(value), repr(value))
+
+TSV_ESCAPES = [('\\', '\\\\'), ('\0', '\\0'), ('\t', '\\t'), ('\n', '\\n'), ('\r', '\\r')]
+
+def pack_tsv_value(value, encoding):
+    """returns value formatted for the default FIELDS/LINES format of LOAD DATA"""
+    if value is None:
+        return '\\N'
+    elif isinstance(value, bool):
+        return '1' if value else '0'
+    elif isinstance(value, float):
+        return repr(value)
+    elif isinstance(value, datetime.timedelta):
+        td = abs(value)
+        hours, seconds = divmod(td.days * 86400 + td.seconds, 3600)
+        minutes, seconds = divmod(seconds, 60)
+        s = '%s%d:%02d:%02d.%06d' % ('-' if value < datetime.timedelta(0) else '', hours, minutes, seconds, td.microseconds)
+    elif isinstance(value, unicode):
+        s = value.encode(encoding)
+    else:
+        s = str(value)
+    for c, escaped in TSV_ESCAPES:
+        if c in s:
+            s = s.replace(c, escaped)
+    return s
+
+def pack_tsv_row(row, encoding):
+    """returns the values of row as a tab separated, newline terminated line for LOAD DATA"""
+    return '\t'.join([pack_tsv_value(value, encoding) for value in row]) + '\n'
+
 def create_scramble_buff():
     import random
     return ''.join([chr(random.randint(0, 255)) for _ in xrange(20)])
@@ -119,6 +226,25 @@ class BufferedPacketWriter(BufferedWriter):
         
     def write_header(self, length, packet_number):
         self.buffer.write_int((length - 4) | (packet_number << 24))
+
+    def write_command(self, cmd, data):
+        """writes a command packet with the given command byte followed by data. Payloads
+        of MAX_PAYLOAD_LENGTH bytes or more are split into multiple packets, as the protocol requires"""
+        n = min(len(data) + 1, MAX_PAYLOAD_LENGTH)
+        self.write_header(n + 4, 0)
+        self.write_byte(cmd)
+        self.write_bytes(data, 0, n - 1)
+        offset = n - 1
+        number = 1
+        while n == MAX_PAYLOAD_LENGTH:
+            #a full packet is always followed by another one, which might be empty
+            n = min(len(data) - offset, MAX_PAYLOAD_LENGTH)
+            if self.buffer.remaining < 4:
+                self.flush()
+            self.write_header(n + 4, number & 0xFF)
+            self.write_bytes(data, offset, n)
+            offset += n
+            number += 1
         
     def start(self):
         """starts building a packet"""
@@ -152,6 +278,8 @@ class BufferedPacketReader(BufferedReader):
         self.stream = stream
         self.buffer = buffer
         self.reader = PacketReader(buffer)
+        self.eof = False #whether the EOF packet of the current resultset was read
+        self.server_status = 0 #SERVER_STATUS flags of that EOF packet
 
     def read_packets(self):
         reader = self.reader
@@ -174,6 +302,9 @@ class BufferedPacketReader(BufferedReader):
     
     def read_fields(self, field_count):
         
+        self.eof = False #a new resultset starts
+        self.server_status = 0
+
         #generator for rest of result packets
         packets = self.read_packets()
         
@@ -193,19 +324,466 @@ class BufferedPacketReader(BufferedReader):
         
         return fields 
 
-    def read_rows(self, fields, row_count = 100):
+    def compile_fields(self, fields):
+        """compiles the field descriptions of a resultset into a RowDecoder, so
+        that the type of each column is only looked at once instead of once per row"""
+        return self.reader.compile_fields(fields)
+
+    def read_rows(self, fields, row_count = 100, binary = False):
+        """returns a RowIterator over the rows of the resultset, *row_count* is not used anymore as the
+        rows are decoded one at a time"""
+        if not isinstance(fields, RowDecoder):
+            fields = self.reader.compile_fields(fields)
+
+        return RowIterator(self, fields, binary)
+
+    def read_row_batches(self, fields, row_count = 100, binary = False):
+        """like read_rows, but yields lists of at most row_count rows, each list only holds
+        rows that were already present in the buffer"""
         reader = self.reader
-        
+
+        if not isinstance(fields, RowDecoder):
+            fields = reader.compile_fields(fields)
+
         READ_RESULT_EOF = PACKET_READ_RESULT.EOF
         READ_RESULT_MORE = PACKET_READ_RESULT.MORE
 
+        if binary:
+            read_rows = reader.read_binary_rows
+        else:
+            read_rows = reader.read_rows
+
         while True:
-            read_result, rows = reader.read_rows(fields, row_count)
-            for row in rows:
-                yield row
+            read_result, rows = read_rows(fields, row_count)
             if read_result & READ_RESULT_EOF:
+                self.server_status = reader.eof_status()
+                self.eof = True
+            if rows:
+                yield rows
+            if self.eof:
                 break
             if not (read_result & READ_RESULT_MORE):
                 self._read_more()
 
+    def read_columns(self, fields, row_count = 100, binary = False):
+        """reads all rows of a resultset into columns, see ColumnBuilder.get_columns"""
+        reader = self.reader
+
+        if not isinstance(fields, RowDecoder):
+            fields = reader.compile_fields(fields)
+
+        READ_RESULT_EOF = PACKET_READ_RESULT.EOF
+        READ_RESULT_MORE = PACKET_READ_RESULT.MORE
+
+        builder = ColumnBuilder(fields)
+        while True:
+            read_result = reader.read_columns(builder, row_count, binary)
+            if read_result & READ_RESULT_EOF:
+                self.server_status = reader.eof_status()
+                self.eof = True
+                break
+            if not (read_result & READ_RESULT_MORE):
+                self._read_more()
+
+        return builder.get_columns()
+
+    def read_streaming_rows(self, decoder, first_streamed):
+        """reads the rows of a text protocol resultset, returning the columns from *first_streamed*
+        on as file like readers, see StreamingRows"""
+        leading_decoder = self.reader.compile_fields(decoder.fields[:first_streamed])
+        leading_decoder.set_row_factory(None)
+        return StreamingRows(self, decoder, leading_decoder, first_streamed)
+
+    def skip_rows(self, max_bytes = None):
+        """reads and throws away the remaining rows of a resultset, without decoding them. Stops after receiving
+        about *max_bytes* bytes when given, returns whether the end of the rows was reached. The end is either
+        the EOF or an ERROR packet, which is then the current packet of the reader"""
+        reader = self.reader
+
+        READ_RESULT_EOF = PACKET_READ_RESULT.EOF
+        READ_RESULT_MORE = PACKET_READ_RESULT.MORE
+
+        received = 0
+        while not self.eof:
+            read_result = reader.skip_rows()
+            if read_result & READ_RESULT_EOF:
+                self.server_status = reader.eof_status() #0 for an ERROR packet
+                self.eof = True
+            elif not (read_result & READ_RESULT_MORE):
+                if max_bytes is not None and received >= max_bytes:
+                    return False
+                received += self._read_more()
+        return True
+
             
+
+
+class PacketStream(object):
+    """Reads the payload of a (possibly multi) packet straight from the buffer of a BufferedPacketReader
+    in pieces, pulling more data from the connection when needed, without collecting the packet in memory first"""
+    def __init__(self, reader):
+        self.reader = reader
+        self.buffer = reader.buffer
+        self.remaining = 0 #bytes left of the current packet
+        self.continued = False #whether the payload continues in the next packet
+
+    def start(self):
+        """reads the header of the next packet, returns the length of its payload"""
+        buffer = self.buffer
+        while buffer.remaining < 4:
+            self.reader._read_more()
+        self.remaining = struct.unpack('<I', buffer.read_bytes(4))[0] & 0xFFFFFF
+        self.continued = self.remaining == MAX_PAYLOAD_LENGTH
+        return self.remaining
+
+    def read(self, n):
+        """reads at most n bytes of the payload, returns '' at the end of the payload"""
+        while self.remaining == 0:
+            if not self.continued:
+                return ''
+            self.start()
+        buffer = self.buffer
+        if buffer.remaining == 0:
+            self.reader._read_more()
+        n = min(n, self.remaining, buffer.remaining)
+        self.remaining -= n
+        return buffer.read_bytes(n)
+
+    def read_exact(self, n):
+        s = []
+        while n > 0:
+            data = self.read(n)
+            if not data:
+                raise PacketReadError("unexpected end of packet")
+            s.append(data)
+            n -= len(data)
+        return ''.join(s)
+
+    def skip(self, n):
+        while n > 0:
+            while self.remaining == 0:
+                if not self.continued:
+                    raise PacketReadError("unexpected end of packet")
+                self.start()
+            buffer = self.buffer
+            if buffer.remaining == 0:
+                self.reader._read_more()
+            r = min(n, self.remaining, buffer.remaining)
+            buffer.skip(r)
+            self.remaining -= r
+            n -= r
+
+    def skip_rest(self):
+        """skips the rest of the payload"""
+        while self.remaining or self.continued:
+            if self.remaining == 0:
+                self.start()
+            self.skip(self.remaining)
+
+    def read_length_coded(self, first = None):
+        """reads a length coded binary, returns the value (None for NULL) and the bytes it was encoded in"""
+        if first is None:
+            first = self.read_exact(1)
+        c = ord(first)
+        if c < 251:
+            return c, first
+        elif c == 251:
+            return None, first
+        if c == 252:
+            s = self.read_exact(2)
+        elif c == 253:
+            s = self.read_exact(3)
+        else:
+            s = self.read_exact(8)
+        return sum([ord(x) << (8 * i) for i, x in enumerate(s)]), first + s
+
+class BlobReader(object):
+    """A file like object that reads the value of a streamed column straight from the connection.
+    The streamed columns of a row must be read in order and before the next row is fetched, reading
+    a column skips whatever was not read of the streamed columns before it.
+    *null* is True when the value was NULL, in that case the reader is empty."""
+
+    def __init__(self, rows, row_number, index):
+        self._rows = rows
+        self._row_number = row_number
+        self._index = index
+
+    def _seek(self):
+        return self._rows._seek(self._row_number, self._index)
+
+    def _length(self):
+        rows = self._rows
+        if self._row_number != rows.row_number or self._index not in rows.lengths:
+            self._seek()
+        return rows.lengths[self._index]
+
+    @property
+    def length(self):
+        """the length of the value in bytes, 0 for NULL"""
+        return self._length() or 0
+
+    @property
+    def null(self):
+        return self._length() is None
+
+    def read(self, n = -1):
+        """reads at most n bytes (or all remaining bytes if n is -1), returns '' when the value was read entirely.
+        Fewer bytes than requested are returned when no more bytes were received yet."""
+        rows = self._rows
+        self._seek()
+        if rows.left == 0:
+            return ''
+        if n < 0:
+            s = rows.stream.read_exact(rows.left)
+        else:
+            s = rows.stream.read(min(n, rows.left))
+        rows.left -= len(s)
+        return s
+
+    def __iter__(self):
+        while True:
+            s = self.read(self._rows.chunk_size)
+            if not s:
+                break
+            yield s
+
+class BufferedBlobReader(object):
+    """A file like object with the same interface as :class:`BlobReader`, for the value of a streamed column
+    of a resultset whose rows were read into memory already (e.g. a :class:`client.SharedResultSet`)"""
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, value):
+        self._value = value #None for NULL
+        self._position = 0
+
+    @property
+    def length(self):
+        """the length of the value in bytes, 0 for NULL"""
+        return len(self._value or '')
+
+    @property
+    def null(self):
+        return self._value is None
+
+    def read(self, n = -1):
+        """reads at most n bytes (or all remaining bytes if n is -1), returns '' when the value was read entirely"""
+        value = self._value or ''
+        if n < 0:
+            end = len(value)
+        else:
+            end = min(self._position + n, len(value))
+        s = value[self._position:end]
+        self._position = end
+        return s
+
+    def __iter__(self):
+        while True:
+            s = self.read(self.chunk_size)
+            if not s:
+                break
+            yield s
+
+class StreamingRows(object):
+    """Reads the rows of a text protocol resultset where the last columns, starting at *first_streamed*,
+    are returned as :class:`BlobReader` objects instead of being read into memory"""
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, reader, decoder, leading_decoder, first_streamed):
+        self.reader = reader
+        self.stream = PacketStream(reader)
+        self.decoder = decoder #for creating the rows
+        self.leading_decoder = leading_decoder #decodes the values before the streamed columns
+        self.first_streamed = first_streamed
+        self.field_count = len(decoder)
+        self.row_number = 0
+        self.column = -1 #the streamed column the stream is positioned in
+        self.left = 0 #bytes left of the value of that column
+        self.lengths = {} #column -> length of the value (None for NULL), for the streamed columns reached so far
+        self.in_row = False #whether the stream is positioned in a row
+        self._scratch = None #packet reader for decoding the leading values
+
+    def _seek(self, row_number, index):
+        if row_number != self.row_number:
+            raise IOError("the row of this streamed column was already passed")
+        if index < self.column:
+            raise IOError("this streamed column was already passed, the columns must be read in order")
+        while self.column < index:
+            self.stream.skip(self.left)
+            self._next_column()
+
+    def _next_column(self, first = None):
+        self.column += 1
+        length, _ = self.stream.read_length_coded(first)
+        self.lengths[self.column] = length
+        self.left = length or 0
+
+    def _decode_leading(self, values):
+        """decodes the raw (length coded) values before the streamed columns using a small packet"""
+        payload = ''.join(values)
+        size = len(payload) + 4
+        if self._scratch is None or self._scratch.buffer.capacity < size:
+            self._scratch = PacketReader(Buffer(max(size, 1024)))
+        scratch = self._scratch
+        buffer = scratch.buffer
+        buffer.clear()
+        buffer.write_int(len(payload))
+        buffer.write_bytes(payload)
+        buffer.flip()
+        _, rows = scratch.read_rows(self.leading_decoder, 1)
+        return rows[0]
+
+    def __iter__(self):
+        stream = self.stream
+        while True:
+            length = stream.start()
+            first = stream.read_exact(1)
+            if first == '\xfe' and length < 9:
+                #EOF, warning count and status flags
+                rest = stream.read_exact(length - 1)
+                if len(rest) >= 4:
+                    self.reader.server_status = struct.unpack('<H', rest[2:4])[0]
+                self.reader.eof = True
+                break
+
+            values = []
+            i = 0
+            while i < self.first_streamed:
+                n, raw = stream.read_length_coded(first)
+                first = None
+                if n:
+                    raw += stream.read_exact(n)
+                values.append(raw)
+                i += 1
+
+            if self.first_streamed:
+                row = list(self._decode_leading(values))
+            else:
+                row = []
+
+            self.column = self.first_streamed - 1
+            self.lengths = {}
+            self._next_column(first)
+            row.extend([BlobReader(self, self.row_number, i) for i in range(self.first_streamed, self.field_count)])
+
+            self.in_row = True
+            yield self.decoder.make_row(row)
+
+            self.finish_row()
+
+    def finish_row(self):
+        """skips whatever was not read of the current row"""
+        if self.in_row:
+            self.in_row = False
+            self.row_number += 1
+            self.stream.skip(self.left)
+            self.left = 0
+            self.stream.skip_rest()
+
+MAX_COMPRESSED_PAYLOAD = 0xFFFFFF
+
+class CompressedStream(object):
+    """Implements the compressed mysql protocol on top of a socket. Every frame has a 7 byte header
+    (compressed length, sequence number, uncompressed length) followed by a zlib compressed payload, or
+    by the plain payload if the uncompressed length is 0. The payloads together form the normal packet stream.
+    This object offers the recv_into and sendall methods of a socket, so that it can be used as the stream of a
+    :class:`BufferedPacketReader` and :class:`BufferedPacketWriter`.
+    Payloads shorter than *min_compress_length* are sent uncompressed."""
+
+    def __init__(self, stream, min_compress_length = 50, buffer_size = 1024 * 16):
+        self.stream = stream
+        self.min_compress_length = min_compress_length
+        self.number = 0
+        self._reader = BufferedReader(stream, Buffer(buffer_size)) #frames as read from the socket
+        self._inflated = Buffer(buffer_size) #payload that did not fit in the buffer passed to recv_into
+        self._inflated.flip()
+
+    def reset(self):
+        """resets the sequence number, must be called at the start of each command"""
+        self.number = 0
+
+    def _grow(self, buffer, size):
+        """returns buffer, or a bigger one (multiple of 2 of its size) with the same remaining data if it
+        cannot hold size bytes. Bigger buffers are kept for the next frames"""
+        if size <= buffer.capacity:
+            return buffer
+        capacity = buffer.capacity
+        while capacity < size:
+            capacity = capacity * 2
+        bigger = Buffer(capacity)
+        bigger.write_buffer(buffer)
+        bigger.flip()
+        return bigger
+
+    def _read_frame(self):
+        """reads a complete frame in the raw buffer, returns (raw buffer, payload length, uncompressed length)"""
+        reader = self._reader
+        header = reader.read_bytes(7)
+        length = ord(header[0]) | (ord(header[1]) << 8) | (ord(header[2]) << 16)
+        self.number = (ord(header[3]) + 1) % 256
+        uncompressed_length = ord(header[4]) | (ord(header[5]) << 8) | (ord(header[6]) << 16)
+        reader.buffer = raw = self._grow(reader.buffer, length)
+        while raw.remaining < length:
+            reader._read_more()
+        return raw, length, uncompressed_length
+
+    def recv_into(self, buffer):
+        """writes as much payload data as fits in buffer (from its position up till its limit), without
+        updating the buffer's position. Returns the number of bytes written"""
+        while True:
+            n = self._recv_into(buffer)
+            if n or buffer.position == buffer.limit:
+                return n
+            #empty frame, 0 would be taken for EOF
+
+    def _recv_into(self, buffer):
+        inflated = self._inflated
+        free = buffer.limit - buffer.position
+
+        if not inflated.remaining:
+            raw, length, uncompressed_length = self._read_frame()
+            if uncompressed_length == 0:
+                #plain payload
+                n = min(length, free)
+                buffer.copy(raw, raw.position, buffer.position, n)
+                if n < length:
+                    self._inflated = inflated = self._grow(inflated, length - n)
+                    inflated.clear()
+                    inflated.copy(raw, raw.position + n, 0, length - n)
+                    inflated.limit = length - n
+                raw.skip(length)
+                return n
+            elif uncompressed_length <= free:
+                buffer.uncompress(raw, raw.position, length, buffer.position, uncompressed_length)
+                raw.skip(length)
+                return uncompressed_length
+            else:
+                self._inflated = inflated = self._grow(inflated, uncompressed_length)
+                inflated.clear()
+                inflated.uncompress(raw, raw.position, length, 0, uncompressed_length)
+                inflated.limit = uncompressed_length
+                raw.skip(length)
+
+        n = min(inflated.remaining, free)
+        buffer.copy(inflated, inflated.position, buffer.position, n)
+        inflated.skip(n)
+        return n
+
+    def sendall(self, data):
+        """sends data in one or more frames"""
+        offset = 0
+        while offset < len(data):
+            payload = data[offset:offset + MAX_COMPRESSED_PAYLOAD]
+            offset += len(payload)
+            uncompressed_length = 0
+            if len(payload) >= self.min_compress_length:
+                compressed = zlib.compress(payload)
+                if len(compressed) < len(payload):
+                    payload, uncompressed_length = compressed, len(payload)
+            header = struct.pack('<I', len(payload))[:3] + chr(self.number) + struct.pack('<I', uncompressed_length)[:3]
+            self.stream.sendall(header + payload)
+            self.number = (self.number + 1) % 256
+
+    def close(self):
+        self.stream.close()
@@ -0,0 +1,241 @@
+# Copyright (C) 2009, Hyves (Startphone Ltd.)
+#
+# This module is part of the Concurrence Framework and is released under
+# the New BSD License: http://www.opensource.org/licenses/bsd-license.php
+
+#a gevent aware pool of mysql connections. the pool hands out the normal
+#geventmysql.Connection (or client.Connection) objects, it only keeps some
+#bookkeeping next to them (creation time, last use)
+
+import time
+import logging
+import collections
+from contextlib import contextmanager
+
+import gevent
+from gevent.event import AsyncResult
+
+import geventmysql
+from geventmysql import client
+
+class PoolError(Exception): pass
+class PoolClosedError(PoolError): pass
+class PoolTimeoutError(PoolError): pass
+
+class Pool(object):
+    """A pool of MySQL connections shared between greenlets.
+    At most *max_size* connections are open at the same time, *min_size* connections
+    are opened up front and kept around even when idle. Greenlets that cannot get a connection
+    immediately wait in FIFO order. Connections older than *max_lifetime* seconds are closed and replaced
+    instead of being handed out. Idle connections beyond *min_size* that were not used for *idle_timeout* seconds
+    are closed, the idle connections are checked whenever a connection is acquired or released.
+    All other arguments are passed to *connect* (default :func:`geventmysql.connect`)."""
+
+    def __init__(self, *args, **kwargs):
+        self.min_size = kwargs.pop('min_size', 0)
+        self.max_size = kwargs.pop('max_size', 10)
+        self.timeout = kwargs.pop('timeout', None)
+        self.max_lifetime = kwargs.pop('max_lifetime', None)
+        self.idle_timeout = kwargs.pop('idle_timeout', None)
+        self.connect = kwargs.pop('connect', geventmysql.connect)
+        #by default we issue a ROLLBACK when a connection is returned, unless the connections are autocommitting
+        self.reset_on_release = kwargs.pop('reset_on_release', not kwargs.get('autocommit', False))
+
+        assert 0 <= self.min_size <= self.max_size, "make sure 0 <= min_size <= max_size"
+
+        self.args = args
+        self.kwargs = kwargs
+
+        self.size = 0 #number of connections currently open (idle + in use + being connected)
+        self.closed = False
+        self._idle = [] #stack of (connection, last_used), most recently used on top
+        self._created = {} #connection -> time of creation
+        self._waiters = collections.deque() #AsyncResults of greenlets waiting for a connection
+
+        for _ in range(self.min_size):
+            self._idle.append((self._new_connection(), time.time()))
+
+    def _new_connection(self):
+        self.size += 1
+        try:
+            cnn = self.connect(*self.args, **self.kwargs)
+        except:
+            self.size -= 1
+            raise
+        self._created[cnn] = time.time()
+        return cnn
+
+    def _close_connection(self, cnn):
+        """closes the connection, the caller is responsible for the slot it occupied"""
+        del self._created[cnn]
+        if not self._is_open(cnn):
+            return
+        try:
+            cnn.close()
+        except gevent.GreenletExit:
+            raise
+        except Exception:
+            self.log.exception("an error occurred while closing pooled connection")
+
+    def _expired(self, cnn, last_used, now, size = None):
+        if size is None:
+            size = self.size
+        if self.max_lifetime is not None and now - self._created[cnn] > self.max_lifetime:
+            return True
+        if self.idle_timeout is not None and now - last_used > self.idle_timeout and size > self.min_size:
+            return True
+        return False
+
+    def _prune(self, now):
+        """closes the idle connections that expired, least recently used first, and opens
+        new ones when that leaves fewer than min_size connections"""
+        #take them out of the pool before closing any, as closing might switch to other greenlets
+        expired = []
+        for cnn, last_used in list(self._idle):
+            if self._expired(cnn, last_used, now, self.size - len(expired)):
+                self._idle.remove((cnn, last_used))
+                expired.append(cnn)
+        for cnn in expired:
+            self._close_connection(cnn)
+            self.size -= 1
+
+        while self.size < self.min_size and not self.closed:
+            try:
+                cnn = self._new_connection()
+            except gevent.GreenletExit:
+                raise
+            except Exception:
+                #the greenlet that acquires will open a connection itself, and see the error
+                self.log.exception("an error occurred while opening pooled connection")
+                break
+            self._give_back(cnn)
+
+    def _client(self, cnn):
+        #dbapi connections wrap the low level client
+        return getattr(cnn, 'client', cnn)
+
+    def _is_open(self, cnn):
+        if getattr(cnn, 'closed', False):
+            return False
+        return self._client(cnn).is_connected()
+
+    def _is_clean(self, cnn):
+        if not self._is_open(cnn):
+            return False
+        c = self._client(cnn)
+        return not c._incommand and c.current_resultset is None
+
+    def acquire(self, timeout = -1):
+        """Returns a connection from the pool, opening a new one if there is no idle connection and the pool is not full.
+        Otherwise waits for at most *timeout* seconds (default is the pools timeout, None waits forever)
+        until another greenlet releases one, and raises :exc:`PoolTimeoutError` if that did not happen."""
+        if self.closed:
+            raise PoolClosedError("pool is closed")
+
+        if timeout == -1:
+            timeout = self.timeout
+
+        self._prune(time.time())
+        #greenlets that are already waiting go first
+        if self._idle and not self._waiters:
+            cnn, _ = self._idle.pop()
+            return cnn
+
+        if self.size < self.max_size and not self._waiters:
+            return self._new_connection()
+
+        waiter = AsyncResult()
+        self._waiters.append(waiter)
+        try:
+            waiter.wait(timeout)
+        except:
+            #killed while waiting, make sure we do not lose a connection that was handed to us
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+            elif waiter.successful():
+                self._give_back(waiter.value)
+            raise
+
+        if not waiter.ready():
+            self._waiters.remove(waiter)
+            raise PoolTimeoutError("timeout while waiting for a connection from the pool")
+
+        cnn = waiter.get() #raises PoolClosedError if the pool was closed while waiting
+
+        if cnn is None:
+            #a slot was freed, but no connection came with it
+            self.size -= 1
+            return self._new_connection()
+        return cnn
+
+    def _give_back(self, cnn):
+        """hands the connection (or None, which just means a free slot) to the first
+        waiting greenlet, or stores it in the pool if nobody is waiting"""
+        if self._waiters:
+            self._waiters.popleft().set(cnn)
+        elif cnn is None:
+            self.size -= 1
+        elif self.closed:
+            self._close_connection(cnn)
+            self.size -= 1
+        else:
+            self._idle.append((cnn, time.time()))
+
+    def release(self, cnn, discard = False):
+        """Returns a connection to the pool. If *discard* is True, or the connection is
+        broken, still busy reading a result or older than *max_lifetime*, it is closed instead of reused.
+        A greenlet that is waiting then gets a new connection in its place."""
+        assert cnn in self._created, "connection does not belong to this pool"
+
+        if not discard and self._is_clean(cnn) and self.reset_on_release:
+            try:
+                cnn.rollback()
+            except gevent.GreenletExit:
+                self._close_connection(cnn)
+                self._give_back(None)
+                raise
+            except Exception:
+                self.log.exception("an error occurred while resetting pooled connection")
+                discard = True
+
+        #connections are handed straight to waiting greenlets, so under constant load this
+        #is the only place where an expired connection is seen
+        now = time.time()
+        if discard or self.closed or not self._is_clean(cnn) or self._expired(cnn, now, now):
+            self._close_connection(cnn)
+            cnn = None
+
+        self._give_back(cnn)
+        self._prune(now)
+
+    @contextmanager
+    def connection(self, timeout = -1):
+        """Context manager that acquires a connection and releases it again afterwards.
+        If the block raises anything other than an ordinary query error, the connection is discarded."""
+        cnn = self.acquire(timeout)
+        try:
+            yield cnn
+        except geventmysql.TimeoutError:
+            #the reply of the interrupted command might still be underway
+            self.release(cnn, discard = True)
+            raise
+        except (geventmysql.Error, client.ClientCommandError):
+            self.release(cnn)
+            raise
+        except:
+            self.release(cnn, discard = True)
+            raise
+        else:
+            self.release(cnn)
+
+    def close(self):
+        """Closes all idle connections, connections that are in use will be closed when they are released."""
+        self.closed = True
+        while self._idle:
+            cnn, _ = self._idle.pop()
+            self._close_connection(cnn)
+            self.size -= 1
+        while self._waiters:
+            self._waiters.popleft().set_exception(PoolClosedError("pool is closed"))
+
+Pool.log = logging.getLogger(Pool.__name__)
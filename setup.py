@@ -3,6 +3,12 @@
 from setuptools import setup
 from distutils.extension import Extension
 
+try:
+    #build from the .pyx when cython is available, otherwise from the generated .c
+    from Cython.Build import cythonize
+except ImportError:
+    cythonize = None
+
 VERSION = '0.0.1'
 
 DESCRIPTION = """\
@@ -10,6 +16,13 @@ A gevent (http://www.gevent.org) adaption of the asynchronous MySQL driver
 from the Concurrence framework (http://opensource.hyves.org/concurrence)
 """
 
+if cythonize is not None:
+    ext_modules = cythonize([Extension("geventmysql._mysql",
+        ["lib/geventmysql/geventmysql._mysql.pyx"], libraries=["z"])],
+        compiler_directives={'language_level': 2})
+else:
+    ext_modules = [Extension("geventmysql._mysql",
+        ["lib/geventmysql/geventmysql._mysql.c"], libraries=["z"])]
 
 setup(
     name="gevent-MySQL",
@@ -19,6 +32,5 @@ setup(
     package_dir={'': 'lib'},
     packages=['geventmysql'],
     install_requires=["gevent"],
-    ext_modules=[Extension("geventmysql._mysql",
-        ["lib/geventmysql/geventmysql._mysql.c"])]
+    ext_modules=ext_modules
 )
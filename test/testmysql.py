@@ -645,6 +645,1031 @@ class TestMySQL(unittest.TestCase):
         self.assertEquals([(1, peacesign_binary),(2, peacesign_binary2)], result)
 
 
+    def testPool(self):
+        from geventmysql.pool import Pool, PoolTimeoutError
+
+        pool = Pool(host = DB_HOST, user = DB_USER, password = DB_PASSWD, db = DB_DB,
+                    min_size = 1, max_size = 2)
+        self.assertEquals(1, pool.size)
+
+        with pool.connection() as cnn:
+            cur = cnn.cursor()
+            cur.execute("select 1")
+            self.assertEquals([(1,)], cur.fetchall())
+            cur.close()
+
+        #connection was returned and is reused
+        cnn1 = pool.acquire()
+        self.assertEquals(cnn, cnn1)
+        cnn2 = pool.acquire()
+        self.assertEquals(2, pool.size)
+
+        #pool is exhausted
+        try:
+            pool.acquire(timeout = 0.1)
+            self.fail('expected timeout')
+        except PoolTimeoutError:
+            pass
+
+        #waiters get connections in the order they asked for them
+        got = []
+        def waiter(i):
+            cnn = pool.acquire()
+            got.append(i)
+            gevent.sleep(0.1)
+            pool.release(cnn)
+        waiters = [gevent.spawn(waiter, i) for i in range(3)]
+        gevent.sleep(0.1)
+        pool.release(cnn1)
+        pool.release(cnn2, discard = True)
+        gevent.joinall(waiters)
+        self.assertEquals([0, 1, 2], got)
+        self.assertEquals(2, pool.size)
+
+        #a half read resultset makes the connection unusable for the next user
+        cnn = pool.acquire()
+        cur = cnn.cursor()
+        cur.execute("select 1 union select 2")
+        cur.fetchone()
+        pool.release(cnn)
+        self.assertEquals(1, pool.size)
+
+        pool.close()
+        self.assertEquals(0, pool.size)
+
+        #an expired connection is replaced when it is released to a waiting greenlet
+        pool = Pool(host = DB_HOST, user = DB_USER, password = DB_PASSWD, db = DB_DB,
+                    max_size = 1, max_lifetime = 0.1)
+        cnn1 = pool.acquire()
+        waiter = gevent.spawn(pool.acquire)
+        gevent.sleep(0.2)
+        pool.release(cnn1)
+        cnn2 = waiter.get()
+        self.assertNotEquals(cnn1, cnn2)
+        self.assertTrue(cnn1.closed)
+        self.assertEquals(1, pool.size)
+        pool.release(cnn2)
+        pool.close()
+
+        #idle connections lower in the stack expire as well, while the one on top is being reused
+        pool = Pool(host = DB_HOST, user = DB_USER, password = DB_PASSWD, db = DB_DB,
+                    min_size = 1, max_size = 3, idle_timeout = 0.2)
+        cnns = [pool.acquire() for _ in range(3)]
+        for cnn in cnns:
+            pool.release(cnn)
+        for _ in range(5):
+            gevent.sleep(0.1)
+            pool.release(pool.acquire())
+        self.assertEquals(1, pool.size)
+        self.assertTrue(cnns[0].closed)
+        self.assertTrue(cnns[1].closed)
+        self.assertFalse(cnns[2].closed)
+        pool.close()
+
+        #connections that expired are replaced up to min_size
+        pool = Pool(host = DB_HOST, user = DB_USER, password = DB_PASSWD, db = DB_DB,
+                    min_size = 2, max_size = 2, max_lifetime = 0.1)
+        cnns = [cnn for cnn, _ in pool._idle]
+        gevent.sleep(0.2)
+        cnn = pool.acquire()
+        self.assertEquals(2, pool.size)
+        self.assertEquals(1, len(pool._idle))
+        self.assertTrue(cnns[0].closed and cnns[1].closed)
+        self.assertFalse(cnn in cnns)
+        pool.release(cnn)
+        pool.close()
+
+    def testPreparedStatement(self):
+        cnn = client.connect(host = DB_HOST, user = DB_USER,
+                             password = DB_PASSWD, db = DB_DB)
+
+        cnn.query("drop table if exists tblprepared")
+        cnn.query("""create table tblprepared (
+                            test_id int(11) DEFAULT NULL,
+                            test_unsigned int unsigned DEFAULT NULL,
+                            test_bigint bigint DEFAULT NULL,
+                            test_double double DEFAULT NULL,
+                            test_string varchar(32) DEFAULT NULL,
+                            test_date date DEFAULT NULL,
+                            test_datetime datetime DEFAULT NULL) ENGINE=MyISAM DEFAULT CHARSET=latin1""")
+
+        d_date = datetime.date(2010, 2, 11)
+        d_datetime = datetime.datetime(2010, 2, 11, 13, 37, 42)
+
+        stmt = cnn.prepare("insert into tblprepared values (?, ?, ?, ?, ?, ?, ?)")
+        self.assertEquals(7, stmt.param_count)
+        self.assertEquals((1, 0), stmt.execute((1, 4294967295, -112233445566778899, 1.5, "pi'et", d_date, d_datetime)))
+        self.assertEquals((1, 0), stmt.execute((2, None, None, None, None, None, None)))
+        stmt.close()
+
+        stmt = cnn.prepare("select * from tblprepared where test_id = ?")
+        self.assertEquals(7, len(stmt.fields))
+
+        rs = stmt.execute((1, ))
+        self.assertEquals([(1, 4294967295, -112233445566778899, 1.5, "pi'et", d_date, d_datetime)], list(rs))
+        rs.close()
+
+        rs = stmt.execute((2, ))
+        self.assertEquals([(2, None, None, None, None, None, None)], list(rs))
+        rs.close()
+
+        try:
+            stmt.execute((1, 2))
+            self.fail('expected exception')
+        except client.ClientProgrammingError:
+            pass
+
+        stmt.close()
+        cnn.close()
+
+    def testStatementCache(self):
+        cnn = dbapi.connect(host = DB_HOST, user = DB_USER,
+                            password = DB_PASSWD, db = DB_DB,
+                            statement_cache_size = 2)
+
+        cur = cnn.cursor()
+        cur.execute("truncate tbltest")
+
+        for i in range(10):
+            cur.execute("insert into tbltest (test_id, test_string) values (%s, %s)", (i, "pi'et%d" % i))
+
+        cur.execute("select test_id, test_string from tbltest where test_id = %s", (3, ))
+        self.assertEquals([(3, "pi'et3")], cur.fetchall())
+
+        #queries without arguments are not prepared
+        cur.execute("select count(*) from tbltest")
+        self.assertEquals([(10, )], cur.fetchall())
+
+        self.assertEquals({'size': 2, 'hits': 9, 'misses': 2, 'evictions': 0}, cnn.get_statement_cache_stats())
+
+        cur.execute("select test_id from tbltest where test_id > %s and test_id < %s", (7, 9))
+        self.assertEquals([(8, )], cur.fetchall())
+
+        stats = cnn.get_statement_cache_stats()
+        self.assertEquals(2, stats['size'])
+        self.assertEquals(1, stats['evictions'])
+
+        #a literal ? or %% in a quoted string is not a placeholder
+        cur.execute("select 'why?', '100%%', test_id from tbltest where test_id = %s", (4, ))
+        self.assertEquals([('why?', '100%', 4)], cur.fetchall())
+
+        #queries with a placeholder in a quoted string can not be prepared, they use the text protocol
+        misses = cnn.get_statement_cache_stats()['misses']
+        cur.execute("select test_id from tbltest where test_string = 'pi''et%s'", (5, ))
+        self.assertEquals([(5, )], cur.fetchall())
+        self.assertEquals(misses, cnn.get_statement_cache_stats()['misses'])
+
+        cur.close()
+        cnn.close()
+
+    def testEncodeArgs(self):
+        from decimal import Decimal
+        from geventmysql._mysql import encode_args, escape_string
+
+        chars = ''.join([chr(i) for i in range(256)])
+        replace = {'\0': '\\0', '\n': '\\n', '\r': '\\r', '\\': '\\\\', "'": "\\'", '"': '\\"', '\x1a': '\\Z'}
+        expected = ''.join([replace.get(ch, ch) for ch in chars])
+        self.assertEquals(expected, escape_string(chars))
+        self.assertEquals(expected.decode('latin-1'), escape_string(chars.decode('latin-1')))
+
+        self.assertEquals(("'pi\\'et'", "'r\xc3\xa4k'", "1", "2", "1.5", "null", "True",
+                           "'2010-02-11 13:37:42'", "'2010-02-11'", "1.50"),
+                          encode_args(("pi'et", u'r\xe4k', 1, 2L, 1.5, None, True,
+                                       datetime.datetime(2010, 2, 11, 13, 37, 42), datetime.date(2010, 2, 11),
+                                       Decimal("1.50")), 'utf-8'))
+
+    def testExecuteMany(self):
+        cnn = dbapi.connect(host = DB_HOST, user = DB_USER,
+                            password = DB_PASSWD, db = DB_DB)
+
+        cur = cnn.cursor()
+        cur.execute("truncate tbltest")
+
+        #small batch size, so that the rows are spread over multiple statements
+        cur.batch_size = 256
+        cur.executemany("insert into tbltest (test_id, test_string) values (%s, %s)", [(i, "pi'et%d" % i) for i in range(100)])
+        self.assertEquals(100, cur.rowcount)
+
+        cur.execute("select count(*), sum(test_id) from tbltest where test_string like 'pi%%'")
+        self.assertEquals([(100, 4950)], cur.fetchall())
+
+        #batches are capped by the max_allowed_packet of the server
+        cur.execute("select @@max_allowed_packet")
+        server_max = cur.fetchall()[0][0]
+        self.assertEquals(min(server_max, cnn.client.max_packet_size), cnn.client.get_max_allowed_packet())
+
+        #statements other than insert are sent in pipelines
+        cur.pipeline_size = 2
+        cur.executemany("update tbltest set test_string = %s where test_id = %s", [('klaas', 1), ('klaas', 2), ('klaas', 1000)])
+        self.assertEquals(2, cur.rowcount)
+
+        cur.close()
+        cnn.close()
+
+        #the max_allowed_packet of the server is read whatever the row factory of the connection is
+        cnn = dbapi.connect(host = DB_HOST, user = DB_USER,
+                            password = DB_PASSWD, db = DB_DB, row_factory = dbapi.ROW_FACTORY.DICT)
+        cur = cnn.cursor()
+        cur.executemany("insert into tbltest (test_id, test_string) values (%s, %s)", [(i, 'dict') for i in range(100, 110)])
+        self.assertEquals(10, cur.rowcount)
+        self.assertEquals(min(server_max, cnn.client.max_packet_size), cnn.client.get_max_allowed_packet())
+
+        cur.close()
+        cnn.close()
+
+    def testSSCursor(self):
+        cnn = dbapi.connect(host = DB_HOST, user = DB_USER,
+                            password = DB_PASSWD, db = DB_DB)
+
+        cur = cnn.cursor()
+        cur.execute("truncate tbltest")
+        cur.executemany("insert into tbltest (test_id, test_string) values (%s, %s)", [(i, 'test%d' % i) for i in range(1000)])
+        cur.close()
+
+        cur = cnn.cursor(dbapi.SSCursor)
+        cur.execute("select test_id, test_string from tbltest order by test_id")
+        self.assertEquals((0, 'test0'), cur.fetchone())
+        self.assertEquals([(1, 'test1')], cur.fetchmany())
+        cur.arraysize = 3
+        self.assertEquals([(2, 'test2'), (3, 'test3'), (4, 'test4')], cur.fetchmany())
+        rows = cur.fetchall()
+        self.assertEquals(995, len(rows))
+        self.assertEquals((999, 'test999'), rows[-1])
+        self.assertEquals(None, cur.fetchone())
+        self.assertEquals([], cur.fetchmany(10))
+
+        #half read resultset is skipped by the next query
+        cur.execute("select test_id, test_string from tbltest order by test_id")
+        self.assertEquals(500, len(cur.fetchmany(500)))
+        cur.execute("select count(*) from tbltest")
+        self.assertEquals([(1000, )], cur.fetchall())
+
+        #all rows were fetched, but the cursor did not ask for the next batch, so it did not see the end
+        cur.execute("select test_id from tbltest where test_id < 3 order by test_id")
+        self.assertEquals([(0, ), (1, ), (2, )], cur.fetchmany(3))
+        cur.execute("select count(*) from tbltest")
+        self.assertEquals([(1000, )], cur.fetchall())
+
+        cur.execute("select test_id, test_string from tbltest")
+        cur.fetchone()
+        cur.close()
+
+        cnn.close()
+
+    def testBufferRecvInto(self):
+        from gevent import socket
+        from geventmysql._mysql import Buffer
+        from geventmysql.buffered import BufferedReader
+
+        a, b = socket.socketpair()
+
+        #recv_into writes in the free part of the buffer, after the data already there
+        buffer = Buffer(16)
+        buffer.write_bytes('ab')
+        a.sendall('0123456789')
+        n = b.recv_into(buffer)
+        self.assertEquals(10, n)
+        buffer.skip(n)
+        buffer.flip()
+        self.assertEquals('ab0123456789', buffer.read_bytes())
+
+        reader = BufferedReader(b, Buffer(4))
+        a.sendall('0123456789')
+        self.assertEquals('0123456789', reader.read_bytes(10))
+
+        a.close()
+        b.close()
+
+    def testBufferedWriter(self):
+        from gevent import socket
+        from geventmysql._mysql import Buffer
+        from geventmysql.buffered import BufferedWriter, BufferedReader
+
+        a, b = socket.socketpair()
+
+        data = ''.join([chr(i % 256) for i in range(1000)])
+        writer = BufferedWriter(a, Buffer(64))
+        writer.write_bytes('head')
+        writer.write_bytes(data) #larger than the buffer, rest is sent directly
+        writer.write_bytes(data[:100]) #larger than what is left, rest is copied into the buffer
+        writer.write_bytes('tail')
+        writer.flush()
+
+        reader = BufferedReader(b, Buffer(64))
+        self.assertEquals('head' + data + data[:100] + 'tail', reader.read_bytes(1108))
+
+        a.close()
+        b.close()
+
+    def testCompressedStream(self):
+        from gevent import socket
+        from geventmysql._mysql import Buffer
+        from geventmysql.buffered import BufferedReader
+        from geventmysql.mysql import CompressedStream
+
+        a, b = socket.socketpair()
+
+        sender = CompressedStream(a, min_compress_length = 10)
+        receiver = BufferedReader(b, Buffer(64))
+        receiver.stream = CompressedStream(b, buffer_size = 64)
+
+        data = 'abcdefghij' * 100 #compresses well, larger than the receivers buffers
+        sender.sendall('short')
+        sender.sendall(data)
+        sender.sendall(''.join([chr(i) for i in range(256)])) #does not compress, is sent plain
+        self.assertEquals(3, sender.number)
+
+        self.assertEquals('short' + data + ''.join([chr(i) for i in range(256)]), receiver.read_bytes(1261))
+        self.assertEquals(3, receiver.stream.number)
+
+        a.close()
+        b.close()
+
+    def testCompress(self):
+        cnn = client.connect(host = DB_HOST, user = DB_USER,
+                             password = DB_PASSWD, db = DB_DB, compress = True)
+
+        cnn.query("truncate tbltest")
+
+        blob = '0123456789' * 10000
+        for i in range(10):
+            cnn.query("insert into tbltest (test_id, test_string, test_blob) values (%d, 'test%d', '%s')" % (i, i, blob))
+
+        rs = cnn.query("select test_id, test_string, test_blob from tbltest")
+        self.assertEquals([(i, 'test%d' % i, blob) for i in range(10)], list(rs))
+        rs.close()
+
+        cnn.close()
+
+
+    def testRowDecoder(self):
+        cnn = client.connect(host = DB_HOST, user = DB_USER,
+                             password = DB_PASSWD, db = DB_DB, use_unicode = True)
+
+        rs = cnn.query("select 1, 'a', 1.5e0, null, cast('abc' as binary), cast('2010-01-02' as date)")
+        self.assertEquals(6, len(rs.decoder))
+        self.assertTrue(rs.decoder.fields is rs.fields)
+        self.assertEquals([(1, u'a', 1.5, None, 'abc', datetime.date(2010, 1, 2))], list(rs))
+        rs.close()
+
+        cnn.close()
+
+    def testTemporalTypes(self):
+        """Tests the conversion of TIMESTAMP, TIME, YEAR and fractional seconds"""
+
+        cnn = dbapi.connect(host = DB_HOST, user = DB_USER,
+                            password = DB_PASSWD, db = DB_DB,
+                            charset = 'latin-1', use_unicode = True)
+
+        cur = cnn.cursor()
+
+        cur.execute("drop table if exists tbldate")
+        cur.execute("create table tbldate (test_id int(11) DEFAULT NULL, test_timestamp timestamp NULL DEFAULT NULL, test_time time DEFAULT NULL, test_year year DEFAULT NULL, test_fraction datetime(6) DEFAULT NULL) ENGINE=MyISAM DEFAULT CHARSET=latin1")
+
+        cur.execute("insert into tbldate values (1, '2010-02-11 13:37:42', '-123:04:05', 2010, '2010-02-11 13:37:42.25')")
+        cur.execute("insert into tbldate values (2, NULL, '00:00:01', NULL, '0000-00-00 00:00:00')")
+
+        cur.execute("select test_id, test_timestamp, test_time, test_year, test_fraction from tbldate order by test_id")
+        result = cur.fetchall()
+        self.assertEquals([(1, datetime.datetime(2010, 2, 11, 13, 37, 42), -datetime.timedelta(0, 123 * 3600 + 4 * 60 + 5), 2010, datetime.datetime(2010, 2, 11, 13, 37, 42, 250000)),
+                           (2, None, datetime.timedelta(0, 1), None, None)], result)
+
+        cnn.close()
+
+    def testConverters(self):
+        from decimal import Decimal
+        from geventmysql.mysql import FIELD_TYPE, FIELD_FLAG
+
+        cnn = client.connect(host = DB_HOST, user = DB_USER,
+                             password = DB_PASSWD, db = DB_DB)
+
+        cnn.query("drop table if exists tblconv")
+        cnn.query("create table tblconv (test_decimal decimal(10, 2), test_bit bit(12), test_set set('a', 'b', 'c'), test_int int) ENGINE=MyISAM DEFAULT CHARSET=latin1")
+        cnn.query("insert into tblconv values (1.5, b'100000000001', 'a,c', 10), (NULL, NULL, NULL, NULL)")
+
+        rs = cnn.query("select test_decimal, test_bit, test_set, test_int from tblconv")
+        self.assertEquals([(Decimal("1.50"), 2049, 'a,c', 10), (None, None, None, None)], list(rs))
+        rs.close()
+
+        cnn.set_converters({(FIELD_TYPE.STRING, FIELD_FLAG.SET): lambda s: set(s.split(',')),
+                            FIELD_TYPE.LONG: str})
+
+        rs = cnn.query("select test_decimal, test_bit, test_set, test_int from tblconv")
+        self.assertEquals([(Decimal("1.50"), 2049, set(['a', 'c']), '10'), (None, None, None, None)], list(rs))
+        rs.close()
+
+        cnn.close()
+
+        #the most specific key wins, whatever the order of the dict
+        from geventmysql._mysql import find_converter
+        converters = {FIELD_TYPE.LONG: 'type',
+                      (FIELD_TYPE.LONG, FIELD_FLAG.NOT_NULL): 'not null',
+                      (FIELD_TYPE.LONG, FIELD_FLAG.UNSIGNED): 'unsigned',
+                      (FIELD_TYPE.LONG, FIELD_FLAG.UNSIGNED | FIELD_FLAG.NOT_NULL): 'unsigned not null'}
+        self.assertEquals('unsigned not null', find_converter(converters, FIELD_TYPE.LONG, FIELD_FLAG.UNSIGNED | FIELD_FLAG.NOT_NULL | FIELD_FLAG.BINARY))
+        self.assertEquals('not null', find_converter(converters, FIELD_TYPE.LONG, FIELD_FLAG.NOT_NULL))
+        self.assertEquals('type', find_converter(converters, FIELD_TYPE.LONG, FIELD_FLAG.BINARY))
+        self.assertEquals(None, find_converter(converters, FIELD_TYPE.TINY, FIELD_FLAG.NOT_NULL))
+        #same number of flags, the highest flag bits win
+        del converters[(FIELD_TYPE.LONG, FIELD_FLAG.UNSIGNED | FIELD_FLAG.NOT_NULL)]
+        self.assertEquals('unsigned', find_converter(converters, FIELD_TYPE.LONG, FIELD_FLAG.UNSIGNED | FIELD_FLAG.NOT_NULL))
+
+    def testRowFactory(self):
+        cnn = dbapi.connect(host = DB_HOST, user = DB_USER,
+                            password = DB_PASSWD, db = DB_DB, row_factory = dbapi.ROW_FACTORY.DICT)
+
+        cur = cnn.cursor()
+        cur.execute("select 1 as a, 'b' as b")
+        self.assertEquals([{'a': 1, 'b': 'b'}], cur.fetchall())
+
+        cur = cnn.cursor(row_factory = dbapi.ROW_FACTORY.NAMEDTUPLE)
+        cur.execute("select 1 as a, 'b' as b")
+        row1 = cur.fetchone()
+        cur.execute("select 2 as a, 'c' as b")
+        row2 = cur.fetchone()
+        self.assertEquals((1, 'b'), row1)
+        self.assertEquals((2, 'c'), (row2.a, row2.b))
+        self.assertTrue(type(row1) is type(row2)) #the class is created once per shape
+
+        cur = cnn.cursor(row_factory = lambda fields, row: [field[0] for field in fields] + list(row))
+        cur.execute("select 1 as a")
+        self.assertEquals([['a', 1]], cur.fetchall())
+
+        cnn.close()
+
+    def testFetchColumns(self):
+        cnn = dbapi.connect(host = DB_HOST, user = DB_USER,
+                            password = DB_PASSWD, db = DB_DB)
+
+        cur = cnn.cursor()
+        cur.execute("truncate tbltest")
+        cur.executemany("insert into tbltest (test_id, test_string) values (%s, %s)", [(i, 'test%d' % i) for i in range(1000)])
+        cur.execute("insert into tbltest (test_id, test_string) values (NULL, NULL)")
+
+        cur.execute("select test_id, test_id / 2e0, test_string from tbltest order by test_id")
+        columns, nulls = cur.fetch_columns()
+        ids, halves, strings = columns
+        self.assertEquals('l', ids.typecode)
+        self.assertEquals('d', halves.typecode)
+        self.assertEquals([0] + range(1000), list(ids))
+        self.assertEquals([0.0] + [i / 2.0 for i in range(1000)], list(halves))
+        self.assertEquals([None] + ['test%d' % i for i in range(1000)], strings)
+        self.assertEquals(1, nulls[0][0]) #first row is NULL
+        self.assertEquals(0, sum(nulls[0][1:]))
+        self.assertEquals(None, nulls[2])
+        self.assertEquals([], cur.fetchall())
+
+        cur.execute("select 1")
+        cur.fetchone()
+        self.assertRaises(dbapi.ProgrammingError, cur.fetch_columns)
+
+        cnn.close()
+
+    def testColumnBuilderMalformed(self):
+        """Tests that numeric values that can not be parsed are not stored as 0"""
+        import struct
+        from geventmysql._mysql import Buffer, PacketReader, ColumnBuilder, FIELD_TYPE, FIELD_FLAG
+
+        def read_columns(field_type, value, flags = 0):
+            payload = chr(len(value)) + value
+            buffer = Buffer(1024)
+            buffer.write_bytes(struct.pack('<I', len(payload))[:3] + '\0' + payload)
+            buffer.write_bytes('\x05\0\0\1\xfe\0\0\2\0') #EOF
+            buffer.flip()
+            reader = PacketReader(buffer)
+            builder = ColumnBuilder(reader.compile_fields([('a', field_type, struct.pack('<H', 63), flags)]))
+            reader.read_columns(builder, 10)
+            return list(builder.get_columns()[0][0])
+
+        self.assertEquals([-1500.0], read_columns(FIELD_TYPE.DOUBLE, '-1.5e3'))
+        self.assertEquals([18446744073709551615L], read_columns(FIELD_TYPE.LONGLONG, '18446744073709551615', FIELD_FLAG.UNSIGNED))
+        self.assertRaises(ValueError, read_columns, FIELD_TYPE.DOUBLE, '')
+        self.assertRaises(ValueError, read_columns, FIELD_TYPE.DOUBLE, '1.5x')
+        self.assertRaises(ValueError, read_columns, FIELD_TYPE.LONG, '')
+        self.assertRaises(ValueError, read_columns, FIELD_TYPE.LONG, '12a')
+        self.assertRaises(ValueError, read_columns, FIELD_TYPE.LONGLONG, '18446744073709551616', FIELD_FLAG.UNSIGNED)
+
+    def testEmptyTemporal(self):
+        """Tests that empty DATE, DATETIME and TIME values are read as None"""
+        import struct
+        from geventmysql._mysql import Buffer, PacketReader, FIELD_TYPE
+
+        def read_value(field_type, value):
+            payload = chr(len(value)) + value
+            buffer = Buffer(1024)
+            buffer.write_bytes(struct.pack('<I', len(payload))[:3] + '\0' + payload)
+            buffer.write_bytes('\x05\0\0\1\xfe\0\0\2\0') #EOF
+            buffer.flip()
+            reader = PacketReader(buffer)
+            _, rows = reader.read_rows(reader.compile_fields([('a', field_type, struct.pack('<H', 63), 0)]), 10)
+            return rows[0][0]
+
+        for field_type in (FIELD_TYPE.DATE, FIELD_TYPE.DATETIME, FIELD_TYPE.TIMESTAMP, FIELD_TYPE.TIME):
+            self.assertEquals(None, read_value(field_type, ''))
+        self.assertEquals(datetime.date(2010, 2, 11), read_value(FIELD_TYPE.DATE, '2010-02-11'))
+        self.assertEquals(datetime.timedelta(0, 3723), read_value(FIELD_TYPE.TIME, '01:02:03'))
+        self.assertRaises(ValueError, read_value, FIELD_TYPE.DATE, '2010-02')
+
+    def testMultiPackets(self):
+        """Tests payloads larger than 16mb, which are split over multiple packets"""
+        cnn = client.connect(host = DB_HOST, user = DB_USER,
+                             password = DB_PASSWD, db = DB_DB, max_allowed_packet = 64 * 1024 * 1024)
+
+        rs = cnn.query("select @@max_allowed_packet")
+        max_allowed_packet = list(rs)[0][0]
+        rs.close()
+        if max_allowed_packet < 40 * 1024 * 1024:
+            cnn.close()
+            self.skipTest("server max_allowed_packet is too small")
+
+        cnn.query("truncate tbltest")
+
+        blob = '0123456789' * (0xFFFFFF / 10 + 1000)
+        cnn.query("insert into tbltest (test_id, test_blob) values (1, '%s')" % blob)
+        cnn.query("insert into tbltest (test_id, test_blob) values (2, 'small')")
+
+        rs = cnn.query("select test_id, test_blob from tbltest order by test_id")
+        self.assertEquals([(1, blob), (2, 'small')], list(rs))
+        rs.close()
+
+        #the length prefix of a value of 16mb or more starts with 0xFE, like an EOF packet
+        rs = cnn.query("select test_blob, test_id from tbltest order by test_id")
+        self.assertEquals([(blob, 1), ('small', 2)], list(rs))
+        rs.close()
+
+        rs = cnn.query("select test_blob, test_id from tbltest order by test_id")
+        columns, nulls = rs.fetch_columns()
+        self.assertEquals([blob, 'small'], columns[0])
+        self.assertEquals([1, 2], list(columns[1]))
+        rs.close()
+
+        #connection is still in sync
+        rs = cnn.query("select 1")
+        self.assertEquals([(1, )], list(rs))
+        rs.close()
+
+        cnn.close()
+
+    def testStreamingBlob(self):
+        cnn = client.connect(host = DB_HOST, user = DB_USER,
+                             password = DB_PASSWD, db = DB_DB)
+
+        cnn.query("truncate tbltest")
+
+        blob = '0123456789' * 100000 #much larger than the connections buffer
+        cnn.query("insert into tbltest (test_id, test_string, test_blob) values (1, 'one', '%s')" % blob)
+        cnn.query("insert into tbltest (test_id, test_string, test_blob) values (2, 'two', NULL)")
+        cnn.query("insert into tbltest (test_id, test_string, test_blob) values (3, 'three', 'not read')")
+
+        rs = cnn.query("select test_id, test_string, test_blob from tbltest order by test_id")
+        rows = []
+        for test_id, test_string, reader in rs.iter_streaming(['test_blob']):
+            if test_id == 3:
+                continue #unread values are skipped
+            rows.append((test_id, test_string, reader.length, reader.null, ''.join(reader)))
+        rs.close()
+
+        self.assertEquals([(1, 'one', len(blob), False, blob), (2, 'two', 0, True, '')], rows)
+
+        #connection is still usable
+        rs = cnn.query("select test_id from tbltest order by test_id")
+        self.assertEquals([(1, ), (2, ), (3, )], list(rs))
+        rs.close()
+
+        cnn.close()
+
+    def testLongData(self):
+        from StringIO import StringIO
+
+        cnn = dbapi.connect(host = DB_HOST, user = DB_USER,
+                            password = DB_PASSWD, db = DB_DB)
+        cnn.client.long_data_chunk_size = 1000 #make sure the data is sent in several chunks
+
+        cur = cnn.cursor()
+        cur.execute("truncate tbltest")
+
+        blob = '0123456789' * 10000
+        cur.execute("insert into tbltest (test_id, test_string, test_blob) values (%s, %s, %s)", (1, 'file', StringIO(blob)))
+        cur.execute("insert into tbltest (test_id, test_string, test_blob) values (%s, %s, %s)", (2, 'iterator', iter([blob[:5000], blob[5000:]])))
+
+        cur.execute("select test_id, test_string, test_blob from tbltest order by test_id")
+        self.assertEquals([(1, 'file', blob), (2, 'iterator', blob)], cur.fetchall())
+
+        cnn.close()
+
+    def testLoadDataLocalInfile(self):
+        from StringIO import StringIO
+
+        cnn = dbapi.connect(host = DB_HOST, user = DB_USER,
+                            password = DB_PASSWD, db = DB_DB, local_infile = True)
+        cnn.client.local_infile_chunk_size = 100 #make sure the data is sent in several packets
+
+        cur = cnn.cursor()
+        cur.execute("truncate tbltest")
+
+        rows = [(i, 'row\t%d\n' % i, None) for i in range(1000)]
+        cnn.register_local_infile('rows.tsv', iter(rows))
+        cur.execute("load data local infile 'rows.tsv' into table tbltest (test_id, test_string, test_blob)")
+        self.assertEquals(1000, cur.rowcount)
+
+        cnn.register_local_infile('file.tsv', StringIO('1000\tfile\n1001\tfile\n'))
+        cur.execute("load data local infile 'file.tsv' into table tbltest (test_id, test_string)")
+        self.assertEquals(2, cur.rowcount)
+
+        cur.execute("select test_id, test_string, test_blob from tbltest order by test_id")
+        self.assertEquals(rows + [(1000, 'file', None), (1001, 'file', None)], list(cur.fetchall()))
+
+        #an unregistered file ends the load without data
+        try:
+            cur.execute("load data local infile 'unknown.tsv' into table tbltest")
+            self.fail("expected error")
+        except dbapi.Error:
+            pass
+
+        cur.execute("select count(*) from tbltest")
+        self.assertEquals((1002,), cur.fetchone())
+
+        cnn.close()
+
+    def testDiscard(self):
+        cnn = client.connect(host = DB_HOST, user = DB_USER,
+                             password = DB_PASSWD, db = DB_DB)
+
+        cnn.query("truncate tbltest")
+        for i in range(100):
+            cnn.query("insert into tbltest (test_id, test_string) values (%d, 'test%d')" % (i, i))
+
+        #the rows that were already decoded are dropped, the rest is skipped
+        rs = cnn.query("select t1.test_id, t2.test_string from tbltest t1, tbltest t2")
+        rows = iter(rs)
+        rows.next()
+        rs.discard()
+        rs.close()
+
+        #all rows were read in the buffer already
+        rs = cnn.query("select test_id from tbltest where test_id < 3")
+        rows = iter(rs)
+        self.assertEquals((0, ), rows.next())
+        rs.discard()
+        rs.close()
+
+        #a large result is killed instead of read
+        rs = cnn.query("select t1.test_id, repeat('x', 1000) from tbltest t1, tbltest t2, tbltest t3")
+        rs.discard(kill_after = 1024 * 1024)
+        rs.close()
+
+        rs = cnn.query("select count(*) from tbltest")
+        self.assertEquals([(100, )], list(rs))
+        rs.close()
+
+        cnn.close()
+
+    def testRowIterator(self):
+        cnn = client.connect(host = DB_HOST, user = DB_USER,
+                             password = DB_PASSWD, db = DB_DB)
+
+        cnn.query("truncate tbltest")
+        for i in range(10):
+            cnn.query("insert into tbltest (test_id, test_string) values (%d, 'test%d')" % (i, i))
+
+        rs = cnn.query("select test_id, test_string from tbltest order by test_id")
+        rows = iter(rs)
+        self.assertFalse(rs.started)
+        self.assertEquals((0, 'test0'), rows.next())
+        self.assertTrue(rs.started)
+        self.assertEquals([(1, 'test1'), (2, 'test2')], rows.read_many(2))
+        self.assertEquals(7, len(rows.read_all()))
+        self.assertEquals(rs.STATE_EOF, rs.state)
+        self.assertEquals([], rows.read_all())
+        self.assertEquals([], list(rows))
+        rs.close()
+
+        cnn.close()
+
+        cnn = dbapi.connect(host = DB_HOST, user = DB_USER,
+                            password = DB_PASSWD, db = DB_DB)
+        cur = cnn.cursor()
+        cur.execute("select test_id from tbltest order by test_id")
+        self.assertEquals((0, ), cur.fetchone())
+        self.assertEquals([(i, ) for i in range(1, 10)], cur.fetchall())
+        self.assertEquals(None, cur.fetchone())
+        cur.close()
+
+        cnn.close()
+
+    def testPipeline(self):
+        cnn = client.connect(host = DB_HOST, user = DB_USER,
+                             password = DB_PASSWD, db = DB_DB)
+
+        cnn.query("truncate tbltest")
+
+        pipeline = cnn.pipeline()
+        pipeline.query("insert into tbltest (test_id, test_string) values (1, 'test1')")
+        pipeline.query("insert into tbltest (test_id, test_string) values (2, 'test2')")
+        pipeline.query("select * from tbltest_does_not_exist")
+        pipeline.query("select test_id, test_string from tbltest order by test_id")
+        pipeline.query("update tbltest set test_string = 'test' where test_id = 1")
+        self.assertEquals(5, len(pipeline))
+        results = pipeline.run()
+        self.assertEquals(0, len(pipeline))
+
+        self.assertEquals((1, 0), results[0])
+        self.assertEquals((1, 0), results[1])
+        self.assertTrue(isinstance(results[2], client.ClientCommandError))
+        self.assertEquals([(1, 'test1'), (2, 'test2')], list(results[3]))
+        results[3].close()
+        self.assertEquals((1, 0), results[4])
+
+        #the server would read the commands after it as the contents of the file
+        pipeline = cnn.pipeline()
+        self.assertRaises(client.ClientProgrammingError, pipeline.query,
+                          "load data low_priority local infile 'data.tsv' into table tbltest")
+        self.assertEquals(0, len(pipeline))
+
+        cnn.close()
+
+        cnn = dbapi.connect(host = DB_HOST, user = DB_USER,
+                            password = DB_PASSWD, db = DB_DB)
+        pipeline = cnn.pipeline()
+        pipeline.execute("select test_string from tbltest where test_id = %s", (1, ))
+        pipeline.execute("select test_string from tbltest_does_not_exist")
+        pipeline.execute("update tbltest set test_string = %s", ('test', ))
+        cur1, error, cur2 = pipeline.run()
+        self.assertEquals([('test', )], cur1.fetchall())
+        self.assertTrue(isinstance(error, dbapi.Error))
+        self.assertEquals(1, cur2.rowcount)
+        cur1.close()
+        cur2.close()
+
+        cnn.close()
+
+        #a statement with more than one result gets a cursor that holds all of them
+        cnn = dbapi.connect(host = DB_HOST, user = DB_USER,
+                            password = DB_PASSWD, db = DB_DB, multi_statements = True)
+        pipeline = cnn.pipeline()
+        pipeline.execute("select %s; update tbltest set test_string = 'multi'; select 2", (1, ))
+        pipeline.execute("select 3; select * from tbltest_does_not_exist")
+        pipeline.execute("select 4")
+        cur1, cur2, cur3 = pipeline.run()
+        self.assertEquals([(1, )], cur1.fetchall())
+        self.assertTrue(cur1.nextset())
+        self.assertEquals(2, cur1.rowcount)
+        self.assertTrue(cur1.nextset())
+        self.assertEquals([(2, )], cur1.fetchall())
+        self.assertEquals(None, cur1.nextset())
+        self.assertEquals([(3, )], cur2.fetchall())
+        self.assertRaises(dbapi.Error, cur2.nextset)
+        self.assertEquals(None, cur2.nextset())
+        self.assertEquals([(4, )], cur3.fetchall())
+        self.assertEquals(None, cur3.nextset())
+        for cur in (cur1, cur2, cur3):
+            cur.close()
+
+        cnn.close()
+
+    def testMultiStatements(self):
+        cnn = client.connect(host = DB_HOST, user = DB_USER,
+                             password = DB_PASSWD, db = DB_DB, multi_statements = True)
+
+        cnn.query("truncate tbltest")
+
+        rs = cnn.query("select 1; insert into tbltest (test_id, test_string) values (1, 'test1'); select test_string from tbltest")
+        self.assertEquals([(1, )], list(rs))
+        rs.close()
+        self.assertTrue(cnn.more_results)
+        self.assertEquals((1, 0), cnn.next_result())
+        rs = cnn.next_result()
+        self.assertEquals([('test1', )], list(rs))
+        rs.close()
+        self.assertFalse(cnn.more_results)
+        self.assertEquals(None, cnn.next_result())
+
+        #results that were not read are skipped by the next command
+        rs = cnn.query("select 1; select 2; select 3")
+        rs.discard()
+        rs.close()
+        rs = cnn.query("select 4")
+        self.assertEquals([(4, )], list(rs))
+        rs.close()
+
+        cnn.close()
+
+        cnn = dbapi.connect(host = DB_HOST, user = DB_USER,
+                            password = DB_PASSWD, db = DB_DB, multi_statements = True)
+        for cursorclass in (dbapi.Cursor, dbapi.SSCursor):
+            cur = cnn.cursor(cursorclass)
+            cur.execute("select 1; update tbltest set test_string = 'test'; select 2, 3")
+            self.assertEquals([(1, )], list(cur.fetchall()))
+            self.assertTrue(cur.nextset())
+            self.assertEquals(None, cur.description)
+            self.assertTrue(cur.nextset())
+            self.assertEquals([(2, 3)], list(cur.fetchall()))
+            self.assertEquals(None, cur.nextset())
+            cur.execute("update tbltest set test_string = 'test1'")
+            self.assertEquals(1, cur.rowcount)
+            cur.close()
+
+        cnn.close()
+
+    def testMultiplexedConnection(self):
+        from geventmysql import multiplex
+
+        cnn = multiplex.connect(host = DB_HOST, user = DB_USER,
+                                password = DB_PASSWD, db = DB_DB)
+
+        cnn.query("truncate tbltest")
+
+        def worker(i):
+            cnn.query("insert into tbltest (test_id, test_string) values (%d, 'test%d')" % (i, i))
+            rs = cnn.query("select test_string from tbltest where test_id = %d" % i)
+            rows = list(rs)
+            rs.close()
+            return rows
+
+        greenlets = [gevent.spawn(worker, i) for i in range(100)]
+        gevent.joinall(greenlets)
+        self.assertEquals([[('test%d' % i, )] for i in range(100)], [g.value for g in greenlets])
+
+        #errors go to the greenlet that sent the statement
+        try:
+            cnn.query("select * from tbltest_does_not_exist")
+            self.fail("expected error")
+        except client.ClientCommandError:
+            pass
+
+        try:
+            cnn.query("begin")
+            self.fail("expected error")
+        except client.ClientProgrammingError:
+            pass
+
+        rs = cnn.query("select count(*) from tbltest")
+        self.assertEquals([(100, )], list(rs))
+        rs.close()
+
+        cnn.close()
+
+    def testBatchLoader(self):
+        from geventmysql import loader
+
+        #without autocommit every batch would read from the snapshot of the first one
+        cnn = dbapi.connect(host = DB_HOST, user = DB_USER,
+                            password = DB_PASSWD, db = DB_DB)
+        self.assertRaises(dbapi.ProgrammingError, loader.BatchLoader, cnn, "select test_id from tbltest where test_id in (%s)")
+        cnn.close()
+
+        cnn = dbapi.connect(host = DB_HOST, user = DB_USER,
+                            password = DB_PASSWD, db = DB_DB, autocommit = True)
+
+        cur = cnn.cursor()
+        cur.execute("truncate tbltest")
+        for i in range(20):
+            cur.execute("insert into tbltest (test_id, test_string) values (%s, %s)", (i % 10, 'test%d' % i))
+        cur.close()
+
+        ldr = loader.BatchLoader(cnn, "select test_id, test_string from tbltest where test_id in (%s) order by length(test_string), test_string",
+                                 key_column = 'test_id', max_batch_size = 8)
+
+        #12 greenlets ask for 11 different keys, that is 2 queries
+        greenlets = [gevent.spawn(ldr.load, i) for i in range(11) + [3]]
+        gevent.joinall(greenlets)
+        self.assertEquals(2, ldr.batches)
+        self.assertEquals(12, ldr.loads)
+        for i, g in zip(range(11) + [3], greenlets):
+            if i < 10:
+                self.assertEquals([(i, 'test%d' % i), (i, 'test%d' % (i + 10))], g.value)
+            else:
+                self.assertEquals([], g.value)
+
+        self.assertEquals([[(1, 'test1'), (1, 'test11')], []], ldr.load_many([1, 42]))
+        self.assertEquals(3, ldr.batches)
+
+        #the server matches '2' with 2, but the rows are handed out by comparing the keys in python
+        self.assertEquals([[], []], ldr.load_many(['2', '3']))
+        ldr = loader.BatchLoader(cnn, "select test_id, test_string from tbltest where test_string in (%s)",
+                                 key_column = 'test_string', normalize_key = lambda key: key.lower())
+        self.assertEquals([[(2, 'test2')], [(3, 'test3')]], ldr.load_many(['TEST2', 'test3']))
+
+        #rows inserted after the first batch are seen by the next one
+        ldr.load('test4')
+        cur = cnn.cursor()
+        cur.execute("insert into tbltest (test_id, test_string) values (100, 'test100')")
+        cur.close()
+        self.assertEquals([(100, 'test100')], ldr.load('test100'))
+
+        cnn.close()
+
+        #the key column is found in the rows whatever the row factory of the connection is
+        cnn = dbapi.connect(host = DB_HOST, user = DB_USER, password = DB_PASSWD, db = DB_DB,
+                            autocommit = True, row_factory = dbapi.ROW_FACTORY.DICT)
+        ldr = loader.BatchLoader(cnn, "select test_id, test_string from tbltest where test_id in (%s) order by test_string")
+        self.assertEquals([[(1, 'test1'), (1, 'test11')], []], ldr.load_many([1, 42]))
+
+        cnn.close()
+
+    def testSingleFlight(self):
+        single_flight = client.SingleFlight()
+
+        cnns = [client.connect(host = DB_HOST, user = DB_USER, password = DB_PASSWD, db = DB_DB, autocommit = True,
+                               single_flight = single_flight) for _ in range(10)]
+
+        def worker(cnn, shared = None):
+            rs = cnn.query("select sleep(0.2), 1", shared)
+            rows = list(rs)
+            rs.close()
+            return rows
+
+        #all selects wait for the first one
+        greenlets = [gevent.spawn(worker, cnn) for cnn in cnns]
+        gevent.joinall(greenlets)
+        self.assertEquals([((0, 1), )] * 10, [tuple(g.value) for g in greenlets])
+        self.assertEquals(1, single_flight.executed)
+        self.assertEquals(9, single_flight.shared)
+
+        #opting out executes every select
+        greenlets = [gevent.spawn(worker, cnn, False) for cnn in cnns[:3]]
+        gevent.joinall(greenlets)
+        self.assertEquals(1, single_flight.executed)
+        self.assertEquals({}, single_flight.flights)
+
+        #selects within a transaction are not shared, unless asked for
+        for cnn in cnns[:3]:
+            cnn.query("BEGIN")
+            self.assertFalse(cnn.in_autocommit())
+        greenlets = [gevent.spawn(worker, cnn) for cnn in cnns[:3]]
+        gevent.joinall(greenlets)
+        self.assertEquals(1, single_flight.executed)
+        greenlets = [gevent.spawn(worker, cnn, True) for cnn in cnns[:3]]
+        gevent.joinall(greenlets)
+        self.assertEquals(2, single_flight.executed)
+        self.assertEquals(11, single_flight.shared)
+        for cnn in cnns[:3]:
+            cnn.rollback()
+            self.assertTrue(cnn.in_autocommit())
+
+        #selects of which the result depends on the session, or that lock rows are never shared
+        for qry in ["select sql_calc_found_rows * from tbltest", "select * from tbltest for share",
+                    "select * from tbltest for update nowait", "select * from tbltest for update skip locked",
+                    "select rand()", "select uuid()", "select found_rows()", "select @a"]:
+            self.assertFalse(client.is_shared_select(qry), qry)
+        self.assertTrue(client.is_shared_select("select * from tbltest"))
+
+        #errors go to all of the waiting greenlets
+        def failing(cnn):
+            try:
+                cnn.query("select sleep(0.2), x from tbltest_does_not_exist")
+            except client.ClientCommandError:
+                return True
+        greenlets = [gevent.spawn(failing, cnn) for cnn in cnns]
+        gevent.joinall(greenlets)
+        self.assertEquals([True] * 10, [g.value for g in greenlets])
+
+        #shared results can be read per column, or streamed
+        def columns(cnn):
+            rs = cnn.query("select sleep(0.2), 1, null, 'abc'")
+            result = rs.fetch_columns()
+            rs.close()
+            return result
+        greenlets = [gevent.spawn(columns, cnn) for cnn in cnns]
+        gevent.joinall(greenlets)
+        self.assertEquals(4, single_flight.executed)
+        for g in greenlets:
+            (sleep, one, null, abc), nulls = g.value
+            self.assertEquals([0], list(sleep))
+            self.assertEquals([1], list(one))
+            self.assertEquals([None], null)
+            self.assertEquals(['abc'], abc)
+
+        def streaming(cnn):
+            rs = cnn.query("select sleep(0.2), 'abc'")
+            result = [(row[0], row[1].read()) for row in rs.iter_streaming([1])]
+            rs.close()
+            return result
+        greenlets = [gevent.spawn(streaming, cnn) for cnn in cnns]
+        gevent.joinall(greenlets)
+        self.assertEquals(5, single_flight.executed)
+        self.assertEquals([[(0, 'abc')]] * 10, [g.value for g in greenlets])
+
+        for cnn in cnns:
+            cnn.close()
+
+        #dict rows are mutable, so they are never shared
+        cnns = [client.connect(host = DB_HOST, user = DB_USER, password = DB_PASSWD, db = DB_DB, autocommit = True,
+                               single_flight = single_flight, row_factory = client.ROW_FACTORY.DICT) for _ in range(3)]
+        def changing(cnn):
+            rs = cnn.query("select sleep(0.2) as s, 1 as one")
+            rows = list(rs)
+            rs.close()
+            rows[0]['one'] += 1
+            return rows
+        greenlets = [gevent.spawn(changing, cnn) for cnn in cnns]
+        gevent.joinall(greenlets)
+        self.assertEquals(5, single_flight.executed)
+        self.assertEquals([[{'s': 0, 'one': 2}]] * 3, [g.value for g in greenlets])
+
+        for cnn in cnns:
+            cnn.close()
+
 
 if __name__ == '__main__':
     unittest.main()